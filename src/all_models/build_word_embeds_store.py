@@ -0,0 +1,67 @@
+"""
+Converts the Glove word embeddings text file into a word embeddings store (see WordEmbeddingStore):
+a float32 .npy matrix, which the training/test scripts load memory-mapped, and a .vocab.json file.
+This is done once, and then the models are created in seconds instead of parsing the text file.
+
+With --corpus_paths, the vocabulary is pruned to the words of the processed corpora (and 'unk'),
+so the store takes memory in proportion to the corpora's vocabulary instead of the 400k Glove words.
+
+Usage:
+    python src/all_models/build_word_embeds_store.py --glove_path data/external/char_embed/glove.6B.300d.txt
+        --output_path output/word_embeds_store
+        --corpus_paths data/processed/cybulska_setup/full_swirl_ecb/training_data
+                       data/processed/cybulska_setup/full_swirl_ecb/dev_data
+                       data/processed/cybulska_setup/full_swirl_ecb/test_data
+Then set "word_embeds_store_path" in the config files to the output path.
+"""
+import os
+import sys
+import logging
+import argparse
+import _pickle as cPickle
+
+# the repository root (for the src package) and the src sub-packages (as build_features.py does)
+root_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, root_dir)
+for pack in os.listdir(os.path.join(root_dir, "src")):
+    sys.path.append(os.path.join(root_dir, "src", pack))
+
+from src.all_models.model_utils import build_word_embeds_store, corpus_vocabulary
+
+parser = argparse.ArgumentParser(description='Converting Glove word embeddings into a word embeddings store')
+parser.add_argument('--glove_path', type=str,
+                    help=' The path to the Glove word embeddings text file')
+parser.add_argument('--output_path', type=str,
+                    help=' The path of the store, without extension (.npy and .vocab.json files are created)')
+parser.add_argument('--corpus_paths', type=str, nargs='*', default=[],
+                    help=' Optional, the pickle files of the processed corpora (created by the build_features '
+                         'script). If given, only the words of these corpora are kept.')
+args = parser.parse_args()
+
+logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+
+def main():
+    vocab = None
+    if args.corpus_paths:
+        corpora = []
+        for corpus_path in args.corpus_paths:
+            logging.info('Loading corpus from %s.' % corpus_path)
+            with open(corpus_path, 'rb') as f:
+                corpora.append(cPickle.load(f))
+        vocab = corpus_vocabulary(corpora)
+        logging.info('The corpora have %d distinct words.' % len(vocab))
+
+    logging.info('Reading word embeddings from %s.' % args.glove_path)
+    store = build_word_embeds_store(args.glove_path, vocab)
+    logging.info('%d word embeddings were read.' % len(store.word_to_ix))
+
+    output_dir = os.path.dirname(args.output_path)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    store.save(args.output_path)
+    logging.info('Word embeddings store saved to %s.' % args.output_path)
+
+
+if __name__ == '__main__':
+    main()
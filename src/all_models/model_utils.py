@@ -1,21 +1,27 @@
 import os
 import sys
+import copy
 import json
+import heapq
+import math
 import torch
 import random
+import time
 import logging
+import weakref
 import itertools
 import collections
+import concurrent.futures
 import numpy as np
 import _pickle as cPickle
-from typing import Dict, List, Tuple, Union, Optional  # for type hinting
+from typing import Dict, List, Tuple, Union, Optional, Iterator, Iterable  # for type hinting
 
 from src.all_models.bcubed_scorer import *
 from scorer import *
 from src.shared.eval_utils import *
-from src.all_models.models import CDCorefScorer
+from src.all_models.models import CDCorefScorer, WordEmbeddingStore
 from src.shared.classes import *
-from src.shared.classes import Corpus, Topic, Document, Sentence, Mention, EventMention, EntityMention, Token, Srl_info, Cluster
+from src.shared.classes import Corpus, Topic, Document, Sentence, Mention, EventMention, EntityMention, Token, Srl_info, Cluster, ClusterList
 # import matplotlib.pyplot as plt
 # import spacy
 # from spacy.lang.en import English
@@ -266,7 +272,7 @@ def mention_list_to_external_wd_cluster_list(mention_list: list, external_wd_cor
         print("mention_list_to_external_wd_cluster_list 暂不支持is_event为True")
         return []
     mention_dict = mention_list_to_external_wd_cluster_dict(mention_list, external_wd_coref_info)
-    cluster_list = []
+    cluster_list = ClusterList()
     for doc_id, clusters in mention_dict.items():
         cluster_list.extend(clusters)
     return cluster_list
@@ -328,9 +334,9 @@ def init_cd(mention_list, is_event):
 
     :param mention_list:  Mention list (either event or entity mention)
     :param is_event: whether the mentions are event or entity mentions.
-    :return: Cluster list (singleton clusters).
+    :return: Cluster list (singleton clusters), a ClusterList.
     """
-    cluster_list = []
+    cluster_list = ClusterList()
     for mention in mention_list:
         cluster = Cluster(is_event=is_event)
         cluster.mentions[mention.mention_id] = mention
@@ -415,6 +421,42 @@ def get_char_embed(word, model, device):
     return char_vec
 
 
+def get_char_embeds_batch(words: List[str], model: CDCorefScorer, device: torch.cuda.device,
+                          words_char_ixs: Optional[list] = None) -> torch.Tensor:
+    '''
+    Runs the character LSTM over a list of words/phrases in one batched call
+    (see CDCorefScorer.get_char_embeds_batch())
+    :param words: a list of words/phrases (strings)
+    :param model: CDCorefScorer object
+    :param device: Pytorch device (gpu/cpu)
+    :param words_char_ixs: optional, the precomputed char indices of each word (or None for a word
+     without indices), see index_mentions().
+    :return: the character-LSTM's last output vectors, a tensor of size (len(words), char_hidden_dim),
+     row i is the vector of words[i].
+    '''
+    return model.get_char_embeds_batch(words, device, words_char_ixs)
+
+
+def get_mention_char_string(mention: Mention, is_event: bool) -> str:
+    '''
+    :param mention: an EventMention/EntityMention object
+    :param is_event: True if mention is an event mention and False if it is an entity mention
+    :return: the string the character LSTM runs on for this mention: the head of an event mention,
+     and the whole span of an entity mention.
+    '''
+    return mention.mention_head if is_event else mention.mention_str
+
+
+def get_mention_char_ixs(mention: Mention, is_event: bool) -> Optional[np.ndarray]:
+    '''
+    :param mention: an EventMention/EntityMention object
+    :param is_event: True if mention is an event mention and False if it is an entity mention
+    :return: the char indices of get_mention_char_string() stored by index_mentions(), or None if the
+     mention is not indexed.
+    '''
+    return getattr(mention, 'head_char_ixs' if is_event else 'span_char_ixs', None)
+
+
 def find_word_embed(word: str, model: CDCorefScorer, device: torch.cuda.device) -> torch.Tensor:
     """
     This function get the embedding vector of *word* from the word embedding layer in *model*.
@@ -425,28 +467,104 @@ def find_word_embed(word: str, model: CDCorefScorer, device: torch.cuda.device)
     :param device: Pytorch device
     :return: The embedding vector of *word*
     """
-    word_to_ix = model.word_to_ix
-    word = clean_word(word)
     # get word index
-    if word in word_to_ix:
-        word_ix = [word_to_ix[word]]
-    elif word.lower() in word_to_ix:
-        word_ix = [word_to_ix[word.lower()]]
-    else:
-        word_ix = [word_to_ix['unk']]
+    word_ix = [find_word_ix(word, model.word_to_ix)]
     # get word embedding
     word_tensor = model.word_embed_layer(torch.tensor(word_ix, dtype=torch.long).to(device))
     #
     return word_tensor
 
 
+def find_word_ix(word: str, word_to_ix: Dict[str, int]) -> int:
+    """
+    Looks a word up in the word embeddings vocabulary (after clean_word(), then in lower case,
+    and 'unk' if both are missing).
+
+    :param word: A word.
+    :param word_to_ix: the vocabulary of the word embedding layer (model.word_to_ix)
+    :return: the word's index in the word embedding layer
+    """
+    word = clean_word(word)
+    if word in word_to_ix:
+        return word_to_ix[word]
+    elif word.lower() in word_to_ix:
+        return word_to_ix[word.lower()]
+    return word_to_ix['unk']
+
+
+def index_mentions(mentions: List[Mention], model: CDCorefScorer) -> None:
+    """
+    Preprocessing step: stores on each mention the indices its word and char embeddings are looked
+    up by, so the embedding layers can gather them directly (without string lookups per call):
+
+        - the_mention.head_word_ix: the vocabulary index of the mention's head.
+        - the_mention.word_ixs: the vocabulary indices of the mention's tokens, stop words excluded.
+        - the_mention.head_char_ixs / the_mention.span_char_ixs: the char indices of the mention's
+          head / span string.
+
+    The indices are valid for all the models that share the same word and char vocabularies (the
+    event and the entity models). Mentions which are already indexed are skipped.
+
+    :param mentions: a list of Mention objects
+    :param model: a CDCorefScorer object
+    :return: No return. But the mentions' indices are set.
+    """
+    for mention in mentions:
+        if getattr(mention, 'word_ixs', None) is not None:
+            continue
+        mention.head_word_ix = find_word_ix(mention.mention_head, model.word_to_ix)
+        mention.word_ixs = np.array([find_word_ix(token, model.word_to_ix) for token in mention.get_tokens()
+                                     if not is_stop(token)], dtype=np.int64)
+        mention.head_char_ixs = np.array(model.chars_to_idxs(mention.mention_head), dtype=np.int64)
+        mention.span_char_ixs = np.array(model.chars_to_idxs(mention.mention_str), dtype=np.int64)
+
+
+def find_mention_words_embeds(mention: Mention, model: CDCorefScorer, device: torch.cuda.device) -> torch.Tensor:
+    """
+    Gathers the word embeddings of a mention's tokens (stop words excluded) in one lookup, by the
+    indices stored by index_mentions() (or by looking the tokens up if the mention is not indexed).
+
+    :param mention: a Mention object
+    :param model: A CDCorefScorer object which has a word embedding layer.
+    :param device: Pytorch device
+    :return: a tensor of size (number of non stop-word tokens, word_embed_dim)
+    """
+    word_ixs = getattr(mention, 'word_ixs', None)
+    if word_ixs is None:
+        word_ixs = [find_word_ix(token, model.word_to_ix) for token in mention.get_tokens() if not is_stop(token)]
+    word_ixs = torch.tensor(word_ixs, dtype=torch.long).view(-1).to(device)
+    return model.word_embed_layer(word_ixs)
+
+
+def find_mention_head_embed(mention: Mention, model: CDCorefScorer, device: torch.cuda.device) -> torch.Tensor:
+    """
+    The word embedding of a mention's head, like find_word_embed(mention.mention_head, ...) but by the
+    index stored by index_mentions() if there is one.
+
+    :param mention: a Mention object
+    :param model: A CDCorefScorer object which has a word embedding layer.
+    :param device: Pytorch device
+    :return: a tensor of size (1, word_embed_dim)
+    """
+    head_word_ix = getattr(mention, 'head_word_ix', None)
+    if head_word_ix is None:
+        return find_word_embed(mention.mention_head, model, device)
+    return model.word_embed_layer(torch.tensor([head_word_ix], dtype=torch.long).to(device))
+
+
 def find_mention_cluster(mention_id, clusters):
     '''
     Given a mention ID, the function fetches its current predicted cluster.
+    If *clusters* is a ClusterList, the cluster is looked up in its mention disjoint-set instead of
+    scanning all the clusters.
     :param mention_id: mention ID
     :param clusters: current clusters, should be of the same type (event/entity) as the mention.
     :return: the mention's current predicted cluster
     '''
+    if isinstance(clusters, ClusterList):
+        cluster = clusters.find_mention_cluster(mention_id)
+        if cluster is not None and mention_id in cluster.mentions:
+            return cluster
     for cluster in clusters:
         if mention_id in cluster.mentions:
             return cluster
@@ -584,20 +702,107 @@ def calc_q(cluster_1, cluster_2):
     the number gold coreferrential mention pairwise links (between the two clusters) and all the
     pairwise links.
 
+    The links are counted from the clusters' gold tags histograms (see Cluster.get_gold_tag_counts()),
+    in O(number of gold tags) instead of O(|cluster_1| * |cluster_2|).
+
     :param cluster_1: first cluster
     :param cluster_2: second cluster
     :return: the quality of merge (a number between 0 to 1)
     '''
-    true_pairs = 0
-    false_pairs = 0
-    for mention_c1 in cluster_1.mentions.values():
-        for mention_c2 in cluster_2.mentions.values():
-            if mention_c1.gold_tag == mention_c2.gold_tag:
-                true_pairs += 1
-            else:
-                false_pairs += 1
+    counts_1 = cluster_1.get_gold_tag_counts()
+    counts_2 = cluster_2.get_gold_tag_counts()
+    if len(counts_1) > len(counts_2):
+        counts_1, counts_2 = counts_2, counts_1
+    true_pairs = sum(count * counts_2[gold_tag] for gold_tag, count in counts_1.items() if gold_tag in counts_2)
+    all_pairs = len(cluster_1.mentions) * len(cluster_2.mentions)
 
-    return true_pairs/float(true_pairs + false_pairs)
+    return true_pairs/float(all_pairs)
+
+
+def histograms_matrix(histograms: List[collections.Counter], normalize: bool = False) -> np.ndarray:
+    '''
+    Stacks n histograms (key -> count) into a (n, keys) count matrix.
+
+    :param histograms: a list of Counter objects
+    :param normalize: whether to divide each row by the histogram's size. Then the product of the rows i and j
+        is the proportion of the pairs of counted items, one from each histogram, that have the same key.
+    :return: a (n, keys) array
+    '''
+    key_to_ix = {}
+    for histogram in histograms:
+        for key in histogram:
+            key_to_ix.setdefault(key, len(key_to_ix))
+    # float64 for the BLAS matrix product, the counts are still exact
+    counts = np.zeros((len(histograms), len(key_to_ix)), dtype=np.float64)
+    for i, histogram in enumerate(histograms):
+        for key, count in histogram.items():
+            counts[i, key_to_ix[key]] = count
+    if normalize:
+        sizes = counts.sum(axis=1)
+        sizes[sizes == 0] = 1.0
+        counts /= sizes[:, None]
+
+    return counts
+
+
+def clusters_lexical_features(clusters: List[Cluster]) -> np.ndarray:
+    '''
+    Builds a feature row per cluster, such that the product of two rows is a cheap lexical similarity
+    of the two clusters: the cosine similarity of the clusters' lexical vectors (cluster.lex_vec, see
+    update_lexical_vectors()), or, if some cluster has no lexical vector, the proportion of the mention
+    pairs with the same head lemma.
+
+    :param clusters: a list of clusters
+    :return: a (len(clusters), features) array
+    '''
+    if all(getattr(cluster, 'lex_vec', None) is not None for cluster in clusters):
+        lex_vecs = torch.cat([cluster.lex_vec.detach().view(1, -1) for cluster in clusters], 0).cpu().numpy()
+        norms = np.linalg.norm(lex_vecs, axis=1)
+        norms[norms == 0] = 1.0
+        return lex_vecs / norms[:, None]
+    return histograms_matrix([collections.Counter(mention.mention_head_lemma
+                                                  for mention in cluster.mentions.values())
+                              for cluster in clusters], normalize=True)
+
+
+class TopPairs(object):
+    '''
+    Keeps the k cluster pairs (i, j) with the highest scores out of the pairs added chunk by chunk,
+    in O(k + chunk) memory: each chunk is merged with the kept pairs by np.argpartition (no full sort).
+    '''
+    def __init__(self, k: int):
+        '''
+        :param k: the number of pairs to keep
+        '''
+        self.k = k
+        self.scores = np.zeros(0, dtype=np.float64)
+        self.rows = np.zeros(0, dtype=np.int64)
+        self.cols = np.zeros(0, dtype=np.int64)
+
+    def add(self, scores: np.ndarray, rows: np.ndarray, cols: np.ndarray):
+        '''
+        Adds a chunk of pairs.
+
+        :param scores: the pairs' scores
+        :param rows: the first clusters' indices of the pairs
+        :param cols: the second clusters' indices of the pairs
+        '''
+        if self.k <= 0:
+            return
+        scores = np.concatenate([self.scores, scores])
+        rows = np.concatenate([self.rows, rows])
+        cols = np.concatenate([self.cols, cols])
+        if len(scores) > self.k:
+            top = np.argpartition(-scores, self.k - 1)[:self.k]
+            scores, rows, cols = scores[top], rows[top], cols[top]
+        self.scores, self.rows, self.cols = scores, rows, cols
+
+    def pairs(self) -> List[Tuple[int, int]]:
+        '''
+        :return: the kept pairs (i, j), from the highest score to the lowest
+        '''
+        order = np.argsort(-self.scores, kind='mergesort')
+        return list(zip(self.rows[order].tolist(), self.cols[order].tolist()))
 
 
 def loadGloveWordEmbedding(glove_filename: str) -> Tuple[List, List]:
@@ -624,6 +829,67 @@ def loadGloveWordEmbedding(glove_filename: str) -> Tuple[List, List]:
     return vocab, embd
 
 
+def corpus_vocabulary(corpora: List[Corpus]) -> set:
+    '''
+    Collects the words the model may look up (see find_word_ix()) for the tokens and the mentions
+    of some corpora.
+
+    :param corpora: Corpus objects (e.g. the processed train, dev and test sets)
+    :return: a set of words - each token and mention head after clean_word(), and in lower case.
+    '''
+    words = set()
+
+    def add_word(word):
+        word = clean_word(word)
+        words.add(word)
+        words.add(word.lower())
+
+    for corpus in corpora:
+        for topic in corpus.topics.values():
+            for doc in topic.docs.values():
+                for sent in doc.sentences.values():
+                    for token in sent.get_tokens():
+                        add_word(token.get_token())
+                    for mention in sent.gold_event_mentions + sent.gold_entity_mentions + \
+                            sent.pred_event_mentions + sent.pred_entity_mentions:
+                        add_word(mention.mention_head)
+                        for token in mention.get_tokens():
+                            add_word(token)
+    return words
+
+
+def build_word_embeds_store(glove_filename: str, vocab: Optional[set] = None) -> WordEmbeddingStore:
+    '''
+    Reads Glove word vectors (like loadGloveWordEmbedding(), but line by line and straight into a
+    float32 array) into a WordEmbeddingStore.
+
+    :param glove_filename: Glove file
+    :param vocab: if given, only the vectors of these words (and of 'unk') are kept.
+    :return: a WordEmbeddingStore object (not saved)
+    '''
+    word_to_ix = {}
+    embeds = []
+    with open(glove_filename, 'r', encoding='utf-8') as file:
+        for line in file:
+            row = line.strip().split(' ')
+            if len(row) <= 1 or row[0] == '':
+                continue
+            word = row[0]
+            if vocab is not None and word not in vocab and word != 'unk':
+                continue
+            if len(row[1:]) != 300:
+                logging.info("warning: len of embedding of word %s is not 300." % word)
+            vec = np.asarray(row[1:], dtype=np.float32)
+            if word in word_to_ix:
+                # the last vector of a repeated word is used, as in load_model_embeddings()
+                logging.info("warning: word %s occurs multi times in word vocab." % word)
+                embeds[word_to_ix[word]] = vec
+            else:
+                word_to_ix[word] = len(embeds)
+                embeds.append(vec)
+    return WordEmbeddingStore(np.stack(embeds), word_to_ix)
+
+
 def get_sub_topics(doc_id):
     '''
     Extracts the sub-topic id from the document ID.
@@ -643,9 +909,9 @@ def separate_clusters_to_sub_topics(clusters, is_event):
     Removes spurious cross sub-topics coreference link (used for experiments in Yang setup).
     :param clusters: a list of Cluster objects
     :param is_event: Clusters' type (event/entity)
-    :return: new list of clusters, after spurious cross sub-topics coreference link were removed.
+    :return: new list of clusters (a ClusterList), after spurious cross sub-topics coreference link were removed.
     '''
-    new_clusters = []
+    new_clusters = ClusterList()
     for cluster in clusters:
         sub_topics_to_clusters = {}
         for mention in cluster.mentions.values():
@@ -675,7 +941,7 @@ def set_coref_chain_to_mentions(clusters, is_event, is_gold, intersect_with_gold
     :param remove_singletons: True if the function ignores singleton clusters (as in Yang's setting)
     '''
     global clusters_count
-    for cluster in clusters:
+    for cluster in ordered_clusters(clusters):
         cluster.cluster_id = clusters_count
         for mention in cluster.mentions.values():
             mention.cd_coref_chain = clusters_count
@@ -684,24 +950,32 @@ def set_coref_chain_to_mentions(clusters, is_event, is_gold, intersect_with_gold
 
 def save_check_point(model, fname):
     '''
-    Saves Pytorch model to a file
-    :param model: Pytorch model
+    Saves a CDCorefScorer model to a file, as a slim checkpoint (see CDCorefScorer.get_checkpoint()):
+    the trainable weights and the model's arguments. The frozen word embeddings of a model created
+    with a saved WordEmbeddingStore are not written, only the store's path.
+    :param model: CDCorefScorer model
     :param fname: output filename
     '''
-    torch.save(model, fname)
+    torch.save(model.get_checkpoint(), fname)
 
 
-def load_check_point(fname):
+def load_check_point(fname, map_location=None):
     '''
-    Loads Pytorch model from a file
+    Loads a CDCorefScorer model from a file, saved by save_check_point() or (in the old format) as a
+    whole pickled model.
     :param fname: model's filename
-    :return:Pytorch model
+    :param map_location: the map_location of torch.load(), by default the tensors are loaded to
+     the cpu unless config_dict["use_cuda"] is true.
+    :return: CDCorefScorer model
     '''
-    from src.config import config_dict
-    if config_dict["use_cuda"]:
-        return torch.load(fname)
-    else:
-        return torch.load(fname, map_location=torch.device('cpu'))
+    if map_location is None:
+        from src.config import config_dict
+        if not config_dict["use_cuda"]:
+            map_location = torch.device('cpu')
+    checkpoint = torch.load(fname, map_location=map_location)
+    if isinstance(checkpoint, dict):
+        return CDCorefScorer.from_checkpoint(checkpoint)
+    return checkpoint
 
 
 def create_gold_clusters(mentions):
@@ -770,7 +1044,7 @@ def mention_list_to_gold_wd_cluster_list(mention_list: List[Mention], is_event:
     # get cluster dict
     cluster_dict = mention_list_to_gold_wd_cluster_dict(mention_list, is_event)
     # transfer cluster dict into cluster list
-    cluster_list = []
+    cluster_list = ClusterList()
     for cur_doc_id, cur_doc_cluster_list in cluster_dict.items():
         cluster_list.extend(cur_doc_cluster_list)
     #
@@ -814,6 +1088,92 @@ def write_entity_coref_results(corpus, out_dir,config_dict):
         src.shared.eval_utils.write_mention_based_wd_clusters(corpus, is_event=False, is_gold=False, out_file=out_file)
 
 
+def create_event_mention_lexical_vec(event_mention: EventMention, model: CDCorefScorer,
+                                     device: torch.cuda.device, use_char_embeds: bool,
+                                     requires_grad: bool, chars_vec: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    计算事件指称的指称向量s(m) (the mention's part of its cluster's lexical vector).
+
+    - If *use_char_embeds* is true, 指称向量s(m) = (词级指称向量(m);字级指称向量(m));
+    - If *use_char_embeds* is false, 指称向量s(m) = (词级指称向量(m));
+    - 词级指称向量(m) = head的词向量
+
+    :param event_mention: an EventMention object
+    :param model: CDCorefScorer model
+    :param device: Pytorch device (gpu/cpu)
+    :param use_char_embeds: whether to use character embeddings
+    :param requires_grad: whether the tensors require gradients (True for
+        training time and False for inference time)
+    :param chars_vec: the mention's char-LSTM vector if it was already computed in a batch
+        (see get_char_embeds_batch()), a tensor of size (1, char_hidden_dim).
+    :return: the mention vector, a tensor of size (1, X)
+    """
+    # 1. get word level embedding of cur event mention. 词级指称向量 = head的词向量
+    head = event_mention.mention_head
+    words_vec = find_mention_head_embed(event_mention, model, device)
+    # 2. get char level embedding of cur entity mention. 字级指称向量
+    if use_char_embeds:
+        if chars_vec is None:
+            chars_vec = get_char_embed(head, model, device)
+        if not requires_grad:
+            chars_vec = chars_vec.detach()
+    # 3. get embedding of cur entity mention. 指称向量 = (词级指称向量;字级指称向量)
+    if use_char_embeds:
+        # s(m) = (词级嵌入(m);字级嵌入(m))
+        mention_vec = torch.cat([words_vec, chars_vec], 1)
+    else:
+        # s(m) = (词级嵌入(m))
+        mention_vec = words_vec
+    return mention_vec
+
+
+def create_entity_mention_lexical_vec(entity_mention: EntityMention, model: CDCorefScorer,
+                                      device: torch.cuda.device, use_char_embeds: bool,
+                                      requires_grad: bool, chars_vec: Optional[torch.Tensor] = None) -> torch.Tensor:
+    """
+    计算实体指称的指称向量s(m) (the mention's part of its cluster's lexical vector).
+
+    - If *use_char_embeds* is true, 指称向量s(m) = (词级指称向量(m);字级指称向量(m));
+    - If *use_char_embeds* is false, 指称向量s(m) = (词级指称向量(m));
+    - 词级指称向量(m) = 指称内各词(停用词除外)的glove词向量之和 / 指称的词数
+
+    :param entity_mention: an EntityMention object
+    :param model: CDCorefScorer model
+    :param device: Pytorch device (gpu/cpu)
+    :param use_char_embeds: whether to use character embeddings
+    :param requires_grad: whether the tensors require gradients (True for
+        training time and False for inference time)
+    :param chars_vec: the mention's char-LSTM vector if it was already computed in a batch
+        (see get_char_embeds_batch()), a tensor of size (1, char_hidden_dim).
+    :return: the mention vector, a tensor of size (1, X)
+    """
+    # 1. get word level embedding of cur entity mention. 词级指称向量 = 指称中每个词的词向量的平均
+    if 1:
+        # 1.1 init words_vec
+        words_vec = torch.zeros(model.word_embed_dim, requires_grad=requires_grad).to(device).view(1, -1)
+        """word level embedding of cur entity mention."""
+        # 1.2 calc words_vec: 实体指称的嵌入等于指称内每个词的嵌入取平均
+        words_embeds = find_mention_words_embeds(entity_mention, model, device)
+        """GloVe embedding of each word (stop words excluded) in cur entity mention, one row per word."""
+        words_vec += words_embeds.sum(0, keepdim=True)
+        words_vec /= len(entity_mention.get_tokens())
+    # 2. get char level embedding of cur entity mention. 字级指称向量
+    if use_char_embeds:
+        if chars_vec is None:
+            chars_vec = get_char_embed(entity_mention.mention_str, model, device)
+        """word level embedding of cur entity mention."""
+        if not requires_grad:
+            chars_vec = chars_vec.detach()
+    # 3. get embedding of cur entity mention. 指称向量 = (词级指称向量;字级指称向量)
+    if use_char_embeds:
+        # s(m) = (词级嵌入(m);字级嵌入(m))
+        mention_vec = torch.cat([words_vec, chars_vec], 1)
+    else:
+        # s(m) = (词级嵌入(m))
+        mention_vec = words_vec
+    return mention_vec
+
+
 def create_event_cluster_bow_lexical_vec(event_cluster: Cluster, model: CDCorefScorer,
                                          device: torch.cuda.device, use_char_embeds: bool, requires_grad: bool):
     """
@@ -847,22 +1207,18 @@ def create_event_cluster_bow_lexical_vec(event_cluster: Cluster, model: CDCorefS
             requires_grad=requires_grad
         ).to(device).view(1, -1)
     # set cluster_vec
-    for event_mention in event_cluster.mentions.values():
-        # 1. get word level embedding of cur event mention. 词级指称向量 = head的词向量
-        head = event_mention.mention_head
-        words_vec = find_word_embed(head, model, device)
-        # 2. get char level embedding of cur entity mention. 字级指称向量
-        if use_char_embeds:
-            chars_vec = get_char_embed(head, model, device)
-            if not requires_grad:
-                chars_vec = chars_vec.detach()
-        # 3. get embedding of cur entity mention. 指称向量 = (词级指称向量;字级指称向量)
-        if use_char_embeds:
-            # s(m) = (词级嵌入(m);字级嵌入(m))
-            mention_vec = torch.cat([words_vec, chars_vec], 1)
-        else:
-            # s(m) = (词级嵌入(m))
-            mention_vec = words_vec
+    event_mentions = list(event_cluster.mentions.values())
+    chars_vecs = [None] * len(event_mentions)
+    if use_char_embeds:
+        # 所有指称的字级向量一次算完
+        chars_vecs = get_char_embeds_batch([get_mention_char_string(mention, True) for mention in event_mentions],
+                                           model, device,
+                                           [get_mention_char_ixs(mention, True) for mention in event_mentions]
+                                           ).split(1, 0)
+    for event_mention, chars_vec in zip(event_mentions, chars_vecs):
+        # 1-3. get embedding of cur event mention. 指称向量
+        mention_vec = create_event_mention_lexical_vec(event_mention, model, device, use_char_embeds, requires_grad,
+                                                       chars_vec)
         # 4. get embedding of cur entity cluster. 簇向量 = 簇内指称向量的平均值
         bow_vec += mention_vec
     return bow_vec / len(event_cluster.mentions.keys())
@@ -901,33 +1257,18 @@ def create_entity_cluster_bow_lexical_vec(entity_cluster: Cluster, model: CDCore
             requires_grad=requires_grad
         ).to(device).view(1, -1)
     # set cluster_vec
-    for entity_mention in entity_cluster.mentions.values():
-        # 1. get word level embedding of cur entity mention. 词级指称向量 = 指称中每个词的词向量的平均
-        if 1:
-            # 1.1 init words_vec
-            words_vec = torch.zeros(model.word_embed_dim, requires_grad=requires_grad).to(device).view(1, -1)
-            """word level embedding of cur entity mention."""
-            # 1.2 calc words_vec: 实体指称的嵌入等于指称内每个词的嵌入取平均
-            words_vec_list: List[torch.Tensor] = [find_word_embed(word, model, device)
-                                                  for word in entity_mention.get_tokens()
-                                                  if not is_stop(word)]
-            """GloVe embedding of each word in cur entity mention make up a list."""
-            for word_vec in words_vec_list:
-                words_vec += word_vec
-            words_vec /= len(entity_mention.get_tokens())
-        # 2. get char level embedding of cur entity mention. 字级指称向量
-        if use_char_embeds:
-            chars_vec = get_char_embed(entity_mention.mention_str, model, device)
-            """word level embedding of cur entity mention."""
-            if not requires_grad:
-                chars_vec = chars_vec.detach()
-        # 3. get embedding of cur entity mention. 指称向量 = (词级指称向量;字级指称向量)
-        if use_char_embeds:
-            # s(m) = (词级嵌入(m);字级嵌入(m))
-            mention_vec = torch.cat([words_vec, chars_vec], 1)
-        else:
-            # s(m) = (词级嵌入(m))
-            mention_vec = words_vec
+    entity_mentions = list(entity_cluster.mentions.values())
+    chars_vecs = [None] * len(entity_mentions)
+    if use_char_embeds:
+        # 所有指称的字级向量一次算完
+        chars_vecs = get_char_embeds_batch([get_mention_char_string(mention, False) for mention in entity_mentions],
+                                           model, device,
+                                           [get_mention_char_ixs(mention, False) for mention in entity_mentions]
+                                           ).split(1, 0)
+    for entity_mention, chars_vec in zip(entity_mentions, chars_vecs):
+        # 1-3. get embedding of cur entity mention. 指称向量
+        mention_vec = create_entity_mention_lexical_vec(entity_mention, model, device, use_char_embeds, requires_grad,
+                                                        chars_vec)
         # 4. get embedding of cur entity cluster. 簇向量 = 簇内指称向量的平均值
         cluster_vec += mention_vec
     return cluster_vec / len(entity_cluster.mentions.keys())
@@ -942,10 +1283,14 @@ def find_mention_cluster_vec(mention_id: str, clusters: Cluster) -> torch.Tensor
     2. return the semantically-dependent vector of this cluster, that is the_cluster.lex_vec.
 
     :param mention_id: mention ID.
-    :param clusters: list of Cluster objects
+    :param clusters: list of Cluster objects (a ClusterList is looked up by its mention index)
     :return: semantically-dependent vector of a mention's cluster.
         Pytorch tensor with size (1, 350).
     """
+    if isinstance(clusters, ClusterList):
+        cluster = clusters.find_mention_cluster(mention_id)
+        if cluster is not None and mention_id in cluster.mentions:
+            return cluster.lex_vec.detach()
     for cluster in clusters:
         if mention_id in cluster.mentions:
             return cluster.lex_vec.detach()
@@ -1014,6 +1359,29 @@ def create_entity_cluster_bow_predicate_vec(entity_cluster: List[Cluster], event
                 entity_mention.loc_vec = find_mention_cluster_vec(predicate_id[1], event_clusters).to(device)
 
 
+_model_tokens = weakref.WeakKeyDictionary()
+"""Key is a CDCorefScorer and value is a unique number of it, see model_parameters_version()."""
+_model_tokens_counter = itertools.count()
+
+
+def model_parameters_version(model: CDCorefScorer) -> Optional[Tuple[int, int]]:
+    """
+    Returns a version of the model's trainable parameters, which changes whenever they are changed
+    in place (by an optimizer step or load_state_dict()), using the tensors' version counters.
+    Tensors computed by the model can be reused as long as its version does not change.
+
+    :param model: CDCorefScorer object
+    :return: a tuple (a unique number of the model object, the sum of its parameters' version counters),
+        or None if the version counters are not available.
+    """
+    versions = [getattr(parameter, '_version', None) for parameter in model.parameters() if parameter.requires_grad]
+    if None in versions:
+        return None
+    if model not in _model_tokens:
+        _model_tokens[model] = next(_model_tokens_counter)
+    return _model_tokens[model], sum(versions)
+
+
 def update_lexical_vectors(clusters: List[Cluster], model: CDCorefScorer,
                            device: torch.cuda.device, is_event: bool, requires_grad: bool):
     """
@@ -1021,6 +1389,12 @@ def update_lexical_vectors(clusters: List[Cluster], model: CDCorefScorer,
 
     the_cluster.lex_vec = average(簇内每个指称的指称向量s(m)).
 
+    Each mention's vector s(m) is cached in the_mention.lex_vec, together with the model parameters
+    version it was computed with (see model_parameters_version()). Without gradients, a cached vector
+    is reused until the model is trained. And each cluster keeps the sum and the number of its mention
+    vectors (the_cluster.lex_vec_sum, the_cluster.lex_vec_count), so merge_clusters() can build the
+    vector of a merged cluster from its two parents without running the model.
+
     :param clusters: list of Cluster objects (event/entity clsuters)
     :param model: It should be an event model if clusters are event clusters (and
         the same with entities)
@@ -1028,14 +1402,36 @@ def update_lexical_vectors(clusters: List[Cluster], model: CDCorefScorer,
     :param is_event: True, if *clusters* are event clusters; False, if *clusters* are entity clusters.
     :param requires_grad: True if tensors require gradients (for training time) , and
      False for inference time.
-    :return: no return, but set cluster.lex_vec
+    :return: no return, but set cluster.lex_vec (and cluster.lex_vec_sum, cluster.lex_vec_count,
+     mention.lex_vec, mention.lex_vec_version)
     """
+    # 带梯度的向量不能复用 (their graph is freed by the backward pass)
+    version = None if requires_grad else model_parameters_version(model)
+    all_mentions = [mention for cluster in clusters for mention in cluster.mentions.values()]
+    stale_mentions = [mention for mention in all_mentions
+                      if version is None or getattr(mention, 'lex_vec_version', None) != version]
+    # 需要重算的指称的字级向量一次算完 (one batched char-LSTM call)
+    if stale_mentions:
+        stale_chars_vecs = get_char_embeds_batch([get_mention_char_string(mention, is_event)
+                                                  for mention in stale_mentions],
+                                                 model, device,
+                                                 [get_mention_char_ixs(mention, is_event) for mention in stale_mentions])
+        for mention, chars_vec in zip(stale_mentions, stale_chars_vecs.split(1, 0)):
+            if is_event:
+                mention.lex_vec = create_event_mention_lexical_vec(mention, model, device, use_char_embeds=True,
+                                                                   requires_grad=requires_grad, chars_vec=chars_vec)
+            else:
+                mention.lex_vec = create_entity_mention_lexical_vec(mention, model, device, use_char_embeds=True,
+                                                                    requires_grad=requires_grad, chars_vec=chars_vec)
+            mention.lex_vec_version = version
     for cluster in clusters:
-        if is_event:
-            lex_vec = create_event_cluster_bow_lexical_vec(cluster, model, device, use_char_embeds=True, requires_grad=requires_grad)
-        else:
-            lex_vec = create_entity_cluster_bow_lexical_vec(cluster, model, device, use_char_embeds=True, requires_grad=requires_grad)
-        cluster.lex_vec = lex_vec
+        lex_vec_sum = torch.zeros(model.word_embed_dim + model.char_hidden_dim,
+                                  requires_grad=requires_grad).to(device).view(1, -1)
+        for mention in cluster.mentions.values():
+            lex_vec_sum += mention.lex_vec
+        cluster.lex_vec_sum = lex_vec_sum
+        cluster.lex_vec_count = len(cluster.mentions)
+        cluster.lex_vec = lex_vec_sum / cluster.lex_vec_count
 
 
 def update_args_feature_vectors(clusters: List[Cluster], other_clusters: List[Cluster],
@@ -1066,6 +1462,187 @@ def update_args_feature_vectors(clusters: List[Cluster], other_clusters: List[Cl
             create_entity_cluster_bow_predicate_vec(cluster, other_clusters, model, device)
 
 
+def ordered_clusters(clusters: List[Cluster]) -> List[Cluster]:
+    """
+    :param clusters: a list of clusters
+    :return: the clusters in their list order (see ClusterList.ordered(), a ClusterList's merge()
+        does not keep the order of the list itself)
+    """
+    return clusters.ordered() if isinstance(clusters, ClusterList) else clusters
+
+
+def copy_clusters(clusters: List[Cluster]) -> List[Cluster]:
+    """
+    :param clusters: a list of clusters
+    :return: a list of shallow copies of the clusters (in their list order), with their own mentions
+        dicts, so they can be merged without changing the given clusters. The mentions are shared.
+    """
+    copies = []
+    for cluster in ordered_clusters(clusters):
+        cluster_copy = copy.copy(cluster)
+        cluster_copy.mentions = MentionsDict(cluster.mentions)
+        copies.append(cluster_copy)
+    return copies
+
+
+def clusterings_pairwise_f1(clusters_1: List[Cluster], clusters_2: List[Cluster]) -> float:
+    """
+    Compares two clusterings of the same mentions by their coreference links: the F1 of the mention
+    pairs which are in the same cluster in *clusters_1* against those of *clusters_2*.
+
+    :param clusters_1: a list of clusters
+    :param clusters_2: a list of clusters of the same mentions
+    :return: the pairwise F1, 1.0 if the clusterings are the same
+    """
+    mention_to_cluster_2 = {mention_id: ix for ix, cluster in enumerate(clusters_2) for mention_id in cluster.mentions}
+    common_links = 0
+    for cluster in clusters_1:
+        overlaps = collections.Counter(mention_to_cluster_2[mention_id] for mention_id in cluster.mentions)
+        common_links += sum(count * (count - 1) // 2 for count in overlaps.values())
+    links_1 = sum(len(cluster.mentions) * (len(cluster.mentions) - 1) // 2 for cluster in clusters_1)
+    links_2 = sum(len(cluster.mentions) * (len(cluster.mentions) - 1) // 2 for cluster in clusters_2)
+    if links_1 + links_2 == 0:
+        return 1.0
+    return 2.0 * common_links / (links_1 + links_2)
+
+
+def iterate_cluster_pairs(clusters: List[Cluster]) -> Iterator[Tuple[Cluster, Cluster]]:
+    """
+    Lazily enumerates all the candidate cluster pairs (for inference time).
+
+    Each unordered pair is visited once by index, as (clusters[i], clusters[j]) with i < j,
+    so no membership checks against the already generated pairs are needed.
+
+    :param clusters: current clusters. The list must not change while the pairs are consumed.
+    :return: a generator of tuples (cluster1, cluster2).
+    """
+    clusters = ordered_clusters(clusters)
+    clusters_num = len(clusters)
+    for i in range(clusters_num):
+        cluster_1 = clusters[i]
+        for j in range(i + 1, clusters_num):
+            yield cluster_1, clusters[j]
+
+
+def iterate_train_cluster_pairs(clusters: List[Cluster],
+                                hard_negatives_budget: Optional[int] = None,
+                                random_negatives_budget: int = 0) -> Iterator[Tuple[Cluster, Cluster, float]]:
+    """
+    Lazily enumerates the candidate cluster pairs for training time, together with their
+    quality of merge (see calc_q()), computed per pair from the clusters' gold tags histograms.
+
+    All the pairs are generated if len(clusters) <= 300. Otherwise, the negative pairs (q = 0)
+    are under-sampled, and all the positive pairs are kept:
+        - if *hard_negatives_budget* is None, each negative pair gets up to two draws with probability p
+          (0.7 if there are less than 500 clusters and 0.6 otherwise), so it is kept with probability
+          1 - (1 - p)^2. If only the second draw succeeds, the pair is generated reversed, as
+          (cluster2, cluster1, q). This is how the original generate_cluster_pairs() sampled, which
+          visited each pair in both orders.
+        - otherwise, the *hard_negatives_budget* negative pairs of the most lexically similar clusters
+          and *random_negatives_budget* random negative pairs are kept (see iterate_ranked_train_cluster_pairs()).
+
+    :param clusters: current clusters. The list must not change while the pairs are consumed.
+    :param hard_negatives_budget: the number of hard negative pairs to keep, or None for
+        the probability p under-sampling.
+    :param random_negatives_budget: the number of random negative pairs to keep in addition to the
+        hard negative pairs.
+    :return: a generator of tuples (cluster1, cluster2, true score).
+    """
+    clusters = ordered_clusters(clusters)
+    # 判断是否需要下采样
+    use_under_sampling = True if len(clusters) > 300 else False
+    if use_under_sampling and hard_negatives_budget is not None:
+        yield from iterate_ranked_train_cluster_pairs(clusters, hard_negatives_budget, random_negatives_budget)
+        return
+    if len(clusters) < 500:
+        p = 0.7
+    else:
+        p = 0.6
+    if use_under_sampling:
+        logging.info('Using under sampling with p = {}'.format(p))
+    positive_pairs_count = 0
+    negative_pairs_count = 0
+    # 遍历所有簇对
+    clusters_num = len(clusters)
+    for i, j in itertools.combinations(range(clusters_num), 2):
+        cluster_1, cluster_2 = clusters[i], clusters[j]
+        q = calc_q(cluster_1, cluster_2)
+        add_to_training = not use_under_sampling
+        if q > 0:
+            add_to_training = True
+            positive_pairs_count += 1
+        if q == 0:
+            if random.random() < p:
+                add_to_training = True
+                negative_pairs_count += 1
+            elif use_under_sampling and random.random() < p:
+                # 原来的实现会在反向 (cluster_2, cluster_1) 时再抽一次
+                cluster_1, cluster_2 = cluster_2, cluster_1
+                add_to_training = True
+                negative_pairs_count += 1
+        if add_to_training:
+            yield cluster_1, cluster_2, q
+    logging.info('Generated {} positive and {} sampled negative training cluster pairs'.format(
+        positive_pairs_count, negative_pairs_count))
+
+
+def iterate_ranked_train_cluster_pairs(clusters: List[Cluster], hard_negatives_budget: int,
+                                       random_negatives_budget: int,
+                                       chunk_pairs: int = 2 ** 20) -> Iterator[Tuple[Cluster, Cluster, float]]:
+    """
+    Lazily enumerates the candidate cluster pairs for training time with similarity-ranked
+    under-sampling of the negative pairs (see iterate_train_cluster_pairs()).
+    The pairs are generated in the same order as iterate_cluster_pairs().
+
+    The negative pairs are ranked chunk by chunk (blocks of rows of the pairs (i, j), i < j), so only
+    about *chunk_pairs* similarities and the kept pairs are in memory at once:
+        - the hard negatives are the top *hard_negatives_budget* similarities (see TopPairs).
+        - the random negatives are drawn from the *hard_negatives_budget* + *random_negatives_budget*
+          negatives with the highest random keys (a uniform sample without replacement), skipping the hard ones.
+
+    :param clusters: current clusters. The list must not change while the pairs are consumed.
+    :param hard_negatives_budget: the number of hard negative pairs to keep.
+    :param random_negatives_budget: the number of random negative pairs to keep.
+    :param chunk_pairs: the (approximate) number of pairs ranked at once.
+    :return: a generator of tuples (cluster1, cluster2, true score).
+    """
+    logging.info('Using under sampling with {} hard and {} random negatives'.format(
+        hard_negatives_budget, random_negatives_budget))
+    clusters_num = len(clusters)
+    features = clusters_lexical_features(clusters)
+    # q > 0 iff the clusters share a gold tag
+    gold_tags = histograms_matrix([cluster.get_gold_tag_counts() for cluster in clusters])
+    hard_negatives = TopPairs(hard_negatives_budget)
+    random_negatives = TopPairs(hard_negatives_budget + random_negatives_budget)
+    chunk_rows = max(1, chunk_pairs // clusters_num)
+    for start in range(0, clusters_num, chunk_rows):
+        end = min(clusters_num, start + chunk_rows)
+        # the pairs (i, j) with start <= i < end and j > i
+        rows, cols = np.nonzero(np.triu(np.ones((end - start, clusters_num), dtype=bool), k=start + 1))
+        is_negative = gold_tags[start:end].dot(gold_tags.T)[rows, cols] == 0
+        rows, cols = rows[is_negative], cols[is_negative]
+        similarities = features[start:end].dot(features.T)[rows, cols]
+        rows += start
+        hard_negatives.add(similarities, rows, cols)
+        random_negatives.add(np.random.random_sample(len(rows)), rows, cols)
+    sampled_negatives = set(hard_negatives.pairs())
+    # random_negatives.pairs() is in a random order
+    for pair in random_negatives.pairs():
+        if len(sampled_negatives) >= hard_negatives_budget + random_negatives_budget:
+            break
+        sampled_negatives.add(pair)
+    positive_pairs_count = 0
+    for i, j in itertools.combinations(range(clusters_num), 2):
+        q = calc_q(clusters[i], clusters[j])
+        if q > 0:
+            positive_pairs_count += 1
+        elif (i, j) not in sampled_negatives:
+            continue
+        yield clusters[i], clusters[j], q
+    logging.info('Generated {} positive and {} sampled negative training cluster pairs'.format(
+        positive_pairs_count, len(sampled_negatives)))
+
+
 def generate_cluster_pairs(clusters: List[Cluster], is_train) -> Tuple[
     List[Union[Tuple[Cluster, Cluster, float], Tuple[Cluster, Cluster]]],
     List[Tuple[Cluster, Cluster]]
@@ -1084,6 +1661,9 @@ def generate_cluster_pairs(clusters: List[Cluster], is_train) -> Tuple[
           The tuple likes (cluster1, cluster2).
           test_pairs includes all possible cluster pairs.
 
+    Note that this function materializes all the pairs, use iterate_cluster_pairs() and
+    iterate_train_cluster_pairs() to consume them lazily.
+
     :param clusters: current clusters
     :param is_train: True if the function generates candidate cluster pairs for training time
         , and False for inference time (without under-sampling)
@@ -1093,51 +1673,17 @@ def generate_cluster_pairs(clusters: List[Cluster], is_train) -> Tuple[
     logging.info('Initial number of clusters = {}'.format(len(clusters)))
 
     if is_train:
-        positive_pairs_count = 0
-        negative_pairs_count = 0
-        train_pairs = []  # 用于训练的候选簇对，带共指得分
-        test_pairs = []   # 用于测试的候选簇对，不带共指得分
-        # 判断train_pairs是否需要下采样
-        use_under_sampling = True if len(clusters) > 300 else False
-        if len(clusters) < 500:
-            p = 0.7
-        else:
-            p = 0.6
-        if use_under_sampling:
-            logging.info('Using under sampling with p = {}'.format(p))
-        # 遍历所有簇对
-        for cluster_1 in clusters:
-            for cluster_2 in clusters:
-                if cluster_1 != cluster_2:
-                    q = calc_q(cluster_1, cluster_2)
-                    if (cluster_1, cluster_2, q) not in train_pairs and (cluster_2, cluster_1, q) not in train_pairs:
-                        # 把当前簇对添加到train_pairs
-                        add_to_training = not use_under_sampling
-                        if q > 0:
-                            add_to_training = True
-                            positive_pairs_count += 1
-                        if q == 0 and random.random() < p:
-                            add_to_training = True
-                            negative_pairs_count += 1
-                        if add_to_training:
-                            train_pairs.append((cluster_1, cluster_2, q))
-                        # 把当前簇对添加到test_pairs
-                        test_pairs.append((cluster_1, cluster_2))
+        train_pairs = list(iterate_train_cluster_pairs(clusters))  # 用于训练的候选簇对，带共指得分
+        test_pairs = list(iterate_cluster_pairs(clusters))  # 用于测试的候选簇对，不带共指得分
         return train_pairs, test_pairs
     else:
-        test_pairs = []  # 用于测试的候选簇对，不带共指得分
-        # 遍历所有簇对
-        for cluster_1 in clusters:
-            for cluster_2 in clusters:
-                if cluster_1 != cluster_2:
-                    if (cluster_1, cluster_2) not in test_pairs and (cluster_2, cluster_1) not in test_pairs:
-                        # 把当前簇对添加到test_pairs
-                        test_pairs.append((cluster_1, cluster_2))
+        test_pairs = list(iterate_cluster_pairs(clusters))  # 用于测试的候选簇对，不带共指得分
         return test_pairs, []
 
 
 def get_mention_span_rep(mention: Mention, device: torch.cuda.device, model: CDCorefScorer,
-                         docs: Dict[str, Document], is_event: bool, requires_grad: bool) -> torch.Tensor:
+                         docs: Dict[str, Document], is_event: bool, requires_grad: bool,
+                         chars_vec: Optional[torch.Tensor] = None) -> torch.Tensor:
     """
     For *mention*, this function:
         - calc it's span text vector s(m) = average(word embedding of each word in the mention)
@@ -1151,6 +1697,8 @@ def get_mention_span_rep(mention: Mention, device: torch.cuda.device, model: CDC
     :param is_event: True if mention is an event mention and False if it is an entity mention
     :param requires_grad: True if tensors require gradients (for training time) , and
         False for inference time.
+    :param chars_vec: the mention's char-LSTM vector if it was already computed in a batch
+        (see get_char_embeds_batch()), a tensor of size (1, char_hidden_dim).
     :return: The span representation of *mention*. It is a tensor with size (1, 1374).
     """
     # 1. get the context vector c(m)
@@ -1160,23 +1708,24 @@ def get_mention_span_rep(mention: Mention, device: torch.cuda.device, model: CDC
     span_vec: torch.Tensor = torch.zeros(model.word_embed_dim+model.char_hidden_dim, requires_grad=requires_grad).to(device).view(1, -1)
     if is_event:
         head = mention.mention_head
-        words_vec = find_word_embed(head, model, device)
-        chars_vec = get_char_embed(head, model, device)
+        words_vec = find_mention_head_embed(mention, model, device)
+        if chars_vec is None:
+            chars_vec = get_char_embed(head, model, device)
         span_vec = torch.cat([words_vec, chars_vec], 1)
     else:
         words_vec = torch.zeros(model.word_embed_dim, requires_grad=requires_grad).to(device).view(1, -1)
-        word_vec_list = [find_word_embed(token, model, device) for token in mention.get_tokens()
-                         if not is_stop(token)]
-        for word_vec in word_vec_list:
-            words_vec = words_vec + word_vec
-            """
-            改bug，mention_bow += mention_word_tensor，改成mention_bow = mention_bow + mention_word_tensor
-            (后来命名改了，但就是这个意思)
-            问题所在：mention_bow初始没问题，但循环中的+=是inplace操作，所以_version非0，产生了问题
-            """
-        chars_vec = get_char_embed(mention.mention_str, model, device)
-        if len(word_vec_list) > 0:
-            words_vec = words_vec / float(len(word_vec_list))
+        # 非停用词的词向量一次取出 (one gather by the mention's word indices)
+        words_embeds = find_mention_words_embeds(mention, model, device)
+        words_vec = words_vec + words_embeds.sum(0, keepdim=True)
+        """
+        改bug，mention_bow += mention_word_tensor，改成mention_bow = mention_bow + mention_word_tensor
+        (后来命名改了，但就是这个意思)
+        问题所在：mention_bow初始没问题，但循环中的+=是inplace操作，所以_version非0，产生了问题
+        """
+        if chars_vec is None:
+            chars_vec = get_char_embed(mention.mention_str, model, device)
+        if words_embeds.shape[0] > 0:
+            words_vec = words_vec / float(words_embeds.shape[0])
         span_vec = torch.cat([words_vec, chars_vec], 1)
 
     # 3. mention span rep = (c(m);s(m))
@@ -1209,8 +1758,13 @@ def create_mention_span_representations(
     :param requires_grad: True if tensors require gradients (for training time) , and False for inference time.
     :return: No return. But for each mention in *mentions*, each_mention.span_rep are updated.
     """
-    for mention in mentions:
-        mention.span_rep = get_mention_span_rep(mention, device, model, topic_docs, is_event, requires_grad)
+    # 所有指称的字级向量一次算完 (one batched char-LSTM call)
+    chars_vecs = get_char_embeds_batch([get_mention_char_string(mention, is_event) for mention in mentions],
+                                       model, device,
+                                       [get_mention_char_ixs(mention, is_event) for mention in mentions])
+    for mention, chars_vec in zip(mentions, chars_vecs.split(1, 0)):
+        mention.span_rep = get_mention_span_rep(mention, device, model, topic_docs, is_event, requires_grad,
+                                                chars_vec)
 
 
 def mention_pair_to_model_input(pair, model, device, topic_docs, is_event, requires_grad,
@@ -1296,8 +1850,302 @@ def mention_pair_to_model_input(pair, model, device, topic_docs, is_event, requi
     return mention_pair_tensor
 
 
+def create_mention_tensor(mention: Mention, use_args_feats: bool) -> torch.Tensor:
+    """
+    Returns the mention representation v(m) = (s(m); d(m)), or v(m) = s(m) if *use_args_feats*
+    is false (see mention_pair_to_model_input()).
+
+    :param mention: a Mention object whose span_rep (and arg vectors) are already set.
+    :param use_args_feats: whether to use the semantically-dependent mention vectors or to ablate them.
+    :return: a tensor of size (1, X)
+    """
+    if use_args_feats:
+        return torch.cat([mention.span_rep, mention.arg0_vec, mention.arg1_vec,
+                          mention.loc_vec, mention.time_vec], 1)
+    return mention.span_rep
+
+
+def map_mentions_to_clusters(clusters: List[Cluster]) -> Dict[str, Cluster]:
+    """
+    Maps each mention id to its cluster.
+
+    :param clusters: a list of Cluster objects
+    :return: a dictionary, key is a mention id and value is the Cluster object it belongs to.
+        For a ClusterList this is its own mention index (it should not be changed).
+    """
+    if isinstance(clusters, ClusterList):
+        return clusters.mention_to_cluster
+    mention_to_cluster = {}
+    for cluster in clusters:
+        for mention_id in cluster.mentions:
+            mention_to_cluster[mention_id] = cluster
+    return mention_to_cluster
+
+
+def mention_args_signature(mention: Mention, mention_to_other_cluster: Dict[str, Cluster],
+                           is_event: bool) -> tuple:
+    """
+    Returns the other type's clusters of a mention's arguments (for an event mention) or predicates
+    (for an entity mention). The mention's semantically-dependent vectors and its binary features
+    depend only on these clusters, so if the signature of a mention has not changed, neither have
+    its inputs to the model.
+
+    :param mention: an EventMention/EntityMention object
+    :param mention_to_other_cluster: maps the mention ids of the other type to their current clusters,
+        see map_mentions_to_clusters().
+    :param is_event: True if the mention is an event mention and False if it is an entity mention
+    :return: a tuple of Cluster objects (or None for a missing argument), compared by identity.
+    """
+    if is_event:
+        return tuple(mention_to_other_cluster.get(getattr(mention, role)[1])
+                     if getattr(mention, role) is not None else None
+                     for role in ['arg0', 'arg1', 'amloc', 'amtmp'])
+    return tuple((rel, mention_to_other_cluster.get(predicate_id[1]))
+                 for predicate_id, rel in mention.predicates.items())
+
+
+def update_role_signatures(mentions: List[Mention], other_clusters: List[Cluster], is_event: bool) -> None:
+    """
+    Sets the role signature of each mention: the cluster ids of its Arg0/Arg1/location/time
+    arguments (for an event mention) or predicates (for an entity mention) in *other_clusters*.
+    Two mentions share a coreferring argument in a role iff their signatures intersect in that
+    role, so the binary features of many pairs are computed from the signatures by
+    role_signatures_coref_bits().
+
+    If *other_clusters* is a ClusterList, a mention's signature is recomputed only if the list
+    has changed since it was computed (see ClusterList.version).
+
+    :param mentions: EventMention objects (or EntityMention objects)
+    :param other_clusters: should be the current entity clusters if the mentions are event
+        mentions and vice versa.
+    :param is_event: True if the mentions are event mentions and False if they are entity mentions
+    :return: No return. But each_mention.role_signature and role_signature_version are set.
+    """
+    if isinstance(other_clusters, ClusterList):
+        version = other_clusters.version
+        find_cluster_id = other_clusters.find_mention_cluster_id
+    else:
+        version = None
+        mention_to_cluster_id = {mention_id: cluster_id for cluster_id, cluster in enumerate(other_clusters)
+                                 for mention_id in cluster.mentions}
+        find_cluster_id = mention_to_cluster_id.get
+
+    def cluster_id_of(mention_id):
+        cluster_id = find_cluster_id(mention_id)
+        if cluster_id is None:
+            raise ValueError('Can not find mention cluster!')
+        return cluster_id
+
+    for mention in mentions:
+        if version is not None and getattr(mention, 'role_signature_version', None) == version:
+            continue
+        if is_event:
+            signature = tuple((cluster_id_of(getattr(mention, role)[1]),)
+                              if getattr(mention, role) is not None else ()
+                              for role in ['arg0', 'arg1', 'amloc', 'amtmp'])
+        else:
+            roles = ['A0', 'A1', 'AM-LOC', 'AM-TMP']
+            role_cluster_ids = [set(), set(), set(), set()]
+            for predicate_id, rel in mention.predicates.items():
+                if rel in roles:
+                    role_cluster_ids[roles.index(rel)].add(cluster_id_of(predicate_id[1]))
+            signature = tuple(tuple(sorted(cluster_ids)) for cluster_ids in role_cluster_ids)
+        mention.role_signature = signature
+        mention.role_signature_version = version
+
+
+def role_signatures_tensor(mentions: List[Mention], device: torch.cuda.device) -> torch.Tensor:
+    """
+    Stacks the role signatures of mentions (see update_role_signatures()) into one tensor.
+
+    :param mentions: mentions whose role signatures are up to date
+    :param device: Pytorch device
+    :return: a LongTensor of size (n, 4, K), K is the largest number of cluster ids of a role,
+        padded with -1.
+    """
+    max_ids = max([1] + [len(cluster_ids) for mention in mentions for cluster_ids in mention.role_signature])
+    signatures = [[list(cluster_ids) + [-1] * (max_ids - len(cluster_ids)) for cluster_ids in mention.role_signature]
+                  for mention in mentions]
+    return torch.tensor(signatures, dtype=torch.long).view(len(mentions), 4, max_ids).to(device)
+
+
+def role_signatures_coref_bits(signatures: torch.Tensor, rows_1: torch.Tensor,
+                               rows_2: torch.Tensor) -> torch.Tensor:
+    """
+    Computes the four binary features (Arg0/Arg1/location/time) of a batch of mention pairs, the
+    same features as create_args_features_vec() and create_predicates_features_vec() but before they
+    are embedded: a role's feature is 1 if the two mentions have coreferring arguments (or predicates)
+    in this role, found by comparing the pairs' role signatures.
+
+    :param signatures: the mentions' role signatures, see role_signatures_tensor()
+    :param rows_1: the rows of the first mentions, a LongTensor of size (B)
+    :param rows_2: the rows of the second mentions, a LongTensor of size (B)
+    :return: a LongTensor of size (B, 4)
+    """
+    signatures_1 = signatures.index_select(0, rows_1).unsqueeze(3)
+    signatures_2 = signatures.index_select(0, rows_2).unsqueeze(2)
+    # a role is shared if some (non padding) cluster id of the first mention is also in the second one
+    shared = (signatures_1 == signatures_2) & (signatures_1 >= 0)
+    return shared.view(shared.shape[0], 4, -1).max(2)[0].long()
+
+
+def mention_pairs_to_model_input_by_index(mention_tensors: torch.Tensor, rows_1: torch.Tensor,
+                                          rows_2: torch.Tensor, coref_bits: Optional[torch.Tensor],
+                                          model: CDCorefScorer) -> torch.Tensor:
+    """
+    Batched version of mention_pair_to_model_input(): gathers the representations of a batch of
+    mention pairs from a matrix of mention representations, and builds their pair representations
+    v_i,j = (v(m_i); v(m_j); v(m_i)-v(m_j); v(m_i)*v(m_j); f(i,j)) with batched operations.
+
+    :param mention_tensors: mention representations (see create_mention_tensor()), a tensor of size (n, X)
+    :param rows_1: the rows of the first mentions, a LongTensor of size (B)
+    :param rows_2: the rows of the second mentions, a LongTensor of size (B)
+    :param coref_bits: the pairs' binary features (see role_signatures_coref_bits()), a LongTensor of size
+        (B, 4), or None to ablate them.
+    :param model: CDCorefScorer object
+    :return: the mention pair representations - a tensor of size (B, model.input_dim)
+    """
+    tensors_1 = mention_tensors.index_select(0, rows_1)
+    tensors_2 = mention_tensors.index_select(0, rows_2)
+    pair_tensors = [tensors_1, tensors_2]
+    if model.use_diff:
+        pair_tensors.append(tensors_1 - tensors_2)
+    if model.use_mult:
+        pair_tensors.append(tensors_1 * tensors_2)
+    if coref_bits is not None:
+        pair_tensors.append(model.coref_role_embeds(coref_bits).view(coref_bits.shape[0], -1))
+    return torch.cat(pair_tensors, 1)
+
+
+class FrozenMentionRepresentations(object):
+    '''
+    The frozen parts of the mention representations v(m) of a training topic, as one contiguous
+    (n, X) matrix.
+
+    Of v(m) = (c(m); s(m); d(m)) only the char-LSTM vector in s(m) is trained. The context vector
+    c(m) (ELMo), the GloVe vectors in s(m) and the semantically-dependent vectors d(m) do not change
+    during train() (d(m) is updated by update_args_feature_vectors() before it). So they are
+    computed once, and each batch computes only the char vectors of its mentions and puts them
+    between the frozen columns (see PreparedTrainBatch).
+
+    The mentions' role signatures (for the binary features) are stacked once as well, by
+    set_role_signatures(), so the batches are prepared without writing to the mentions.
+    '''
+    def __init__(self, mentions: List[Mention], model: CDCorefScorer, device: torch.cuda.device,
+                 is_event: bool, use_args_feats: bool):
+        '''
+        :param mentions: the mentions to represent (of one type)
+        :param model: CDCorefScorer object (should be in the same type as the mentions)
+        :param device: Pytorch device
+        :param is_event: True if the mentions are event mentions and False if they are entity mentions
+        :param use_args_feats: whether to use the semantically-dependent mention vectors or to ablate them.
+        '''
+        self.mentions = list(mentions)
+        self.mention_to_row = {id(mention): row for row, mention in enumerate(self.mentions)}
+        """Key is id() of a mention (a Mention object) and value is its row in the matrix."""
+        with torch.no_grad():
+            rows = []
+            for mention in self.mentions:
+                context_vec = mention.head_elmo_embeddings.to(device).view(1, -1)
+                if is_event:
+                    words_vec = find_mention_head_embed(mention, model, device)
+                else:
+                    words_embeds = find_mention_words_embeds(mention, model, device)
+                    words_vec = words_embeds.sum(0, keepdim=True)
+                    if words_embeds.shape[0] > 0:
+                        words_vec = words_vec / float(words_embeds.shape[0])
+                row = [context_vec, words_vec]
+                if use_args_feats:
+                    row.extend([mention.arg0_vec.to(device), mention.arg1_vec.to(device),
+                                mention.loc_vec.to(device), mention.time_vec.to(device)])
+                rows.append(torch.cat(row, 1))
+            self.frozen = torch.cat(rows, 0).detach() if rows else None
+            """Row i is v(mentions[i]) without its char vector, a tensor of size (n, X - char_hidden_dim)."""
+        self.char_column = context_vec.shape[1] + model.word_embed_dim if rows else 0
+        """The column of v(m) where the char vector starts (after c(m) and the GloVe part of s(m))."""
+        self.role_signatures = None
+        """Row i is the role signature of mentions[i] (see role_signatures_tensor()), set by set_role_signatures()."""
+
+    def get_rows(self, mentions: List[Mention]) -> List[int]:
+        '''
+        :param mentions: mentions given to the constructor
+        :return: their rows in the matrix
+        '''
+        return [self.mention_to_row[id(mention)] for mention in mentions]
+
+    def set_role_signatures(self, other_clusters: List[Cluster], is_event: bool, device: torch.cuda.device) -> None:
+        '''
+        Updates the mentions' role signatures (see update_role_signatures()) and stacks them into
+        self.role_signatures. Should be called before the batches are prepared (in the calling thread),
+        since it sets attributes of the mentions.
+        :param other_clusters: should be the current entity clusters if the mentions are event
+            mentions and vice versa.
+        :param is_event: True if the mentions are event mentions and False if they are entity mentions
+        :param device: Pytorch device
+        '''
+        update_role_signatures(self.mentions, other_clusters, is_event)
+        self.role_signatures = role_signatures_tensor(self.mentions, device)
+
+    def gather(self, rows: torch.Tensor) -> torch.Tensor:
+        '''
+        :param rows: rows of mentions given to the constructor (see get_rows()), a LongTensor
+        :return: their frozen rows, a tensor of size (len(rows), X - char_hidden_dim)
+        '''
+        return self.frozen.index_select(0, rows)
+
+    def insert_chars_vecs(self, frozen: torch.Tensor, chars_vecs: torch.Tensor) -> torch.Tensor:
+        '''
+        :param frozen: frozen rows, see gather()
+        :param chars_vecs: the char vectors of the same mentions, a tensor of size (len(frozen), char_hidden_dim)
+        :return: the full representations v(m), a tensor of size (len(frozen), X)
+        '''
+        return torch.cat([frozen[:, :self.char_column], chars_vecs, frozen[:, self.char_column:]], 1)
+
+
+def batch_pairs_to_rows(batch_pairs: List[Tuple[Mention, Mention]]) -> Tuple[List[Mention], List[int], List[int]]:
+    """
+    Indexes the distinct mentions of a batch of mention pairs, so their representations can be
+    computed once and gathered by mention_pairs_to_model_input_by_index().
+
+    :param batch_pairs: a list of mention pairs
+    :return: (batch_mentions, rows_1, rows_2) - the distinct mentions of the batch (in order of
+        appearance), and the rows in batch_mentions of the first and the second mention of each pair.
+    """
+    mention_to_row = {}
+    batch_mentions = []
+    rows_1 = []
+    rows_2 = []
+    for mention_1, mention_2 in batch_pairs:
+        for mention, rows in [(mention_1, rows_1), (mention_2, rows_2)]:
+            if id(mention) not in mention_to_row:
+                mention_to_row[id(mention)] = len(batch_mentions)
+                batch_mentions.append(mention)
+            rows.append(mention_to_row[id(mention)])
+    return batch_mentions, rows_1, rows_2
+
+
+def batch_coref_bits(batch_mentions: List[Mention], rows_1: torch.Tensor, rows_2: torch.Tensor,
+                     other_clusters: List[Cluster], is_event: bool, device: torch.cuda.device) -> torch.Tensor:
+    """
+    The binary features of a batch of mention pairs (see role_signatures_coref_bits()), computed from
+    the mentions' role signatures and embedded later by a single model.coref_role_embeds lookup.
+
+    :param batch_mentions: the distinct mentions of the batch, see batch_pairs_to_rows()
+    :param rows_1: the rows in batch_mentions of the first mentions, a LongTensor of size (B)
+    :param rows_2: the rows in batch_mentions of the second mentions, a LongTensor of size (B)
+    :param other_clusters: should be the current event clusters if the mentions are entity mentions
+        and vice versa.
+    :param is_event: True if the mentions are event mentions and False if they are entity mentions
+    :param device: Pytorch device
+    :return: a LongTensor of size (B, 4)
+    """
+    update_role_signatures(batch_mentions, other_clusters, is_event)
+    return role_signatures_coref_bits(role_signatures_tensor(batch_mentions, device), rows_1, rows_2)
+
+
 def train_pairs_batch_to_model_input(batch_pairs, model, device, topic_docs, is_event,
-                                      use_args_feats, use_binary_feats, other_clusters):
+                                      use_args_feats, use_binary_feats, other_clusters,
+                                      frozen_reps=None):
     '''
     Creates input tensors (mention pair representations) to all mention pairs in the batch
     (for training time).
@@ -1315,41 +2163,279 @@ def train_pairs_batch_to_model_input(batch_pairs, model, device, topic_docs, is_
     them.
     :param other_clusters: should be the current event clusters if batch_pairs are entity mention
      pairs and vice versa.
+    :param frozen_reps: optional, a FrozenMentionRepresentations object of the batch's mentions. If
+     given only the char vectors are computed, otherwise the whole span representations.
     :return: batch_pairs_tensor - a tensor of the mention pair representations
     according to the batch size, q_pairs_tensor - a tensor of the pairs' gold labels
     '''
-    tensors_list = []
-    q_list = []
+    if frozen_reps is not None:
+        if use_binary_feats and frozen_reps.role_signatures is None:
+            frozen_reps.set_role_signatures(other_clusters, is_event, device)
+        batch_pairs_tensor, q_pairs_tensor = PreparedTrainBatch(batch_pairs, frozen_reps, device, is_event,
+                                                                use_binary_feats).to_model_input(model, device)
+    else:
+        # 一个指称在batch中可能出现在很多对里，它的表示只算一次 (once per distinct mention),
+        # 再按行号取出每对的两个指称。共享的表示仍在计算图中，梯度会累加回去。
+        batch_mentions, rows_1, rows_2 = batch_pairs_to_rows(batch_pairs)
+        create_mention_span_representations(batch_mentions, model, device, topic_docs, is_event,
+                                            requires_grad=True)
+        mention_tensors = torch.cat([create_mention_tensor(mention, use_args_feats)
+                                     for mention in batch_mentions], 0).to(device)
+
+        # v_i,j = (v(m_i); v(m_j); v(m_i) - v(m_j); v(m_i) * v(m_j); f(i, j))
+        rows_1 = torch.tensor(rows_1, dtype=torch.long).to(device)
+        rows_2 = torch.tensor(rows_2, dtype=torch.long).to(device)
+        coref_bits = None
+        if use_binary_feats:
+            coref_bits = batch_coref_bits(batch_mentions, rows_1, rows_2, other_clusters, is_event, device)
+        batch_pairs_tensor = mention_pairs_to_model_input_by_index(mention_tensors, rows_1, rows_2, coref_bits, model)
+        q_pairs_tensor = batch_pairs_gold_labels(batch_pairs, device)
+
+    if not batch_pairs_tensor.requires_grad:
+        logging.info('mention_pair_tensor does not require grad ! (warning)')
 
-    for pair in batch_pairs:
-        # v_i,j = (v(m_i); v(m_j); v(m_i) * v(m_j); f(i, j))
-        mention_pair_tensor = mention_pair_to_model_input(pair, model, device, topic_docs,
-                                                          is_event, requires_grad=True,
-                                                          use_args_feats=use_args_feats,
-                                                          use_binary_feats=use_binary_feats,
-                                                          other_clusters=other_clusters)
+    return batch_pairs_tensor, q_pairs_tensor
 
-        if not mention_pair_tensor.requires_grad:
-            logging.info('mention_pair_tensor does not require grad ! (warning)')
 
-        tensors_list.append(mention_pair_tensor)
-        q = 1.0 if pair[0].gold_tag == pair[1].gold_tag else 0.0
-        q_tensor = float_to_tensor(q, device)
-        q_list.append(q_tensor)
+def batch_pairs_gold_labels(batch_pairs: List[Tuple[Mention, Mention]], device: torch.cuda.device) -> torch.Tensor:
+    '''
+    :param batch_pairs: a list of mention pairs
+    :param device: Pytorch device
+    :return: a tensor of size (len(batch_pairs), 1), 1.0 for a coreferring pair and 0.0 otherwise
+    '''
+    return torch.tensor([1.0 if mention_1.gold_tag == mention_2.gold_tag else 0.0
+                         for mention_1, mention_2 in batch_pairs]).to(device).view(-1, 1)
 
-    batch_pairs_tensor = torch.cat(tensors_list, 0)
-    q_pairs_tensor = torch.cat(q_list, 0)
 
-    return batch_pairs_tensor, q_pairs_tensor
+class PreparedTrainBatch(object):
+    '''
+    The parts of a training batch's model input that do not depend on the trained parameters: the
+    batch's frozen mention rows (see FrozenMentionRepresentations), the pairs' row indices, their binary
+    features and gold labels. They are built in the constructor, which can run in a worker thread
+    (see PipelinedBatches) since it only reads the mentions and frozen_reps, and to_model_input() adds
+    the trained part, the char vectors.
+    '''
+    def __init__(self, batch_pairs: List[Tuple[Mention, Mention]], frozen_reps: FrozenMentionRepresentations,
+                 device: torch.cuda.device, is_event: bool, use_binary_feats: bool):
+        '''
+        :param batch_pairs: a list of mention pairs (in the size of the batch)
+        :param frozen_reps: a FrozenMentionRepresentations object of the batch's mentions. If use_binary_feats,
+         its role signatures should be set (see FrozenMentionRepresentations.set_role_signatures()).
+        :param device: Pytorch device
+        :param is_event: True if pairs are event mention pairs and False if they are entity mention pairs.
+        :param use_binary_feats: whether to use the binary coreference features or to ablate them.
+        '''
+        batch_mentions, rows_1, rows_2 = batch_pairs_to_rows(batch_pairs)
+        self.frozen_reps = frozen_reps
+        self.char_strings = [get_mention_char_string(mention, is_event) for mention in batch_mentions]
+        self.char_ixs = [get_mention_char_ixs(mention, is_event) for mention in batch_mentions]
+        frozen_rows = torch.tensor(frozen_reps.get_rows(batch_mentions), dtype=torch.long).to(device)
+        self.frozen = frozen_reps.gather(frozen_rows)
+        self.rows_1 = torch.tensor(rows_1, dtype=torch.long).to(device)
+        self.rows_2 = torch.tensor(rows_2, dtype=torch.long).to(device)
+        self.coref_bits = None
+        if use_binary_feats:
+            self.coref_bits = role_signatures_coref_bits(frozen_reps.role_signatures,
+                                                         frozen_rows.index_select(0, self.rows_1),
+                                                         frozen_rows.index_select(0, self.rows_2))
+        self.q_pairs_tensor = batch_pairs_gold_labels(batch_pairs, device)
+
+    def to_model_input(self, model: CDCorefScorer, device: torch.cuda.device) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        Computes the batch's char vectors (with gradients) and builds the model input.
+        :param model: CDCorefScorer object (should be in the same type as the batch pairs)
+        :param device: Pytorch device
+        :return: batch_pairs_tensor - a tensor of the mention pair representations, q_pairs_tensor - a
+         tensor of the pairs' gold labels (see train_pairs_batch_to_model_input())
+        '''
+        chars_vecs = get_char_embeds_batch(self.char_strings, model, device, self.char_ixs)
+        mention_tensors = self.frozen_reps.insert_chars_vecs(self.frozen, chars_vecs)
+        # v_i,j = (v(m_i); v(m_j); v(m_i) - v(m_j); v(m_i) * v(m_j); f(i, j))
+        batch_pairs_tensor = mention_pairs_to_model_input_by_index(mention_tensors, self.rows_1, self.rows_2,
+                                                                   self.coref_bits, model)
+        return batch_pairs_tensor, self.q_pairs_tensor
+
+
+class PipelinedBatches(object):
+    '''
+    Iterates over the results of prepare(item) of a list of items (in order), while *workers* threads
+    prepare up to *queue_size* next items in the background. With workers = 0, the items are prepared
+    one by one in the calling thread.
+
+    It counts the time spent on preparing the items (by the workers) and the time the calling thread waited
+    for them, to show how much of the preparation overlapped with the consumer's work (see summary()).
+    '''
+    def __init__(self, items: list, prepare, workers: int, queue_size: int):
+        '''
+        :param items: the items to prepare
+        :param prepare: a function, item -> prepared item
+        :param workers: the number of worker threads (0 to prepare in the calling thread)
+        :param queue_size: the maximal number of items prepared in advance
+        '''
+        self.items = items
+        self.prepare = prepare
+        self.workers = workers
+        self.queue_size = max(queue_size, 1)
+        self.prepared_count = 0
+        self.prepare_time = 0.0
+        """The total time (in seconds) spent in prepare()."""
+        self.wait_time = 0.0
+        """The total time (in seconds) the calling thread waited for prepared items."""
+        self.total_time = 0.0
+        """The time (in seconds) from the start to the end of the iteration."""
+
+    def _timed_prepare(self, item):
+        start = time.time()
+        prepared = self.prepare(item)
+        return prepared, time.time() - start
+
+    def __iter__(self):
+        start = time.time()
+        if self.workers <= 0:
+            for item in self.items:
+                prepared, prepare_time = self._timed_prepare(item)
+                self._count(prepare_time, prepare_time)
+                yield prepared
+        else:
+            items = iter(self.items)
+            pending = collections.deque()
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+                # 有界队列: 最多提前准备 queue_size 个
+                for item in itertools.islice(items, self.queue_size):
+                    pending.append(executor.submit(self._timed_prepare, item))
+                while pending:
+                    wait_start = time.time()
+                    prepared, prepare_time = pending.popleft().result()
+                    self._count(prepare_time, time.time() - wait_start)
+                    for item in itertools.islice(items, 1):
+                        pending.append(executor.submit(self._timed_prepare, item))
+                    yield prepared
+        self.total_time += time.time() - start
+
+    def _count(self, prepare_time, wait_time):
+        self.prepared_count += 1
+        self.prepare_time += prepare_time
+        self.wait_time += wait_time
+
+    def summary(self) -> str:
+        '''
+        :return: a string with the throughput counters
+        '''
+        overlap = 1.0 - self.wait_time / self.prepare_time if self.prepare_time > 0 else 0.0
+        return '{} batches in {:.2f}s ({:.1f} batches/s): {:.2f}s of batch preparation ({} workers), ' \
+               'waited {:.2f}s for batches ({:.0f}% of the preparation overlapped)'.format(
+                self.prepared_count, self.total_time,
+                self.prepared_count / self.total_time if self.total_time > 0 else 0.0,
+                self.prepare_time, self.workers, self.wait_time, 100. * max(overlap, 0.0))
+
+
+class MentionPairReservoir(object):
+    '''
+    A uniform random sample of at most *budget* mention pairs of a stream of cluster pairs, kept in
+    bounded memory (reservoir sampling, "Algorithm L" of Li 1994).
+
+    The mention pairs of a cluster pair are not generated one by one: the sampler skips over them
+    by their count (|c1|*|c2|), and only the sampled pairs are taken from the clusters. So adding a
+    cluster pair costs O(1) plus O(1) per sampled pair of it, however big the clusters are.
+    If the stream has at most *budget* mention pairs, all of them are kept.
+    '''
+    def __init__(self, budget: int):
+        '''
+        :param budget: the maximal number of mention pairs to keep
+        '''
+        self.budget = budget
+        self.pairs: List[Tuple[Mention, Mention]] = []
+        """The sampled mention pairs."""
+        self.seen_count = 0
+        """The number of mention pairs in the stream so far."""
+        self.weight = 1.0
+        self.next_index = None
+        """The index (in the stream) of the next mention pair to put in the reservoir, once it is full."""
+
+    @staticmethod
+    def _uniform():
+        # a uniform number in (0, 1)
+        u = random.random()
+        while u == 0.0:
+            u = random.random()
+        return u
+
+    def _skip(self):
+        # the gap to the next replaced pair is geometric, see Li 1994
+        self.weight *= math.exp(math.log(self._uniform()) / self.budget)
+        gap = 0
+        if self.weight < 1.0:
+            gap = int(math.floor(math.log(self._uniform()) / math.log1p(-self.weight)))
+        self.next_index += gap + 1
+
+    def add_cluster_pair(self, cluster_1: Cluster, cluster_2: Cluster) -> None:
+        '''
+        Adds the mention pairs between two clusters (see cluster_pair_to_mention_pair()) to the stream.
+        :param cluster_1: first cluster
+        :param cluster_2: second cluster
+        '''
+        pairs_count = len(cluster_1.mentions) * len(cluster_2.mentions)
+        if pairs_count == 0 or self.budget <= 0:
+            self.seen_count += pairs_count
+            return
+        mentions_1 = None
+        mentions_2 = None
+        first_index = self.seen_count
+        index = first_index
+        end_index = first_index + pairs_count
+        while index < end_index:
+            if len(self.pairs) < self.budget:
+                pair_index = index
+            elif self.next_index < end_index:
+                pair_index = self.next_index
+            else:
+                break
+            if mentions_1 is None:
+                mentions_1 = list(cluster_1.mentions.values())
+                mentions_2 = list(cluster_2.mentions.values())
+            row, column = divmod(pair_index - first_index, len(mentions_2))
+            pair = (mentions_1[row], mentions_2[column])
+            if len(self.pairs) < self.budget:
+                self.pairs.append(pair)
+                if len(self.pairs) == self.budget:
+                    self.next_index = pair_index
+                    self._skip()
+            else:
+                self.pairs[random.randrange(self.budget)] = pair
+                self._skip()
+            index = pair_index + 1
+        self.seen_count = end_index
+
+    def add_cluster_pairs(self, cluster_pairs: Iterable[tuple]) -> 'MentionPairReservoir':
+        '''
+        :param cluster_pairs: cluster pairs (tuples whose first two items are Cluster objects), e.g.
+         a generator of iterate_train_cluster_pairs()
+        :return: self
+        '''
+        for cluster_pair in cluster_pairs:
+            self.add_cluster_pair(cluster_pair[0], cluster_pair[1])
+        return self
+
+    def iterate_batches(self, batch_size: int) -> Iterator[List[Tuple[Mention, Mention]]]:
+        '''
+        Shuffles the sampled pairs and yields them in batches (only full batches, as in train()).
+        :param batch_size: the number of mention pairs in a batch
+        :return: a generator of lists of mention pairs
+        '''
+        random.shuffle(self.pairs)
+        for i in range(0, len(self.pairs), batch_size):
+            if i + batch_size < len(self.pairs):
+                yield self.pairs[i:i + batch_size]
 
 
 def train(cluster_pairs, model, optimizer, loss_function, device, topic_docs, epoch,
           topics_counter, topics_num, config_dict, is_event, other_clusters):
     '''
     Trains a model using a given set of cluster pairs, a specific optimizer and a loss function.
-    The model is trained on all mention pairs between each cluster pair.
+    The model is trained on all mention pairs between each cluster pair, or on a uniform sample of
+    config_dict["train_pairs_budget"] of them if there are more (see MentionPairReservoir).
 
-    :param cluster_pairs: list of clusters pairs
+    :param cluster_pairs: clusters pairs, a list or a generator (it is consumed once)
     :param model: CDCorefModel object
     :param optimizer: Pytorch optimizer
     :param loss_function: Pytorch loss function
@@ -1367,25 +2453,40 @@ def train(cluster_pairs, model, optimizer, loss_function, device, topic_docs, ep
     mode = 'Event' if is_event else 'Entity'
     retain_graph = False
     epochs = config_dict["regressor_epochs"]
-    random.shuffle(cluster_pairs)
 
-    # creates mention pairs and their true labels (creates max 100,000 mention pairs - due to memory constrains)
-    pairs = cluster_pairs_to_mention_pairs(cluster_pairs)
-    random.shuffle(pairs)
+    # samples up to train_pairs_budget mention pairs (due to memory constrains), uniformly from all the cluster pairs
+    reservoir = MentionPairReservoir(config_dict.get("train_pairs_budget", 100000)).add_cluster_pairs(cluster_pairs)
+    pairs = reservoir.pairs
+    if reservoir.seen_count > len(pairs):
+        logging.info('Sampled {} of {} mention pairs for training'.format(len(pairs), reservoir.seen_count))
+
+    # 指称表示中不训练的部分 (ELMo, GloVe, d(m)) 整个topic只算一次
+    pairs_mentions = list({id(mention): mention for pair in pairs for mention in pair}.values())
+    frozen_reps = FrozenMentionRepresentations(pairs_mentions, model, device, is_event,
+                                               config_dict["use_args_feats"])
+    use_binary_feats = config_dict["use_binary_feats"]
+    if use_binary_feats:
+        # the clusters do not change during train(), so the signatures are computed once, here in the
+        # main thread, and the workers only read frozen_reps.role_signatures
+        frozen_reps.set_role_signatures(other_clusters, is_event, device)
+
+    # 流水线: worker线程准备后面的batch (PreparedTrainBatch), 主线程做前向/反向传播
+    def prepare(batch_pairs):
+        return PreparedTrainBatch(batch_pairs, frozen_reps, device, is_event, use_binary_feats)
+    workers = config_dict.get("train_prepare_workers", 0)
+    queue_size = config_dict.get("train_prepare_queue_size", 2 * workers)
 
     for reg_epoch in range(0, epochs):
         samples_count = 0
         batches_count = 0
         total_loss = 0
-        batches = [pairs[i:i + batch_size] for i in range(0, len(pairs), batch_size) if i + batch_size < len(pairs)]
-        for batch_pairs in batches:
+        batches = PipelinedBatches(list(reservoir.iterate_batches(batch_size)), prepare, workers, queue_size)
+        for prepared_batch in batches:
             samples_count += batch_size
             batches_count += 1
-            batch_tensor, q_tensor = train_pairs_batch_to_model_input(batch_pairs, model,
-                                                                      device, topic_docs, is_event,
-                                                                      config_dict["use_args_feats"],
-                                                                      config_dict["use_binary_feats"],
-                                                                      other_clusters)
+            batch_tensor, q_tensor = prepared_batch.to_model_input(model, device)
+            if not batch_tensor.requires_grad:
+                logging.info('mention_pair_tensor does not require grad ! (warning)')
 
             model.zero_grad()
             output = model(batch_tensor)
@@ -1400,7 +2501,8 @@ def train(cluster_pairs, model, optimizer, loss_function, device, topic_docs, ep
                     100. * samples_count / len(pairs), (total_loss/float(batches_count)))
                 )
 
-            del batch_tensor, q_tensor
+            del batch_tensor, q_tensor, prepared_batch
+        logging.info('{} model training throughput: {}'.format(mode, batches.summary()))
 
 
 def cluster_pair_to_mention_pair(pair):
@@ -1423,26 +2525,6 @@ def cluster_pair_to_mention_pair(pair):
     return mention_pairs
 
 
-def cluster_pairs_to_mention_pairs(cluster_pairs):
-    '''
-    Generates all mention pairs between all cluster pairs
-
-    :param cluster_pairs: cluster pairs (tuples of two Cluster objects)
-    :return: a list contains tuples of Mention object pairs (EventMention/EntityMention)
-    '''
-    th = 100000
-    mention_pairs = []
-
-    for pair in cluster_pairs:
-
-        mention_pairs.extend(cluster_pair_to_mention_pair(pair))
-
-        if len(mention_pairs) > th: # up to 100,000 pairs (due to memory constrains)
-            break
-
-    return mention_pairs
-
-
 def test_pairs_batch_to_model_input(batch_pairs, model, device, topic_docs, is_event,
                                      use_args_feats, use_binary_feats, other_clusters):
 
@@ -1466,16 +2548,16 @@ def test_pairs_batch_to_model_input(batch_pairs, model, device, topic_docs, is_e
     according to the batch size, q_pairs_tensor - a tensor of the pairs' gold labels
 
     '''
-    tensors_list = []
-    for pair in batch_pairs:
-        mention_pair_tensor = mention_pair_to_model_input(pair, model, device, topic_docs,
-                                                          is_event, requires_grad=False,
-                                                          use_args_feats=use_args_feats,
-                                                          use_binary_feats=use_binary_feats,
-                                                          other_clusters=other_clusters)
-        tensors_list.append(mention_pair_tensor)
-
-    batch_pairs_tensor = torch.cat(tensors_list, 0)
+    # 按行号从指称矩阵中取出每对的两个指称 (the span_rep of the mentions is already set)
+    batch_mentions, rows_1, rows_2 = batch_pairs_to_rows(batch_pairs)
+    mention_tensors = torch.cat([create_mention_tensor(mention, use_args_feats)
+                                 for mention in batch_mentions], 0).to(device)
+    rows_1 = torch.tensor(rows_1, dtype=torch.long).to(device)
+    rows_2 = torch.tensor(rows_2, dtype=torch.long).to(device)
+    coref_bits = None
+    if use_binary_feats:
+        coref_bits = batch_coref_bits(batch_mentions, rows_1, rows_2, other_clusters, is_event, device)
+    batch_pairs_tensor = mention_pairs_to_model_input_by_index(mention_tensors, rows_1, rows_2, coref_bits, model)
 
     return batch_pairs_tensor
 
@@ -1496,46 +2578,289 @@ def get_batches(mention_pairs, batch_size):
 
     return batches
 
-def key_with_max_val(d):
-    """ a) creates a list of the dict's keys and values;
-        b) returns the key with the max value and the max value"""
-    v = list(d.values()) #scores
-    k = list(d.keys()) #pairs
+class CandidatePairsQueue(object):
+    '''
+    A priority queue of candidate cluster pairs and their scores, used by the agglomerative
+    merge loop.
+
+    Pairs are kept in a max-heap. Pairs that touch a merged (dead) cluster are not removed from
+    the heap, they are invalidated lazily: *retire()* only marks the cluster as dead, and
+    *pop_max()* skips heap entries of dead clusters. Picking the best pair and retiring a cluster
+    therefore cost logarithmic time instead of a scan over all the candidate pairs.
+    '''
+    def __init__(self):
+        self.heap = []
+        """Heap entries - (-score, insertion number, cluster_1, cluster_2)."""
+        self.partners = {}
+        """
+        Key is a live Cluster object.
+        Value is a Counter of the clusters it currently forms live candidate pairs with.
+        """
+        self.pairs_count = 0
+        """Number of live candidate pairs."""
+        self.pushed_count = 0
+        """Number of pushed pairs, breaks score ties by insertion order."""
+
+    def __len__(self):
+        return self.pairs_count
+
+    def push(self, pair: Tuple[Cluster, Cluster], score: float) -> None:
+        '''
+        Adds a candidate cluster pair
+        :param pair: a tuple of two Cluster objects
+        :param score: the pair's score
+        '''
+        cluster_1, cluster_2 = pair
+        heapq.heappush(self.heap, (-score, self.pushed_count, cluster_1, cluster_2))
+        self.pushed_count += 1
+        self.partners.setdefault(cluster_1, collections.Counter())[cluster_2] += 1
+        self.partners.setdefault(cluster_2, collections.Counter())[cluster_1] += 1
+        self.pairs_count += 1
+
+    def retire(self, cluster: Cluster) -> None:
+        '''
+        Marks a cluster as dead (e.g. after it was merged), all of its candidate pairs become stale.
+        :param cluster: a Cluster object
+        '''
+        for other, count in self.partners.pop(cluster, {}).items():
+            del self.partners[other][cluster]
+            self.pairs_count -= count
 
-    np_scores = np.asarray(v)
-    best_ix = np.argmax(np_scores)
-    best_score = np_scores[best_ix]
+    def is_live(self, cluster_1: Cluster, cluster_2: Cluster) -> bool:
+        '''
+        Checks whether a pair of clusters is still a live candidate pair
+        :param cluster_1: first cluster
+        :param cluster_2: second cluster
+        :return: True if both clusters are alive, and False otherwise.
+        '''
+        return cluster_1 in self.partners and cluster_2 in self.partners
 
-    return k[v.index(best_score)], best_score
+    def pop_max(self) -> Tuple[Optional[Tuple[Cluster, Cluster]], Optional[float]]:
+        '''
+        Removes and returns the live candidate pair with the highest score (the earliest pushed
+        pair among equal scores), stale entries met on the way are discarded.
+        :return: (pair, score), or (None, None) if there is no live pair.
+        '''
+        while self.heap:
+            neg_score, _, cluster_1, cluster_2 = heapq.heappop(self.heap)
+            if self.is_live(cluster_1, cluster_2):
+                self.partners[cluster_1][cluster_2] -= 1
+                self.partners[cluster_2][cluster_1] -= 1
+                self.pairs_count -= 1
+                return (cluster_1, cluster_2), -neg_score
+        return None, None
+
+    def pop_mutual_best(self, threshold: float) -> List[Tuple[Tuple[Cluster, Cluster], float]]:
+        '''
+        Removes and returns all the live candidate pairs with a score above *threshold* whose two
+        clusters are each other's best partner. These pairs do not share clusters, so they can all
+        be merged in one round.
+
+        Entries are popped in descending score order, so the first pair a cluster appears in is its
+        best pair, and a pair is mutually best iff it is the first pair of both of its clusters. The
+        other live entries popped on the way are pushed back.
+        :param threshold: merging threshold
+        :return: a list of (pair, score), in descending score order.
+        '''
+        mutual_best_pairs = []
+        popped_entries = []
+        seen_clusters = set()
+        while self.heap and -self.heap[0][0] > threshold and len(seen_clusters) < len(self.partners):
+            entry = heapq.heappop(self.heap)
+            neg_score, _, cluster_1, cluster_2 = entry
+            if not self.is_live(cluster_1, cluster_2):
+                continue
+            if cluster_1 not in seen_clusters and cluster_2 not in seen_clusters:
+                self.partners[cluster_1][cluster_2] -= 1
+                self.partners[cluster_2][cluster_1] -= 1
+                self.pairs_count -= 1
+                mutual_best_pairs.append(((cluster_1, cluster_2), -neg_score))
+            else:
+                popped_entries.append(entry)
+            seen_clusters.add(cluster_1)
+            seen_clusters.add(cluster_2)
+        for entry in popped_entries:
+            heapq.heappush(self.heap, entry)
+        return mutual_best_pairs
 
 
-def merge_clusters(pair_to_merge: Tuple[Cluster, Cluster],
-                   clusters: List[Cluster], other_clusters: List[Cluster],
-                   is_event, model, device, topic_docs: Dict[str, Document],
-                   candidate_pairs: Dict[Tuple[Cluster, Cluster], float],
-                   use_args_feats, use_binary_feats) -> None:
+class MentionPairScoreMatrix(object):
+    '''
+    A dense (n x n) matrix of the model's scores for all the ordered mention pairs of a topic
+    (of one type - event mentions or entity mentions).
+
+    All the mention pairs are scored together in large fixed-size batches, instead of a few small
+    batches per cluster pair (as in assign_score()). The score sum of a cluster pair is then read
+    from the matrix, by summing the rows of its first cluster and the columns of its second one.
+    The pairs are scored by the factorized inference path of the model
+    (CDCorefScorer.score_mention_pairs()), which gives the same scores as forward().
+
+    The scores are valid as long as the mention representations, the model and the other type's
+    clusters do not change, e.g. during merge(). Between the joint iterations of test_models() only
+    the other type's clusters change, and update() rescores only the pairs of the mentions whose
+    arguments/predicates moved to another cluster (the other pairs' inputs did not change).
+    '''
+    def __init__(self, mentions: List[Mention], batch_size: int = 1024):
+        '''
+        :param mentions: the topic's mentions (of one type)
+        :param batch_size: the number of mention pairs scored by one forward pass
+        '''
+        self.mentions = list(mentions)
+        self.mention_to_row = {mention.mention_id: row for row, mention in enumerate(self.mentions)}
+        """Key is a mention id and value is its row (and column) in the matrix."""
+        self.batch_size = batch_size
+        self.scores: torch.Tensor = None
+        """The scores matrix, scores[i, j] is the score of the pair (mentions[i], mentions[j])."""
+        self.signatures: List[tuple] = None
+        """
+        signatures[i] holds the other type's clusters of the arguments/predicates of mentions[i]
+        when its scores were computed (see mention_args_signature()).
+        """
+
+    def score_all(self, model: CDCorefScorer, device: torch.cuda.device, is_event: bool,
+                  use_args_feats: bool, use_binary_feats: bool, other_clusters: List[Cluster]) -> None:
+        '''
+        Scores all the mention pairs by the model.
+        :param model: CDCorefScorer object (should be in the same type as the mentions)
+        :param device: Pytorch device
+        :param is_event: True if the mentions are event mentions and False if they are entity mentions
+        :param use_args_feats: whether to use the semantically-dependent mention vectors or to ablate them.
+        :param use_binary_feats: whether to use the binary coreference features or to ablate them.
+        :param other_clusters: should be the current event clusters if the mentions are entity mentions
+         and vice versa.
+        '''
+        mentions_num = len(self.mentions)
+        self.scores = torch.zeros(mentions_num, mentions_num)
+        self.signatures = self.args_signatures(is_event, other_clusters)
+        all_rows = list(range(mentions_num))
+        self.score_block(all_rows, all_rows, model, device, is_event, use_args_feats, use_binary_feats,
+                         other_clusters)
+
+    def update(self, model: CDCorefScorer, device: torch.cuda.device, is_event: bool,
+               use_args_feats: bool, use_binary_feats: bool, other_clusters: List[Cluster]) -> int:
+        '''
+        Brings the scores up to date after the other type's clusters were changed (merged), with the
+        same model and mention span representations: only the rows and the columns of the mentions
+        whose arguments/predicates are now in a different cluster are rescored. Scores all the pairs
+        if the matrix was not scored yet.
+        The parameters are the same as in score_all().
+        :return: the number of rescored mentions (rows)
+        '''
+        if self.scores is None:
+            self.score_all(model, device, is_event, use_args_feats, use_binary_feats, other_clusters)
+            return len(self.mentions)
+        signatures = self.args_signatures(is_event, other_clusters)
+        dirty_rows = [row for row in range(len(self.mentions)) if signatures[row] != self.signatures[row]]
+        self.signatures = signatures
+        logging.info('Rescoring the pairs of {}/{} mentions'.format(len(dirty_rows), len(self.mentions)))
+        if dirty_rows:
+            dirty_set = set(dirty_rows)
+            clean_rows = [row for row in range(len(self.mentions)) if row not in dirty_set]
+            all_rows = list(range(len(self.mentions)))
+            self.score_block(dirty_rows, all_rows, model, device, is_event, use_args_feats, use_binary_feats,
+                             other_clusters)
+            self.score_block(clean_rows, dirty_rows, model, device, is_event, use_args_feats, use_binary_feats,
+                             other_clusters)
+        return len(dirty_rows)
+
+    def args_signatures(self, is_event: bool, other_clusters: List[Cluster]) -> List[tuple]:
+        '''
+        :param is_event: True if the mentions are event mentions and False if they are entity mentions
+        :param other_clusters: the other type's current clusters
+        :return: the signature of each mention, see mention_args_signature()
+        '''
+        mention_to_other_cluster = map_mentions_to_clusters(other_clusters)
+        return [mention_args_signature(mention, mention_to_other_cluster, is_event) for mention in self.mentions]
+
+    def score_block(self, rows: List[int], columns: List[int], model: CDCorefScorer, device: torch.cuda.device,
+                    is_event: bool, use_args_feats: bool, use_binary_feats: bool,
+                    other_clusters: List[Cluster]) -> None:
+        '''
+        Scores the mention pairs (mentions[i], mentions[j]) for all i in *rows* and j in *columns*, and
+        writes them to the matrix.
+        The other parameters are the same as in score_all().
+        '''
+        if not rows or not columns:
+            return
+        mention_tensors = torch.cat([create_mention_tensor(mention, use_args_feats)
+                                     for mention in self.mentions], 0).to(device)
+        signatures = None
+        if use_binary_feats:
+            update_role_signatures(self.mentions, other_clusters, is_event)
+            signatures = role_signatures_tensor(self.mentions, device)
+        # the linear part of the first layer is computed once per mention (see model.score_mention_pairs())
+        with torch.no_grad():
+            projections = model.project_mentions(mention_tensors, use_binary_feats)
+        # each batch is a block of whole rows: ~batch_size pairs (at least one row)
+        rows_per_batch = max(1, self.batch_size // len(columns))
+        columns_tensor = torch.tensor(columns, dtype=torch.long)
+        for start in range(0, len(rows), rows_per_batch):
+            batch_rows = torch.tensor(rows[start:start + rows_per_batch], dtype=torch.long)
+            rows_1 = batch_rows.view(-1, 1).expand(-1, len(columns)).contiguous().view(-1)
+            rows_2 = columns_tensor.repeat(len(batch_rows))
+            coref_bits = None
+            if use_binary_feats:
+                coref_bits = role_signatures_coref_bits(signatures, rows_1.to(device), rows_2.to(device))
+            with torch.no_grad():
+                model_scores = model.score_mention_pairs(mention_tensors, rows_1.to(device), rows_2.to(device),
+                                                         coref_bits, projections)
+            model_scores = model_scores.cpu().view(len(batch_rows), len(columns))
+            self.scores[batch_rows.view(-1, 1), columns_tensor.view(1, -1)] = model_scores
+
+    def cluster_rows(self, cluster: Cluster) -> torch.Tensor:
+        '''
+        :param cluster: a Cluster object
+        :return: the rows of the cluster's mentions, a LongTensor
+        '''
+        return torch.tensor([self.mention_to_row[mention_id] for mention_id in cluster.mentions],
+                            dtype=torch.long)
+
+    def pair_score_sum(self, cluster_1: Cluster, cluster_2: Cluster) -> float:
+        '''
+        :param cluster_1: first cluster
+        :param cluster_2: second cluster
+        :return: the sum of the scores of all the mention pairs (m1, m2), m1 in cluster_1 and
+         m2 in cluster_2
+        '''
+        block = self.scores.index_select(0, self.cluster_rows(cluster_1))
+        block = block.index_select(1, self.cluster_rows(cluster_2))
+        return float(block.double().sum())
+
+    def clusters_score_sums(self, clusters: List[Cluster]) -> torch.Tensor:
+        '''
+        Computes the score sums of all the cluster pairs at once (segment sums over the rows and
+        then over the columns of the matrix).
+        :param clusters: a list of Cluster objects, they should cover all the matrix's mentions.
+        :return: a (k x k) double tensor, element [a, b] is the score sum of the cluster pair
+         (clusters[a], clusters[b])
+        '''
+        segments = torch.zeros(len(self.mentions), dtype=torch.long)
+        for cluster_ix, cluster in enumerate(clusters):
+            segments[self.cluster_rows(cluster)] = cluster_ix
+        scores = self.scores.double()
+        rows_sums = torch.zeros(len(clusters), len(self.mentions), dtype=torch.double)
+        rows_sums.index_add_(0, segments, scores)
+        sums = torch.zeros(len(clusters), len(clusters), dtype=torch.double)
+        sums.index_add_(1, segments, rows_sums)
+        return sums
+
+
+def create_merged_cluster(pair_to_merge: Tuple[Cluster, Cluster],
+                          clusters: List[Cluster], other_clusters: List[Cluster],
+                          is_event, model, device, candidate_pairs: CandidatePairsQueue) -> Cluster:
     """
-    This function:
-        - 基于 *pair_to_merge* 中的两个旧簇, 进行合并, 创建新簇, 并计算新簇的mentions, lex_vec,
-          arg0_vec, arg1_vec, time_vec, loc_vec.
-        - 更新当前簇*clusters*：
-          1. 删除旧簇
-          2. 添加新簇
-        - 更新候选簇对*candidate_pairs*:
-          1. 删除旧簇对(所有涉及旧簇的簇对);
-          2. 添加新簇对(新簇和当前每个簇各组成一个新簇对).
+    Merges the two clusters of *pair_to_merge* into a new cluster (its mentions, lex_vec and
+    arguments vectors), replaces them by it in *clusters* and retires them in *candidate_pairs*.
+    The new cluster's candidate pairs are not scored here (see merge_clusters()).
 
     :param pair_to_merge: a tuple of two Cluster objects that were chosen to get merged.
-    :param clusters: 所有此类簇。current event/entity clusters (of the same type of pair_to_merge)
-    :param other_clusters: 所有它类簇。should be the current event clusters if clusters are entity clusters and vice versa.
+    :param clusters: current event/entity clusters (of the same type of pair_to_merge)
+    :param other_clusters: should be the current event clusters if clusters are entity clusters and vice versa.
     :param is_event: True if pair_to_merge is an event pair  and False if they it's an entity pair.
     :param model: CDCorefModel object
     :param device: Pytorch device object
-    :param topic_docs: current topic's documents
-    :param candidate_pairs: 所有候选簇对及其得分。dictionary contains the current candidate cluster pairs
-    :param use_args_feats: whether to use the semantically-dependent mention vectors or to ablate them.
-    :param use_binary_feats: whether to use the binary coreference features or to ablate them.
-    :return: No return. *clusters* updated, *candidate_pairs* updated.
+    :param candidate_pairs: a CandidatePairsQueue contains the current candidate cluster pairs
+    :return: the new cluster
     """
     cluster_i = pair_to_merge[0]
     cluster_j = pair_to_merge[1]
@@ -1546,22 +2871,27 @@ def merge_clusters(pair_to_merge: Tuple[Cluster, Cluster],
     # 新簇的指称
     new_cluster.mentions.update(cluster_j.mentions)
     new_cluster.mentions.update(cluster_i.mentions)
+    if len(new_cluster.mentions) == len(cluster_i.mentions) + len(cluster_j.mentions):
+        new_cluster.set_gold_tag_counts(cluster_j.get_gold_tag_counts() + cluster_i.get_gold_tag_counts())
 
-    # 候选簇对:删除旧簇对
-    keys_pairs_dict: List[Tuple[Cluster, Cluster]] = list(candidate_pairs.keys())
-    for pair in keys_pairs_dict:
-        cluster_pair = (pair[0], pair[1])
-        if cluster_i in cluster_pair or cluster_j in cluster_pair:
-            del candidate_pairs[pair]
-
-    # 本类簇列表:删除旧簇
-    clusters.remove(cluster_i)
-    clusters.remove(cluster_j)
-    # 本类簇列表:添加新簇
-    clusters.append(new_cluster)
+    # 候选簇对:删除旧簇对 (lazily, stale pairs are skipped by candidate_pairs.pop_max())
+    candidate_pairs.retire(cluster_i)
+    candidate_pairs.retire(cluster_j)
 
-    # 新簇的向量
-    if is_event:
+    # 本类簇列表:删除旧簇, 添加新簇 (a ClusterList unions its mention sets instead of re-indexing)
+    if isinstance(clusters, ClusterList):
+        clusters.merge(cluster_i, cluster_j, new_cluster)
+    else:
+        clusters.remove(cluster_i)
+        clusters.remove(cluster_j)
+        clusters.append(new_cluster)
+
+    # 新簇的向量: 两个旧簇的指称向量之和相加 (running sums, see update_lexical_vectors())
+    if getattr(cluster_i, 'lex_vec_sum', None) is not None and getattr(cluster_j, 'lex_vec_sum', None) is not None:
+        new_cluster.lex_vec_sum = cluster_j.lex_vec_sum + cluster_i.lex_vec_sum
+        new_cluster.lex_vec_count = cluster_j.lex_vec_count + cluster_i.lex_vec_count
+        lex_vec = new_cluster.lex_vec_sum / new_cluster.lex_vec_count
+    elif is_event:
         lex_vec = create_event_cluster_bow_lexical_vec(new_cluster, model, device,
                                                        use_char_embeds=True,
                                                        requires_grad=False)
@@ -1574,20 +2904,179 @@ def merge_clusters(pair_to_merge: Tuple[Cluster, Cluster],
     # 新簇的语义依存向量 create arguments features for the new cluster
     update_args_feature_vectors([new_cluster], other_clusters, model, device, is_event)
 
+    return new_cluster
+
+
+def merge_clusters(pair_to_merge: Tuple[Cluster, Cluster],
+                   clusters: List[Cluster], other_clusters: List[Cluster],
+                   is_event, model, device, topic_docs: Dict[str, Document],
+                   candidate_pairs: CandidatePairsQueue,
+                   use_args_feats, use_binary_feats,
+                   linkage_sums: Optional[Dict[Cluster, Dict[Cluster, float]]] = None,
+                   pair_score_matrix: Optional[MentionPairScoreMatrix] = None) -> None:
+    """
+    This function:
+        - 基于 *pair_to_merge* 中的两个旧簇, 进行合并, 创建新簇, 并计算新簇的mentions, lex_vec,
+          arg0_vec, arg1_vec, time_vec, loc_vec.
+        - 更新当前簇*clusters*：
+          1. 删除旧簇
+          2. 添加新簇
+        - 更新候选簇对*candidate_pairs*:
+          1. 删除旧簇对(所有涉及旧簇的簇对);
+          2. 添加新簇对(新簇和当前每个簇各组成一个新簇对).
+
+    :param pair_to_merge: a tuple of two Cluster objects that were chosen to get merged.
+    :param clusters: 所有此类簇。current event/entity clusters (of the same type of pair_to_merge)
+    :param other_clusters: 所有它类簇。should be the current event clusters if clusters are entity clusters and vice versa.
+    :param is_event: True if pair_to_merge is an event pair  and False if they it's an entity pair.
+    :param model: CDCorefModel object
+    :param device: Pytorch device object
+    :param topic_docs: current topic's documents
+    :param candidate_pairs: 所有候选簇对及其得分。a CandidatePairsQueue contains the current candidate cluster pairs
+    :param use_args_feats: whether to use the semantically-dependent mention vectors or to ablate them.
+    :param use_binary_feats: whether to use the binary coreference features or to ablate them.
+    :param linkage_sums: if given, the scores of the new pairs are computed incrementally from
+        this dict instead of running the model (see merge()). linkage_sums[c1][c2] is the sum of
+        the mention-pair scores of all (m1, m2) pairs, m1 in c1 and m2 in c2. It is updated here.
+    :param pair_score_matrix: a MentionPairScoreMatrix to read the mention-pair scores from, or None
+        to run the model.
+    :return: No return. *clusters* updated, *candidate_pairs* updated.
+    """
+    cluster_i = pair_to_merge[0]
+    cluster_j = pair_to_merge[1]
+    new_cluster = create_merged_cluster(pair_to_merge, clusters, other_clusters, is_event, model, device,
+                                        candidate_pairs)
+
     # 候选簇对：添加新簇对
     new_pairs = []
     for cluster in clusters:
         if cluster != new_cluster:
             new_pairs.append((cluster, new_cluster))
     # create scores for the new pairs
+    if linkage_sums is None:
+        for pair in new_pairs:
+            pair_score = assign_score(pair, model, device, topic_docs, is_event,
+                                      use_args_feats, use_binary_feats, other_clusters,
+                                      pair_score_matrix)
+            candidate_pairs.push(pair, pair_score)
+        return
+
+    # Lance-Williams update of the average linkage: the mention-pair scores stay fixed during
+    # merge(), so the score sums of the new cluster are the sums of its parents' score sums.
+    # A sum that has not been computed yet (e.g. the reversed direction of an initial pair) is
+    # computed once by the model.
+    parents = (cluster_i, cluster_j)
+    parents_sums = (linkage_sums.pop(cluster_i, {}), linkage_sums.pop(cluster_j, {}))
+    new_cluster_sums = {}
     for pair in new_pairs:
-        pair_score = assign_score(pair, model, device, topic_docs, is_event,
-                                  use_args_feats, use_binary_feats, other_clusters)
-        candidate_pairs[pair] = pair_score
+        cluster = pair[0]
+        cluster_sums = linkage_sums.setdefault(cluster, {})
+        to_new_sum = 0.0  # sum of the (cluster, new_cluster) mention pair scores
+        from_new_sum = 0.0  # sum of the (new_cluster, cluster) mention pair scores
+        for parent, parent_sums in zip(parents, parents_sums):
+            if parent in cluster_sums:
+                to_new_sum += cluster_sums.pop(parent)
+            else:
+                to_new_sum += sum_pair_scores((cluster, parent), model, device, topic_docs, is_event,
+                                              use_args_feats, use_binary_feats, other_clusters,
+                                              pair_score_matrix)[0]
+            if cluster in parent_sums:
+                from_new_sum += parent_sums[cluster]
+            else:
+                from_new_sum += sum_pair_scores((parent, cluster), model, device, topic_docs, is_event,
+                                                use_args_feats, use_binary_feats, other_clusters,
+                                                pair_score_matrix)[0]
+        cluster_sums[new_cluster] = to_new_sum
+        new_cluster_sums[cluster] = from_new_sum
+        pairs_count = len(cluster.mentions) * len(new_cluster.mentions)
+        candidate_pairs.push(pair, to_new_sum / float(pairs_count))
+    linkage_sums[new_cluster] = new_cluster_sums
+
+
+def score_merged_clusters(merged: List[Tuple[Cluster, Tuple[Cluster, Cluster]]],
+                          clusters: List[Cluster], other_clusters: List[Cluster],
+                          is_event, model, device, topic_docs: Dict[str, Document],
+                          candidate_pairs: CandidatePairsQueue,
+                          use_args_feats, use_binary_feats,
+                          linkage_sums: Optional[Dict[Cluster, Dict[Cluster, float]]] = None,
+                          pair_score_matrix: Optional[MentionPairScoreMatrix] = None) -> None:
+    """
+    Scores the candidate pairs of the new clusters of a round of merges, once all the round's
+    merges were applied by create_merged_cluster() (see merge_mutual_best_pairs()). Each new cluster
+    is paired with the surviving clusters and with the new clusters created before it in the round,
+    as (cluster, new_cluster), so each pair is scored once and no score of a cluster that is merged
+    later in the round is computed.
+
+    With *linkage_sums*, the score sums of a new pair are the sums of the score sums of the clusters
+    they were merged from (as in merge_clusters(), but both clusters of a pair can be new).
+
+    :param merged: a list of tuples (new_cluster, (cluster_i, cluster_j)), the round's new clusters
+        and the two clusters each one was merged from, in the order of the merges.
+    :param clusters: current event/entity clusters, after the round's merges
+    :param other_clusters: should be the current event clusters if clusters are entity clusters and vice versa.
+    :param is_event: True if the clusters are event clusters and False if they are entity clusters.
+    :param model: CDCorefModel object
+    :param device: Pytorch device object
+    :param topic_docs: current topic's documents
+    :param candidate_pairs: a CandidatePairsQueue contains the current candidate cluster pairs
+    :param use_args_feats: whether to use the semantically-dependent mention vectors or to ablate them.
+    :param use_binary_feats: whether to use the binary coreference features or to ablate them.
+    :param linkage_sums: the score sums of the cluster pairs (see merge_clusters()), updated here,
+        or None to score the new pairs by the model.
+    :param pair_score_matrix: a MentionPairScoreMatrix to read the mention-pair scores from, or None
+        to run the model.
+    :return: No return. *candidate_pairs* (and *linkage_sums*) updated.
+    """
+    new_clusters = [new_cluster for new_cluster, _ in merged]
+    new_cluster_to_parents = dict(merged)
+    surviving_clusters = [cluster for cluster in ordered_clusters(clusters)
+                          if cluster not in new_cluster_to_parents]
+
+    def linkage_sum(cluster_1, cluster_2):
+        # the clusters before the round's merges have score sums (or are scored once by the model)
+        scores_sum = 0.0
+        for part_1 in new_cluster_to_parents.get(cluster_1, (cluster_1,)):
+            part_1_sums = linkage_sums.get(part_1, {})
+            for part_2 in new_cluster_to_parents.get(cluster_2, (cluster_2,)):
+                if part_2 in part_1_sums:
+                    scores_sum += part_1_sums[part_2]
+                else:
+                    scores_sum += sum_pair_scores((part_1, part_2), model, device, topic_docs, is_event,
+                                                  use_args_feats, use_binary_feats, other_clusters,
+                                                  pair_score_matrix)[0]
+        return scores_sum
+
+    new_pairs_sums = []
+    for k, new_cluster in enumerate(new_clusters):
+        for cluster in surviving_clusters + new_clusters[:k]:
+            pair = (cluster, new_cluster)
+            if linkage_sums is None:
+                pair_score = assign_score(pair, model, device, topic_docs, is_event,
+                                          use_args_feats, use_binary_feats, other_clusters,
+                                          pair_score_matrix)
+            else:
+                to_new_sum = linkage_sum(cluster, new_cluster)
+                new_pairs_sums.append((cluster, new_cluster, to_new_sum, linkage_sum(new_cluster, cluster)))
+                pair_score = to_new_sum / float(len(cluster.mentions) * len(new_cluster.mentions))
+            candidate_pairs.push(pair, pair_score)
+    if linkage_sums is None:
+        return
+    # 删除旧簇的得分和, 添加新簇对的得分和
+    merged_clusters = [parent for _, parents in merged for parent in parents]
+    for parent in merged_clusters:
+        linkage_sums.pop(parent, None)
+    for cluster in surviving_clusters:
+        cluster_sums = linkage_sums.get(cluster)
+        if cluster_sums:
+            for parent in merged_clusters:
+                cluster_sums.pop(parent, None)
+    for cluster, new_cluster, to_new_sum, from_new_sum in new_pairs_sums:
+        linkage_sums.setdefault(cluster, {})[new_cluster] = to_new_sum
+        linkage_sums.setdefault(new_cluster, {})[cluster] = from_new_sum
 
 
 def assign_score(cluster_pair, model, device, topic_docs, is_event, use_args_feats,
-                 use_binary_feats, other_clusters):
+                 use_binary_feats, other_clusters, pair_score_matrix=None):
     """
     Assigns coreference (or quality of merge) score to a cluster pair by averaging the mention-pair
     scores predicted by the model.
@@ -1603,8 +3092,41 @@ def assign_score(cluster_pair, model, device, topic_docs, is_event, use_args_fea
         them.
     :param other_clusters: should be the current event clusters if cluster_pair is an entity pair
         and vice versa.
+    :param pair_score_matrix: a MentionPairScoreMatrix to read the mention-pair scores from, or None
+        to run the model.
     :return: The average mention pairwise score
     """
+    scores_sum, pairs_count = sum_pair_scores(cluster_pair, model, device, topic_docs, is_event,
+                                              use_args_feats, use_binary_feats, other_clusters,
+                                              pair_score_matrix)
+
+    return scores_sum/float(pairs_count)
+
+
+def sum_pair_scores(cluster_pair, model, device, topic_docs, is_event, use_args_feats,
+                    use_binary_feats, other_clusters, pair_score_matrix=None):
+    """
+    Sums the mention-pair scores predicted by the model over all the mention pairs of a cluster pair.
+
+    :param cluster_pair: a tuple of two Cluster objects
+    :param model: CDCorefScorer object
+    :param device: Pytorch device
+    :param topic_docs: current topic's documents
+    :param is_event: True if cluster_pair is an event pair and False if it's an entity pair
+    :param use_args_feats: whether to use the semantically-dependent mention vectors or to ablate
+        them.
+    :param use_binary_feats: whether to use the binary coreference features or to ablate
+        them.
+    :param other_clusters: should be the current event clusters if cluster_pair is an entity pair
+        and vice versa.
+    :param pair_score_matrix: a MentionPairScoreMatrix to read the mention-pair scores from, or None
+        to run the model.
+    :return: (sum of the mention pairwise scores, number of mention pairs)
+    """
+    if pair_score_matrix is not None:
+        pairs_count = len(cluster_pair[0].mentions) * len(cluster_pair[1].mentions)
+        return pair_score_matrix.pair_score_sum(cluster_pair[0], cluster_pair[1]), pairs_count
+
     mention_pairs = cluster_pair_to_mention_pair(cluster_pair)
     batches = get_batches(mention_pairs, 256)
     pairs_count = 0
@@ -1622,27 +3144,53 @@ def assign_score(cluster_pair, model, device, topic_docs, is_event, use_args_fea
 
         del batch_tensor
 
-    return scores_sum/float(pairs_count)
+    return scores_sum, pairs_count
 
 
 def merge(clusters: List[Cluster],
-          pairs: List[Tuple[Cluster, Cluster]], other_clusters: List[Cluster],
+          pairs: Iterable[Tuple[Cluster, Cluster]], other_clusters: List[Cluster],
           model: CDCorefScorer, device: torch.cuda.device,
           topic_docs, epoch, topics_counter,
-          topics_num, threshold, is_event, use_args_feats, use_binary_feats) -> None:
+          topics_num, threshold, is_event, use_args_feats, use_binary_feats,
+          use_incremental_linkage=False, use_dense_pair_scores=False,
+          use_mutual_best_merges=False,
+          pair_score_matrix: Optional[MentionPairScoreMatrix] = None,
+          compare_with_greedy=False) -> None:
     """
     Merges cluster pairs in agglomerative manner till it reaches a pre-defined
     threshold. In each step, the function merges the cluster pair with the
     highest score, and updates the candidate cluster pairs according to the
     current merge.
 
+    Since *other_clusters* and the mention representations are fixed during merges, each
+    mention-pair score is a constant. If *use_incremental_linkage* is true, the sums of those
+    scores are kept for every cluster pair, and the (average linkage) score of a new cluster is
+    built from the sums of its two parents, without running the model again.
+
+    If *use_dense_pair_scores* is true, all the mention-pair scores of the topic are computed
+    once, in large batches, into a MentionPairScoreMatrix, and the cluster pair scores are read
+    from it (see MentionPairScoreMatrix). A *pair_score_matrix* kept from an earlier merge() of the
+    same topic (and the same model) can be given instead, then only its outdated scores are
+    recomputed (see MentionPairScoreMatrix.update()).
+
+    If *use_mutual_best_merges* is true, each step merges all the pairs above the threshold whose
+    clusters are each other's best partner (see CandidatePairsQueue.pop_mutual_best()), instead of
+    the single best pair. With average linkage a merge can not raise the score of the merged
+    clusters' partners above their previous best, so this usually gives the same clusters as the
+    greedy order, in much fewer steps. The number of merges whose score is higher than the lowest
+    score merged in an earlier round is logged (a score order heuristic: the greedy order would
+    have tried them first). If *compare_with_greedy* is true, the greedy merges are also run on a
+    copy of the clusters, and the pairwise F1 between the two clusterings is logged (a diagnostic,
+    it costs a full greedy merge()).
+
     Note that all Cluster objects in *clusters* should have the same type (event
     or entity but not both of them).
 
     Note that *clusters* are updated and *other_clusters* are fixed during merges.
 
     :param clusters: a list of event/entity Cluster objects.
-    :param pairs: a list of all candidate cluster pairs.
+    :param pairs: all candidate cluster pairs, a list or a generator (e.g. iterate_cluster_pairs()).
+        It is fully consumed before the first merge.
     :param other_clusters: a list of entity/event Cluster objects (with the opposite type to *clusters*) .
     :param model: CDCorefScorer object with the same type as clusters.
     :param device: Pytorch device
@@ -1654,41 +3202,141 @@ def merge(clusters: List[Cluster],
     :param is_event: True if clusters are event clusters and false if they are entity clusters
     :param use_args_feats: whether to use the semantically-dependent mention vectors or to ablate them.
     :param use_binary_feats: whether to use the binary coreference features or to ablate
+    :param use_incremental_linkage: whether to update the scores of new cluster pairs incrementally
+    :param use_dense_pair_scores: whether to score all the mention pairs of the topic at once
+    :param use_mutual_best_merges: whether to merge all the mutually best pairs in each step
+    :param pair_score_matrix: a MentionPairScoreMatrix of the mentions of *clusters* to reuse, it is
+        updated here. If given, the mention-pair scores are read from it (as in *use_dense_pair_scores*).
+    :param compare_with_greedy: with *use_mutual_best_merges*, whether to log the difference from the
+        clusters of the greedy merges
     :return: No return. But *clusters* are updated.
     """
     logging.info('Initialize cluster pairs scores... ')
-    # initializes the pairs-scores dict
-    pairs_dict: Dict[Tuple[Cluster, Cluster], float] = {}
+    # initializes the pairs-scores queue
+    pairs_queue = CandidatePairsQueue()
+    linkage_sums = {} if use_incremental_linkage else None
     mode = 'event' if is_event else 'entity'
+    if pair_score_matrix is not None:
+        pair_score_matrix.update(model, device, is_event, use_args_feats, use_binary_feats, other_clusters)
+    elif use_dense_pair_scores:
+        pair_score_matrix = MentionPairScoreMatrix([mention for cluster in ordered_clusters(clusters)
+                                                    for mention in cluster.mentions.values()])
+        pair_score_matrix.score_all(model, device, is_event, use_args_feats, use_binary_feats,
+                                    other_clusters)
+    if pair_score_matrix is not None:
+        # 初始簇两两之间的得分和，一次算完
+        cluster_to_ix = {cluster: ix for ix, cluster in enumerate(clusters)}
+        clusters_sums = pair_score_matrix.clusters_score_sums(clusters)
     # 为每个簇对预测得分 init the scores (that the model assigns to the pairs)
     for pair in pairs:
-        pair_score = assign_score(pair, model, device, topic_docs, is_event,
-                                  use_args_feats, use_binary_feats, other_clusters)
-        pairs_dict[pair] = pair_score
+        if pair_score_matrix is not None and pair[0] in cluster_to_ix and pair[1] in cluster_to_ix:
+            ix_1, ix_2 = cluster_to_ix[pair[0]], cluster_to_ix[pair[1]]
+            scores_sum = clusters_sums[ix_1, ix_2].item()
+            pair_score = scores_sum/float(len(pair[0].mentions) * len(pair[1].mentions))
+            if linkage_sums is not None:
+                linkage_sums.setdefault(pair[0], {})[pair[1]] = scores_sum
+                linkage_sums.setdefault(pair[1], {})[pair[0]] = clusters_sums[ix_2, ix_1].item()
+        elif linkage_sums is None:
+            pair_score = assign_score(pair, model, device, topic_docs, is_event,
+                                      use_args_feats, use_binary_feats, other_clusters,
+                                      pair_score_matrix)
+        else:
+            scores_sum, pairs_count = sum_pair_scores(pair, model, device, topic_docs, is_event,
+                                                      use_args_feats, use_binary_feats, other_clusters,
+                                                      pair_score_matrix)
+            linkage_sums.setdefault(pair[0], {})[pair[1]] = scores_sum
+            pair_score = scores_sum/float(pairs_count)
+        pairs_queue.push(pair, pair_score)
+    if use_mutual_best_merges:
+        greedy_clusters = copy_clusters(clusters) if compare_with_greedy else None
+        merge_mutual_best_pairs(clusters, other_clusters, model, device, topic_docs, epoch, topics_counter,
+                                topics_num, threshold, is_event, use_args_feats, use_binary_feats,
+                                pairs_queue, linkage_sums, pair_score_matrix)
+        if greedy_clusters is not None:
+            merge(greedy_clusters, iterate_cluster_pairs(greedy_clusters), other_clusters, model, device,
+                  topic_docs, epoch, topics_counter, topics_num, threshold, is_event, use_args_feats,
+                  use_binary_feats, use_incremental_linkage, use_dense_pair_scores,
+                  pair_score_matrix=pair_score_matrix)
+            different_clusters = ({frozenset(cluster.mentions) for cluster in clusters} -
+                                  {frozenset(cluster.mentions) for cluster in greedy_clusters})
+            logging.info('Mutual best merges vs greedy merges ({}): pairwise F1 = {}, {} of {} clusters are not '
+                         'in the greedy clustering ({} greedy clusters)'.format(
+                            mode, clusterings_pairwise_f1(clusters, greedy_clusters), len(different_clusters),
+                            len(clusters), len(greedy_clusters)))
+        return
     # 迭代的凝聚
     while True:
         # finds max pair (break if we can't find one  - max score < threshold)
-        if len(pairs_dict) < 2:
+        if len(pairs_queue) < 2:
             logging.info('Less the 2 clusters had left, stop merging!')
             break
-        max_pair, max_score = key_with_max_val(pairs_dict)
+        max_pair, max_score = pairs_queue.pop_max()
         # 凝聚一下
         if max_score > threshold:
             logging.info('epoch {} topic {}/{} - merge {} clusters with score {} clusters : {} {}'.format(
                 epoch, topics_counter, topics_num, mode, str(max_score), str(max_pair[0]),
                 str(max_pair[1])))
             merge_clusters(max_pair, clusters, other_clusters, is_event,
-                           model, device, topic_docs, pairs_dict,
-                           use_args_feats, use_binary_feats)
+                           model, device, topic_docs, pairs_queue,
+                           use_args_feats, use_binary_feats, linkage_sums, pair_score_matrix)
         # 停止凝聚
         else:
             logging.info('Max score = {} is lower than threshold = {}, stopped merging!'.format(max_score, threshold))
             break
 
 
+def merge_mutual_best_pairs(clusters, other_clusters, model, device, topic_docs, epoch, topics_counter,
+                            topics_num, threshold, is_event, use_args_feats, use_binary_feats,
+                            pairs_queue: CandidatePairsQueue,
+                            linkage_sums: Optional[Dict[Cluster, Dict[Cluster, float]]] = None,
+                            pair_score_matrix: Optional[MentionPairScoreMatrix] = None) -> None:
+    '''
+    The merge loop of merge() in rounds: each round merges all the mutually best cluster pairs above
+    the threshold, and then scores the new clusters' candidate pairs in one pass (see
+    score_merged_clusters()). The loop stops when there are no such pairs. Logs the number of merges
+    scored above the lowest score of an earlier round (see merge()).
+    The parameters are the same as in merge(), *pairs_queue* holds the scored candidate pairs.
+    '''
+    mode = 'event' if is_event else 'entity'
+    rounds_num = 0
+    merges_num = 0
+    late_merges = 0
+    max_excess = 0.0
+    earlier_min_score = None
+    while True:
+        if len(pairs_queue) < 2:
+            logging.info('Less the 2 clusters had left, stop merging!')
+            break
+        round_pairs = pairs_queue.pop_mutual_best(threshold)
+        if not round_pairs:
+            logging.info('No pair with score above threshold = {}, stopped merging!'.format(threshold))
+            break
+        rounds_num += 1
+        merged = []
+        for pair, score in round_pairs:
+            logging.info('epoch {} topic {}/{} - round {} - merge {} clusters with score {} clusters : {} {}'.format(
+                epoch, topics_counter, topics_num, rounds_num, mode, str(score), str(pair[0]), str(pair[1])))
+            merged.append((create_merged_cluster(pair, clusters, other_clusters, is_event, model, device,
+                                                 pairs_queue), pair))
+            merges_num += 1
+            if earlier_min_score is not None and score > earlier_min_score:
+                late_merges += 1
+                max_excess = max(max_excess, score - earlier_min_score)
+        # 一轮的所有合并之后, 新簇只打分一次 (one rescoring pass per round)
+        score_merged_clusters(merged, clusters, other_clusters, is_event, model, device, topic_docs, pairs_queue,
+                              use_args_feats, use_binary_feats, linkage_sums, pair_score_matrix)
+        round_min_score = round_pairs[-1][1]
+        if earlier_min_score is None or round_min_score < earlier_min_score:
+            earlier_min_score = round_min_score
+    logging.info('Mutual best merges: {} {} merges in {} rounds, {} merges scored above an earlier round\'s '
+                 'lowest merge score (max score excess {})'.format(merges_num, mode, rounds_num, late_merges,
+                                                                    max_excess))
+
+
 def test_model(clusters, other_clusters, model, device, topic_docs, is_event, epoch,
                topics_counter, topics_num, threshold, use_args_feats,
-               use_binary_feats):
+               use_binary_feats, use_incremental_linkage=False, use_dense_pair_scores=False,
+               use_mutual_best_merges=False, pair_score_matrix=None, compare_with_greedy=False):
     '''
     Runs the inference procedure for a specific model (event/entity model).
     :param clusters: a list of Cluster objects of the same type (event/entity)
@@ -1705,18 +3353,31 @@ def test_model(clusters, other_clusters, model, device, topic_docs, is_event, ep
     :param use_args_feats: whether to use the semantically-dependent mention vectors or to ablate
     them.
     :param use_binary_feats: whether to use the binary coreference features or to ablate them.
+    :param use_incremental_linkage: whether to update the scores of new cluster pairs incrementally
+     (see merge())
+    :param use_dense_pair_scores: whether to score all the mention pairs of the topic at once
+     (see merge())
+    :param use_mutual_best_merges: whether to merge all the mutually best pairs in each step
+     (see merge())
+    :param pair_score_matrix: a MentionPairScoreMatrix of the mentions of *clusters* which is kept
+     across the iterations of the topic (see merge())
+    :param compare_with_greedy: whether to log the difference of the mutual best merges from the greedy
+     merges (see merge())
     '''
 
     # updating the semantically - dependent vectors according to other_clusters
     update_args_feature_vectors(clusters, other_clusters, model, device, is_event)
 
-    # generating candidate cluster pairs
-    cluster_pairs, _ = generate_cluster_pairs(clusters, is_train=False)
+    # generating candidate cluster pairs (lazily, merge() consumes them before any merge)
+    logging.info('Generating cluster pairs...')
+    logging.info('Initial number of clusters = {}'.format(len(clusters)))
+    cluster_pairs = iterate_cluster_pairs(clusters)
 
     # merging clusters pairs till reaching a pre-defined threshold
     merge(clusters, cluster_pairs, other_clusters,model, device, topic_docs, epoch,
           topics_counter, topics_num, threshold, is_event, use_args_feats,
-          use_binary_feats)
+          use_binary_feats, use_incremental_linkage, use_dense_pair_scores, use_mutual_best_merges,
+          pair_score_matrix, compare_with_greedy)
 
 from src.all_models.models import CDCorefScorer
 def test_models(
@@ -1764,6 +3425,12 @@ def test_models(
     all_event_mentions = []
     all_entity_mentions = []
 
+    # char LSTM inference mode: deterministic char vectors, cached by string (see set_char_inference_mode())
+    char_embeds_cache_size = config_dict.get("char_embeds_cache_size", 0)
+    if char_embeds_cache_size > 0:
+        event_char_mode = cd_event_model.set_char_inference_mode(True, char_embeds_cache_size)
+        entity_char_mode = cd_entity_model.set_char_inference_mode(True, char_embeds_cache_size)
+
     topics_counter = 0
     with torch.no_grad():
         for topic_id in topics_keys:
@@ -1778,6 +3445,8 @@ def test_models(
                                                                     topic,
                                                                     is_gold=config_dict["test_use_gold_mentions"]
                                                                     )
+            # 预先查好指称的词和字的索引 (word/char indices, both models share the vocabularies)
+            index_mentions(event_mentions + entity_mentions, cd_event_model)
             all_event_mentions.extend(event_mentions)  # 把抽取得到的本topic下的事件指称累计到全部事件指称列表
             all_entity_mentions.extend(entity_mentions)  # 把抽取得到的本topic下的实体指称累计到全部实体指称列表
 
@@ -1797,7 +3466,7 @@ def test_models(
             # initialize within-document entity clusters with the output of within-document system
             wd_entity_clusters = init_entity_wd_clusters(entity_mentions, doc_to_entity_mentions)
 
-            topic_entity_clusters = []
+            topic_entity_clusters = ClusterList()
             for doc_id, clusters in wd_entity_clusters.items():
                 topic_entity_clusters.extend(clusters)
 
@@ -1813,6 +3482,14 @@ def test_models(
             entity_th = config_dict["entity_merge_threshold"]
             event_th = config_dict["event_merge_threshold"]
 
+            # mention-pair scores kept across the iterations, only the outdated ones are recomputed
+            entity_pair_scores, event_pair_scores = None, None
+            if config_dict.get("use_dense_pair_scores", False):
+                entity_pair_scores = MentionPairScoreMatrix([mention for cluster in topic_entity_clusters
+                                                             for mention in cluster.mentions.values()])
+                event_pair_scores = MentionPairScoreMatrix([mention for cluster in topic_event_clusters
+                                                            for mention in cluster.mentions.values()])
+
             # 初始化结束，开始主循环
             for i in range(1,config_dict["merge_iters"]+1):
                 logging.info('Iteration number {}'.format(i))
@@ -1824,7 +3501,12 @@ def test_models(
                            topics_counter=topics_counter, topics_num=topics_num,
                            threshold=entity_th,
                            use_args_feats=config_dict["use_args_feats"],
-                           use_binary_feats=config_dict["use_binary_feats"])
+                           use_binary_feats=config_dict["use_binary_feats"],
+                           use_incremental_linkage=config_dict.get("use_incremental_linkage", False),
+                           use_dense_pair_scores=config_dict.get("use_dense_pair_scores", False),
+                           use_mutual_best_merges=config_dict.get("use_mutual_best_merges", False),
+                           pair_score_matrix=entity_pair_scores,
+                           compare_with_greedy=config_dict.get("compare_mutual_best_merges", False))
                 # Merge events
                 logging.info('Merge event clusters...')
                 test_model(clusters=topic_event_clusters, other_clusters=topic_entity_clusters,
@@ -1832,7 +3514,12 @@ def test_models(
                            topics_counter=topics_counter, topics_num=topics_num,
                            threshold=event_th,
                            use_args_feats=config_dict["use_args_feats"],
-                           use_binary_feats=config_dict["use_binary_feats"])
+                           use_binary_feats=config_dict["use_binary_feats"],
+                           use_incremental_linkage=config_dict.get("use_incremental_linkage", False),
+                           use_dense_pair_scores=config_dict.get("use_dense_pair_scores", False),
+                           use_mutual_best_merges=config_dict.get("use_mutual_best_merges", False),
+                           pair_score_matrix=event_pair_scores,
+                           compare_with_greedy=config_dict.get("compare_mutual_best_merges", False))
 
             set_coref_chain_to_mentions(topic_event_clusters, is_event=True,
                                         is_gold=config_dict["test_use_gold_mentions"],intersect_with_gold=True)
@@ -1860,6 +3547,10 @@ def test_models(
             sample_errors(event_errors, os.path.join(out_dir,'event_errors'))
             sample_errors(entity_errors, os.path.join(out_dir,'entity_errors'))
 
+    if char_embeds_cache_size > 0:
+        cd_event_model.set_char_inference_mode(event_char_mode, char_embeds_cache_size)
+        cd_entity_model.set_char_inference_mode(entity_char_mode, char_embeds_cache_size)
+
     if analyze_scores:
         # Save mention representations
         save_mention_representations(all_event_clusters, out_dir, is_event=True)
@@ -1905,10 +3596,10 @@ def init_clusters_with_lemma_baseline(mentions, is_event):
     (used for experiments)
     :param mentions: list of Mention objects (EventMention/EntityMention objects)
     :param is_event: True if mentions are event mentions and False if they are entity mentions
-    :return: list of Cluster objects
+    :return: list of Cluster objects (a ClusterList)
     '''
     mentions_by_head_lemma = {}
-    clusters = []
+    clusters = ClusterList()
 
     for mention in mentions:
         if mention.mention_head_lemma not in mentions_by_head_lemma:
@@ -2,19 +2,140 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence
 import numpy as np
+import itertools
+import collections
+import json
+import logging
+import weakref
 from typing import Dict, List, Tuple, Union  # for type hinting
 # import torch.autograd as autograd
 # import src.all_models.model_utils
 
 
+class LRUCache(object):
+    '''
+    A bounded dictionary which evicts the least recently used key when it is full.
+    '''
+    def __init__(self, max_size):
+        '''
+        :param max_size: the maximal number of keys
+        '''
+        self.max_size = max_size
+        self.items = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key, default=None):
+        '''
+        :param key: a key
+        :param default: returned if the key is not in the cache
+        :return: the key's value (and marks it as the most recently used), or *default*.
+        '''
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        '''
+        Adds a key (the least recently used key is evicted if the cache is full)
+        :param key: a key
+        :param value: its value
+        '''
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+
+class WordEmbeddingStore(object):
+    '''
+    The frozen pre-trained word embeddings (GloVe) and their vocabulary, shared by the event model
+    and the entity model (both models' word_embed_layer use the same weight tensor).
+
+    A store saved by save() is loaded by load() as a copy-on-write memory-mapped array, so the
+    processes which load it share its pages. Such a store is pickled as its path only: a pickled
+    model references the file instead of holding a copy of the embeddings, and the models loaded
+    in the same process share one store (see get_shared()).
+    '''
+    _loaded = weakref.WeakValueDictionary()
+    """Key is a path, value is the store loaded from it by get_shared() (while it is in use)."""
+
+    def __init__(self, word_embeds, word_to_ix, path=None):
+        '''
+        :param word_embeds: an array with size (|V|, |w|), see CDCorefScorer.__init__()
+        :param word_to_ix: a lookup dict of word_embeds, see CDCorefScorer.__init__()
+        :param path: the path the store was saved to (without extension), or None.
+        '''
+        self.word_embeds = np.asarray(word_embeds, dtype=np.float32)
+        self.word_to_ix = word_to_ix
+        self.path = path
+        self._weight = None
+
+    @property
+    def weight(self):
+        '''
+        :return: the embeddings as a tensor (created once, on the store's memory)
+        '''
+        if self._weight is None:
+            self._weight = torch.from_numpy(self.word_embeds)
+        return self._weight
+
+    def save(self, path):
+        '''
+        Saves the store to path.npy (the embeddings, float32) and path.vocab.json (word_to_ix)
+        :param path: the output path without extension
+        '''
+        np.save(path + '.npy', self.word_embeds)
+        with open(path + '.vocab.json', 'w', encoding='utf8') as f:
+            json.dump(self.word_to_ix, f, ensure_ascii=False)
+        self.path = path
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        '''
+        Loads a store saved by save()
+        :param path: the path the store was saved to (without extension)
+        :param mmap: whether to memory-map the embeddings instead of reading them
+        :return: a WordEmbeddingStore object
+        '''
+        word_embeds = np.load(path + '.npy', mmap_mode='c' if mmap else None)
+        with open(path + '.vocab.json', 'r', encoding='utf8') as f:
+            word_to_ix = json.load(f)
+        return cls(word_embeds, word_to_ix, path)
+
+    @classmethod
+    def get_shared(cls, path):
+        '''
+        Like load(), but returns the store already loaded from this path in this process if there is one.
+        :param path: the path the store was saved to (without extension)
+        :return: a WordEmbeddingStore object
+        '''
+        store = cls._loaded.get(path)
+        if store is None:
+            store = cls.load(path)
+            cls._loaded[path] = store
+        return store
+
+    def __reduce__(self):
+        if self.path is not None:
+            return WordEmbeddingStore.get_shared, (self.path,)
+        return WordEmbeddingStore, (self.word_embeds, self.word_to_ix)
+
+
 class CDCorefScorer(nn.Module):
     '''
     An abstract class represents a coreference pairwise scorer.
     Inherits Pytorch's Module class.
     '''
     def __init__(self,
-                 word_embeds: np.ndarray, word_to_ix: Dict[str, int], vocab_size: int,
+                 word_embeds: Union[np.ndarray, WordEmbeddingStore], word_to_ix: Dict[str, int], vocab_size: int,
                  char_embeds, char_to_ix, char_rep_size, dims, use_mult, use_diff, feature_size
                  ):
         """
@@ -25,6 +146,8 @@ class CDCorefScorer(nn.Module):
             |v| is the length of vocabulary.
             |w| is the length of word embedding and is 300 by default beacause we use glove.6B.300d.txt by default.
             The element word_embeds[i] is the word embedding of the i-th word in vocabulary.
+            It can also be a WordEmbeddingStore, then the model uses the store's weight tensor
+            (shared with the other models of the store) and vocabulary instead of copies.
         :param word_to_ix: A lookup dict of word_embeds.
             Key is each word in vocabulary.
             Value is the index of this word's embedding in word_embeds.
@@ -48,17 +171,26 @@ class CDCorefScorer(nn.Module):
         """
         super(CDCorefScorer, self).__init__()
         # length of embedding
-        self.word_embed_dim = word_embeds.shape[1]
+        if isinstance(word_embeds, WordEmbeddingStore):
+            self.word_embed_dim = word_embeds.word_embeds.shape[1]
+        else:
+            self.word_embed_dim = word_embeds.shape[1]
         self.char_embed_dim = char_embeds.shape[1]
         """LSTF的输入向量的长度"""
         self.char_hidden_dim = char_rep_size
         """LSTF的输出向量的长度"""
 
         # word embedding layer
-        self.word_embed_layer = nn.Embedding(vocab_size, self.word_embed_dim)
-        self.word_embed_layer.weight.data.copy_(torch.from_numpy(word_embeds))
-        self.word_embed_layer.weight.requires_grad = False  # pre-trained word embeddings are fixed
-        self.word_to_ix = word_to_ix
+        if isinstance(word_embeds, WordEmbeddingStore):
+            self.word_embeds_store = word_embeds
+            self.word_embed_layer = nn.Embedding.from_pretrained(word_embeds.weight, freeze=True)
+            self.word_to_ix = word_embeds.word_to_ix
+        else:
+            self.word_embeds_store = None
+            self.word_embed_layer = nn.Embedding(vocab_size, self.word_embed_dim)
+            self.word_embed_layer.weight.data.copy_(torch.from_numpy(word_embeds))
+            self.word_embed_layer.weight.requires_grad = False  # pre-trained word embeddings are fixed
+            self.word_to_ix = word_to_ix
 
         # char embedding layer
         self.char_embed_layer = nn.Embedding(len(char_to_ix.keys()), self.word_embed_dim)
@@ -87,6 +219,11 @@ class CDCorefScorer(nn.Module):
         self.use_diff = use_diff
         self.model_type = 'CD_scorer'
 
+        # char LSTM inference mode (see set_char_inference_mode())
+        self.char_inference_mode = False
+        self.char_embeds_cache = None
+        self.chars_seq_cache = None
+
     def forward(self, clusters_pair_tensor):
         '''
         The forward method - pass the input tensor through a feed-forward neural network
@@ -102,14 +239,199 @@ class CDCorefScorer(nn.Module):
 
         return out
 
-    def init_char_hidden(self, device):
+    def split_first_layer_weight(self, mention_dim, use_binary_feats):
+        '''
+        Splits the weight of hidden_layer_1 into the blocks that multiply each part of the pair input
+        [v1; v2; v1-v2 (if use_diff); v1*v2 (if use_mult); f (if use_binary_feats)].
+        :param mention_dim: the size of a mention representation v
+        :param use_binary_feats: whether the pair input ends with the binary features' embeddings
+        :return: a tuple (W_1, W_2, W_diff, W_mult, W_feats), W_diff/W_mult/W_feats are None
+         if their part is not in the input.
+        '''
+        weight = self.hidden_layer_1.weight
+        feats_dim = 4 * self.coref_role_embeds.embedding_dim if use_binary_feats else 0
+        blocks_num = 2 + int(self.use_diff) + int(self.use_mult)
+        if blocks_num * mention_dim + feats_dim != self.input_dim:
+            raise ValueError('Mention size {} does not fit the input size {} of the model'.format(
+                mention_dim, self.input_dim))
+        blocks = list(torch.split(weight[:, :blocks_num * mention_dim], mention_dim, dim=1))
+        w_1, w_2 = blocks[0], blocks[1]
+        w_diff = blocks[2] if self.use_diff else None
+        w_mult = blocks[-1] if self.use_mult else None
+        w_feats = weight[:, blocks_num * mention_dim:] if use_binary_feats else None
+        return w_1, w_2, w_diff, w_mult, w_feats
+
+    def project_mentions(self, mention_tensors, use_binary_feats):
+        '''
+        Computes the per-mention part of the first layer, for inference (see score_mention_pairs()).
+        hidden_layer_1 is linear, so for a pair (m_i, m_j) its v1, v2 and v1-v2 blocks contribute
+        (W_1 + W_diff) v_i + (W_2 - W_diff) v_j, which is computed once per mention here instead of
+        once per pair.
+        :param mention_tensors: mention representations, a tensor of size (n, X)
+        :param use_binary_feats: whether the pairs have binary features
+        :return: a tuple (first, second), tensors of size (n, hidden_dim_1). first includes the bias
+         of hidden_layer_1.
+        '''
+        w_1, w_2, w_diff, _, _ = self.split_first_layer_weight(mention_tensors.shape[1], use_binary_feats)
+        if w_diff is not None:
+            w_1 = w_1 + w_diff
+            w_2 = w_2 - w_diff
+        first = F.linear(mention_tensors, w_1, self.hidden_layer_1.bias)
+        second = F.linear(mention_tensors, w_2)
+        return first, second
+
+    def score_mention_pairs(self, mention_tensors, rows_1, rows_2, coref_bits, projections=None):
+        '''
+        Inference path equivalent to forward() on the pair input
+        [v1; v2; v1-v2; v1*v2; f] (see model_utils.mention_pairs_to_model_input_by_index()),
+        without building that input: the linear blocks of the first layer come from the cached
+        per-mention projections (see project_mentions()), and only the element-wise product and
+        the binary features are computed per pair. The binary features take only 16 values, so their
+        first-layer projections are looked up from a table.
+        :param mention_tensors: mention representations, a tensor of size (n, X)
+        :param rows_1: the rows of the first mentions, a LongTensor of size (B)
+        :param rows_2: the rows of the second mentions, a LongTensor of size (B)
+        :param coref_bits: the pairs' binary features, a LongTensor of size (B, 4), or None to ablate them.
+        :param projections: the result of project_mentions(mention_tensors), computed here if None.
+        :return: the predicted scores, a tensor of size (B, 1)
+        '''
+        use_binary_feats = coref_bits is not None
+        if projections is None:
+            projections = self.project_mentions(mention_tensors, use_binary_feats)
+        first, second = projections
+        _, _, _, w_mult, w_feats = self.split_first_layer_weight(mention_tensors.shape[1], use_binary_feats)
+        first_hidden = first.index_select(0, rows_1) + second.index_select(0, rows_2)
+        if w_mult is not None:
+            mult = mention_tensors.index_select(0, rows_1) * mention_tensors.index_select(0, rows_2)
+            first_hidden = first_hidden + F.linear(mult, w_mult)
+        if use_binary_feats:
+            # 4个二值特征共16种取值组合，先算好每种组合在第一层的投影
+            all_bits = torch.tensor(list(itertools.product([0, 1], repeat=4)), dtype=torch.long,
+                                    device=coref_bits.device)
+            feats_table = F.linear(self.coref_role_embeds(all_bits).view(16, -1), w_feats)
+            bits_weights = torch.tensor([8, 4, 2, 1], dtype=torch.long, device=coref_bits.device)
+            codes = (coref_bits * bits_weights).sum(1)
+            first_hidden = first_hidden + feats_table.index_select(0, codes)
+        first_hidden = F.relu(first_hidden)
+        second_hidden = F.relu(self.hidden_layer_2(first_hidden))
+        out = F.sigmoid(self.out_layer(second_hidden))
+
+        return out
+
+    def __getstate__(self):
+        # the char embeddings caches are not saved with the model
+        state = self.__dict__.copy()
+        state['char_embeds_cache'] = None
+        state['chars_seq_cache'] = None
+        state['char_inference_mode'] = False
+        # the frozen word embeddings are saved once, by the store (only its path if it is a file)
+        if getattr(self, 'word_embeds_store', None) is not None:
+            state['_modules'] = state['_modules'].copy()
+            state['_modules']['word_embed_layer'] = None
+            state['word_to_ix'] = None
+        return state
+
+    def __setstate__(self, state):
+        super(CDCorefScorer, self).__setstate__(state)
+        if getattr(self, 'word_embeds_store', None) is not None and self.word_embed_layer is None:
+            self.word_embed_layer = nn.Embedding.from_pretrained(self.word_embeds_store.weight, freeze=True)
+            self.word_to_ix = self.word_embeds_store.word_to_ix
+
+    def trainable_state_dict(self):
+        '''
+        :return: the model's state_dict() without the frozen word embeddings (which are restored from
+         the word embeddings source when the model is created)
+        '''
+        return collections.OrderedDict((name, value) for name, value in self.state_dict().items()
+                                       if name != 'word_embed_layer.weight')
+
+    def get_checkpoint(self):
+        '''
+        Returns a slim checkpoint of the model: its trainable weights, the arguments to create it and
+        the path of its word embeddings store (see from_checkpoint()). The word embeddings themselves
+        are in the checkpoint only if the model has no saved store.
+        :return: a dictionary
+        '''
+        store = getattr(self, 'word_embeds_store', None)
+        store_path = store.path if store is not None else None
+        checkpoint = {'model_type': self.model_type,
+                      'dims': [self.input_dim, self.hidden_dim_1, self.hidden_dim_2],
+                      'char_rep_size': self.char_hidden_dim,
+                      'use_mult': self.use_mult,
+                      'use_diff': self.use_diff,
+                      'feature_size': self.coref_role_embeds.embedding_dim,
+                      'char_to_ix': self.char_to_ix,
+                      'char_embeds_shape': list(self.char_embed_layer.weight.shape),
+                      'word_embeds_shape': list(self.word_embed_layer.weight.shape),
+                      'word_embeds_store_path': store_path}
+        if store_path is None:
+            checkpoint['word_to_ix'] = self.word_to_ix
+            checkpoint['state_dict'] = self.state_dict()
+        else:
+            checkpoint['state_dict'] = self.trainable_state_dict()
+        return checkpoint
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint):
+        '''
+        Creates a model from a checkpoint of get_checkpoint(). The word embeddings are taken from
+        the shared store of the checkpoint's path (memory-mapped, and loaded only once per process).
+        :param checkpoint: a dictionary returned by get_checkpoint()
+        :return: a CDCorefScorer object (on the device of the checkpoint's tensors)
+        '''
+        if checkpoint['word_embeds_store_path'] is not None:
+            word_embeds = WordEmbeddingStore.get_shared(checkpoint['word_embeds_store_path'])
+            word_to_ix = word_embeds.word_to_ix
+        else:
+            # filled by the state dict below
+            word_embeds = np.zeros(checkpoint['word_embeds_shape'], dtype=np.float32)
+            word_to_ix = checkpoint['word_to_ix']
+        model = cls(word_embeds, word_to_ix, checkpoint['word_embeds_shape'][0],
+                    char_embeds=np.zeros(checkpoint['char_embeds_shape'], dtype=np.float32),
+                    char_to_ix=checkpoint['char_to_ix'],
+                    char_rep_size=checkpoint['char_rep_size'],
+                    dims=checkpoint['dims'],
+                    use_mult=checkpoint['use_mult'],
+                    use_diff=checkpoint['use_diff'],
+                    feature_size=checkpoint['feature_size'])
+        device = next(iter(checkpoint['state_dict'].values())).device
+        model = model.to(device)
+        state_dict = model.state_dict()
+        state_dict.update(checkpoint['state_dict'])
+        model.load_state_dict(state_dict)
+        return model
+
+    def set_char_inference_mode(self, enabled, cache_size=10000):
+        '''
+        Turns the char LSTM inference mode on/off. In this mode the LSTM's initial states are zeros
+        instead of random (so a string always gets the same vector), and the char vectors and the
+        character indices of the strings are kept in LRU caches keyed by the string, so a repeated
+        string (e.g. the head "said") runs the LSTM only once.
+        The cached vectors do not require gradients and become stale when the model is trained, so
+        this mode is for inference only. The caches are emptied on each call.
+        :param enabled: True to turn the mode on, and False to turn it off
+        :param cache_size: the maximal number of strings in each cache
+        :return: whether the mode was on before the call
+        '''
+        previous_mode = getattr(self, 'char_inference_mode', False)
+        self.char_inference_mode = enabled
+        self.char_embeds_cache = LRUCache(cache_size) if enabled else None
+        self.chars_seq_cache = LRUCache(cache_size) if enabled else None
+        return previous_mode
+
+    def init_char_hidden(self, device, batch_size=1):
         '''
         initializes hidden states the character LSTM
         :param device: gpu/cpu Pytorch device
-        :return: initialized hidden states (tensors)
+        :param batch_size: the number of sequences the LSTM runs on
+        :return: initialized hidden states (tensors), zeros in the inference mode
+         (see set_char_inference_mode()) and random otherwise.
         '''
-        return (torch.randn((1, 1, self.char_hidden_dim), requires_grad=True).to(device),
-                torch.randn((1, 1, self.char_hidden_dim), requires_grad=True).to(device))
+        if getattr(self, 'char_inference_mode', False):
+            return (torch.zeros((1, batch_size, self.char_hidden_dim)).to(device),
+                    torch.zeros((1, batch_size, self.char_hidden_dim)).to(device))
+        return (torch.randn((1, batch_size, self.char_hidden_dim), requires_grad=True).to(device),
+                torch.randn((1, batch_size, self.char_hidden_dim), requires_grad=True).to(device))
 
     def get_char_embeds(self, seq, device):
         '''
@@ -118,14 +440,78 @@ class CDCorefScorer(nn.Module):
         :param device:  gpu/cpu Pytorch device
         :return: the LSTM's last output state
         '''
+        if getattr(self, 'char_inference_mode', False):
+            char_vec = self.char_embeds_cache.get(seq)
+            if char_vec is not None:
+                return char_vec.to(device)
         char_hidden = self.init_char_hidden(device)
         input_char_seq = self.prepare_chars_seq(seq, device)
         char_embeds = self.char_embed_layer(input_char_seq).view(len(seq), 1, -1)
         char_lstm_out, char_hidden = self.char_lstm_layer(char_embeds, char_hidden)
         char_vec = char_lstm_out[-1]
+        if getattr(self, 'char_inference_mode', False):
+            char_vec = char_vec.detach()
+            self.char_embeds_cache.put(seq, char_vec)
 
         return char_vec
 
+    def get_char_embeds_batch(self, seqs, device, seqs_idxs=None):
+        '''
+        Batched version of get_char_embeds(): runs the LSTM once on a list of strings, as a padded
+        batch packed by length (sorted from the longest), and returns the last output state of each
+        string.
+        :param seqs: a list of strings (words or phrases), not empty strings
+        :param device:  gpu/cpu Pytorch device
+        :param seqs_idxs: optional, the precomputed char indices of each string (see chars_to_idxs()),
+         or None for a string without indices.
+        :return: a tensor of size (len(seqs), char_hidden_dim), row i is the LSTM's last output
+         state of seqs[i]
+        '''
+        if seqs_idxs is None:
+            seqs_idxs = [None] * len(seqs)
+        if getattr(self, 'char_inference_mode', False):
+            # run the LSTM only on the distinct strings which are not in the cache
+            seq_to_vec = {}
+            for seq in seqs:
+                if seq not in seq_to_vec and seq in self.char_embeds_cache:
+                    seq_to_vec[seq] = self.char_embeds_cache.get(seq)
+            seq_to_idxs = collections.OrderedDict((seq, idxs) for seq, idxs in zip(seqs, seqs_idxs)
+                                                  if seq not in seq_to_vec)
+            missing_seqs = list(seq_to_idxs.keys())
+            missing_vecs = self._run_char_lstm_batch(missing_seqs, device, list(seq_to_idxs.values())).detach()
+            for seq, char_vec in zip(missing_seqs, missing_vecs.split(1, 0)):
+                self.char_embeds_cache.put(seq, char_vec)
+                seq_to_vec[seq] = char_vec
+            if len(seqs) == 0:
+                return torch.zeros(0, self.char_hidden_dim).to(device)
+            return torch.cat([seq_to_vec[seq].to(device) for seq in seqs], 0)
+        return self._run_char_lstm_batch(seqs, device, seqs_idxs)
+
+    def _run_char_lstm_batch(self, seqs, device, seqs_idxs):
+        '''
+        The LSTM part of get_char_embeds_batch(), without the cache.
+        '''
+        if len(seqs) == 0:
+            return torch.zeros(0, self.char_hidden_dim).to(device)
+        order = sorted(range(len(seqs)), key=lambda ix: len(seqs[ix]), reverse=True)
+        lengths = [len(seqs[ix]) for ix in order]
+        padded_seqs = torch.zeros((lengths[0], len(seqs)), dtype=torch.long)
+        for column, ix in enumerate(order):
+            if seqs_idxs[ix] is not None:
+                padded_seqs[:lengths[column], column] = torch.tensor(seqs_idxs[ix], dtype=torch.long)
+            else:
+                padded_seqs[:lengths[column], column] = self.prepare_chars_seq(seqs[ix], torch.device('cpu'))
+        char_embeds = self.char_embed_layer(padded_seqs.to(device))
+        packed_embeds = pack_padded_sequence(char_embeds, lengths)
+        char_hidden = self.init_char_hidden(device, len(seqs))
+        _, (last_hidden, _) = self.char_lstm_layer(packed_embeds, char_hidden)
+        # back to the order of seqs
+        unsort = torch.zeros(len(seqs), dtype=torch.long)
+        unsort[torch.tensor(order, dtype=torch.long)] = torch.arange(len(seqs), dtype=torch.long)
+        char_vecs = last_hidden[-1].index_select(0, unsort.to(device))
+
+        return char_vecs
+
     def prepare_chars_seq(self, seq, device):
         '''
         Given a string represents a word or a phrase, this method converts the sequence
@@ -134,6 +520,24 @@ class CDCorefScorer(nn.Module):
         :param device: device:  gpu/cpu Pytorch device
         :return: a list of character embeddings
         '''
+        if getattr(self, 'char_inference_mode', False):
+            idxs = self.chars_seq_cache.get(seq)
+            if idxs is None:
+                idxs = self.chars_to_idxs(seq)
+                self.chars_seq_cache.put(seq, idxs)
+        else:
+            idxs = self.chars_to_idxs(seq)
+        tensor = torch.tensor(idxs, dtype=torch.long).to(device)
+
+        return tensor
+
+    def chars_to_idxs(self, seq):
+        '''
+        Maps the characters of a string to their indices in char_embed_layer (unknown characters
+        are mapped to '<UNK>').
+        :param seq: a string represents a word or a phrase
+        :return: the indices of its characters in char_embed_layer
+        '''
         idxs = []
         for w in seq:
             if w in self.char_to_ix:
@@ -144,7 +548,6 @@ class CDCorefScorer(nn.Module):
                     idxs.append(self.char_to_ix[lower_w])
                 else:
                     idxs.append(self.char_to_ix['<UNK>'])
-                    print('can find char {}'.format(w))
-        tensor = torch.tensor(idxs, dtype=torch.long).to(device)
+                    logging.debug('can find char {}'.format(w))
 
-        return tensor
+        return idxs
@@ -12,7 +12,7 @@ import src.shared.classes as classes
 # 这个classes类定义了corpus、topic、document等基本类，而测试集是以corpus类对象的形式存储的
 from src.shared.classes import *  # from classes import *
 from src.shared.eval_utils import *  # from eval_utils import *
-from src.all_models.model_utils import load_entity_wd_clusters, test_models
+from src.all_models.model_utils import load_entity_wd_clusters, test_models, load_check_point
 
 print(os.getcwd())
 print("环境变量：", os.environ["PATH"], "\n")
@@ -176,11 +176,11 @@ def test_model(test_set: src.shared.classes.Corpus):
         device = torch.device("cpu")
     # 加载模型
     if config_dict["use_cuda"]:  # 训练模型时使用的是0号GPU，现在使用n号GPU，需要转换
-        cd_event_model = torch.load(config_dict["cd_event_model_path"], map_location={'cuda:0': cudan})
-        cd_entity_model = torch.load(config_dict["cd_entity_model_path"], map_location={'cuda:0': cudan})
+        cd_event_model = load_check_point(config_dict["cd_event_model_path"], map_location={'cuda:0': cudan})
+        cd_entity_model = load_check_point(config_dict["cd_entity_model_path"], map_location={'cuda:0': cudan})
     else:  # 训练模型时使用的是0号GPU，现在使用CPU，需要转换
-        cd_event_model = torch.load(config_dict["cd_event_model_path"], map_location={'cuda:0': 'cpu'})
-        cd_entity_model = torch.load(config_dict["cd_entity_model_path"], map_location={'cuda:0': 'cpu'})
+        cd_event_model = load_check_point(config_dict["cd_event_model_path"], map_location={'cuda:0': 'cpu'})
+        cd_entity_model = load_check_point(config_dict["cd_entity_model_path"], map_location={'cuda:0': 'cpu'})
     # 把模型放到设备中
     cd_event_model.to(device)
     cd_entity_model.to(device)
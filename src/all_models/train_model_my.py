@@ -2,6 +2,7 @@ import os
 import gc
 import sys
 import time
+import queue
 import math
 import json
 import spacy
@@ -9,6 +10,7 @@ import random
 import logging
 import argparse
 import itertools
+import traceback
 import numpy as np
 from scorer import *
 import _pickle as cPickle
@@ -21,15 +23,15 @@ from spacy.lang.en import English
 from typing import Dict, List, Tuple, Union  # for type hinting
 from src.shared.classes import Corpus, Topic, Document, Sentence, Mention, EventMention, EntityMention, Token, Srl_info, Cluster
 from src.shared.eval_utils import *
-from src.all_models.models import CDCorefScorer
+from src.all_models.models import CDCorefScorer, WordEmbeddingStore
 from src.all_models.model_utils import load_entity_wd_clusters
 from src.all_models.model_utils import loadGloveWordEmbedding, loadGloveCharEmbeddings, load_one_hot_char_embeddings
 from src.all_models.model_utils import topic_to_mention_list
 from src.all_models.model_utils import update_lexical_vectors
 from src.all_models.model_utils import update_args_feature_vectors
-from src.all_models.model_utils import generate_cluster_pairs
+from src.all_models.model_utils import iterate_cluster_pairs, iterate_train_cluster_pairs
 from src.all_models.model_utils import train, merge
-from src.all_models.model_utils import create_mention_span_representations
+from src.all_models.model_utils import create_mention_span_representations, index_mentions
 from src.all_models.model_utils import mention_list_to_gold_wd_cluster_list, mention_list_to_singleton_cluster_list
 
 
@@ -116,6 +118,11 @@ value is the index of this char's embedding in word_embeds.
 So, char_embeds[char_to_ix["$"]] is the embedding of char "$". 
 length is 96: There are 94 chars in Glove char embeddings file and 2 more special char.
 """
+word_embeds_store: WordEmbeddingStore = None
+"""
+word_embeds and word_to_ix in one store, shared by the event model and the entity model.
+See create_word_embeds_store().
+"""
 
 
 def train_and_merge(clusters: List[Cluster], other_clusters: List[Cluster],
@@ -152,7 +159,12 @@ def train_and_merge(clusters: List[Cluster], other_clusters: List[Cluster],
 
     # 2. 根据(实体/事件)指称向量，更新(实体/事件)指称对打分函数
     #   生成数据
-    train_cluster_pairs, test_cluster_pairs = generate_cluster_pairs(clusters, is_train=True)
+    logging.info('Generating cluster pairs...')
+    logging.info('Initial number of clusters = {}'.format(len(clusters)))
+    # (streamed into train()'s mention pairs sample, not kept as a list)
+    train_cluster_pairs = iterate_train_cluster_pairs(clusters,
+                                                      config_dict.get("hard_negatives_budget", None),
+                                                      config_dict.get("random_negatives_budget", 0))
     #   训练打分函数
     train(train_cluster_pairs, model, optimizer, loss,
           device, topic.docs, epoch, topics_counter, topics_num, config_dict, is_event,
@@ -167,9 +179,15 @@ def train_and_merge(clusters: List[Cluster], other_clusters: List[Cluster],
         create_mention_span_representations(event_mentions, model, device, topic.docs, is_event=True, requires_grad=False)
         create_mention_span_representations(entity_mentions, model, device, topic.docs, is_event=False, requires_grad=False)
         # 凝聚聚类 Merge clusters till reaching the threshold
+        # (clusters have not changed since the training pairs were generated)
+        test_cluster_pairs = iterate_cluster_pairs(clusters)
         merge(clusters, test_cluster_pairs, other_clusters, model, device, topic.docs, epoch,
               topics_counter, topics_num, threshold, is_event,
-              config_dict["use_args_feats"], config_dict["use_binary_feats"])
+              config_dict["use_args_feats"], config_dict["use_binary_feats"],
+              config_dict.get("use_incremental_linkage", False),
+              config_dict.get("use_dense_pair_scores", False),
+              config_dict.get("use_mutual_best_merges", False),
+              compare_with_greedy=config_dict.get("compare_mutual_best_merges", False))
 
 
 def save_epoch_f1(event_f1, entity_f1, epoch,  best_event_th, best_entity_th):
@@ -212,7 +230,7 @@ def save_training_checkpoint(epoch, model, optimizer, best_f1, filename):
     :param best_f1: the best B-cubed F1 score so far
     :param filename: the filename of the checkpoint file
     '''
-    state = {'epoch': epoch + 1, 'state_dict': model.state_dict(),
+    state = {'epoch': epoch + 1, 'state_dict': model.trainable_state_dict(),
              'optimizer': optimizer.state_dict(), 'best_f1': best_f1 }
     torch.save(state, filename)
 
@@ -230,7 +248,10 @@ def load_training_checkpoint(model, optimizer, filename, device):
     logging.info("Loading checkpoint '{}'".format(filename))
     checkpoint = torch.load(filename)
     start_epoch = checkpoint['epoch']
-    model.load_state_dict(checkpoint['state_dict'])
+    # the checkpoint has no frozen word embeddings, the model keeps its own
+    state_dict = model.state_dict()
+    state_dict.update(checkpoint['state_dict'])
+    model.load_state_dict(state_dict)
     optimizer.load_state_dict(checkpoint['optimizer'])
     best_f1 = checkpoint['best_f1']
     logging.info("Loaded checkpoint '{}' (epoch {})" .format(filename, checkpoint['epoch']))
@@ -251,17 +272,18 @@ def create_model(config_dict: Dict) -> CDCorefScorer:
     :param config_dict: a configuration dictionary.
     :return: an cd coref model.
     '''
-    global word_embeds, word_to_ix, char_embeds, char_to_ix
+    global word_embeds_store, char_embeds, char_to_ix
 
     context_vector_size = 1024
+    word_embed_dim = word_embeds_store.word_embeds.shape[1]
 
     # use argument vectors 使用论元特征
     if config_dict["use_args_feats"]:
-        mention_rep_size = context_vector_size + ((word_embeds.shape[1] + config_dict["char_rep_size"]) * 5)
+        mention_rep_size = context_vector_size + ((word_embed_dim + config_dict["char_rep_size"]) * 5)
 
     # use predicate vectors 使用谓词特征
     else:
-        mention_rep_size = context_vector_size + word_embeds.shape[1] + config_dict["char_rep_size"]
+        mention_rep_size = context_vector_size + word_embed_dim + config_dict["char_rep_size"]
 
     input_dim = mention_rep_size * 3
 
@@ -272,7 +294,7 @@ def create_model(config_dict: Dict) -> CDCorefScorer:
     third_dim = second_dim
     model_dims = [input_dim, second_dim, third_dim]
 
-    model = CDCorefScorer(word_embeds, word_to_ix, word_embeds.shape[0],
+    model = CDCorefScorer(word_embeds_store, word_embeds_store.word_to_ix, word_embeds_store.word_embeds.shape[0],
                           char_embeds=char_embeds, char_to_ix=char_to_ix,
                           char_rep_size=config_dict["char_rep_size"],
                           dims=model_dims,
@@ -382,6 +404,18 @@ def load_model_embeddings(config_dict: Dict) -> None:
         i += 1
     logging.info('Word embeddings have been loaded.')
     # load char embeddings
+    load_char_embeddings(config_dict)
+
+
+def load_char_embeddings(config_dict: Dict) -> None:
+    """
+    The char embeddings part of load_model_embeddings().
+
+    :param config_dict: A configuration dictionary which should have items:
+        "use_pretrained_char", "char_pretrained_path", "char_vocab_path".
+    :returns: No return. The global variables char_embeds, char_to_ix are changed.
+    """
+    global char_embeds, char_to_ix
     if config_dict["use_pretrained_char"]:
         logging.info('Loading pre-trained char embeddings from %s and %s.' % (config_dict["char_pretrained_path"], config_dict["char_vocab_path"]))
         char_embeds, char_vocab = loadGloveCharEmbeddings(config_dict["char_pretrained_path"],
@@ -405,6 +439,270 @@ def load_model_embeddings(config_dict: Dict) -> None:
         logging.info('One-hot char embeddings have been loaded.')
 
 
+def create_word_embeds_store(config_dict: Dict) -> None:
+    """
+    Puts the word embeddings into one store, so the event model and the entity model use the same
+    frozen embeddings instead of a copy each (see WordEmbeddingStore).
+
+    If config_dict["word_embeds_store_path"] is set, the store is saved to this path (if it is not
+    there yet) and loaded from it memory-mapped. Then the saved models reference this file instead
+    of holding the embeddings.
+
+    :param config_dict: A configuration dictionary, "word_embeds_store_path" is optional.
+    :returns: No return. The global variable word_embeds_store is set (and word_embeds is released).
+    """
+    global word_embeds, word_to_ix, word_embeds_store
+    store_path = config_dict.get("word_embeds_store_path", "")
+    if store_path and os.path.exists(store_path + '.npy'):
+        logging.info('Loading word embeddings store from %s.' % store_path)
+        word_embeds_store = WordEmbeddingStore.get_shared(store_path)
+    else:
+        word_embeds_store = WordEmbeddingStore(word_embeds, word_to_ix)
+        if store_path:
+            logging.info('Saving word embeddings store to %s.' % store_path)
+            word_embeds_store.save(store_path)
+            word_embeds_store = WordEmbeddingStore.get_shared(store_path)
+    word_embeds = None
+    word_to_ix = word_embeds_store.word_to_ix
+
+
+def train_topic(cur_topic_id: str, cur_topic: Topic, epoch: int, topics_counter: int, topics_num: int,
+                doc_to_entity_mentions, device: torch.cuda.device,
+                cd_event_model: CDCorefScorer, cd_event_optimizer, cd_event_loss,
+                cd_entity_model: CDCorefScorer, cd_entity_optimizer, cd_entity_loss,
+                event_th: float, entity_th: float) -> None:
+    """
+    Runs the training procedure on one topic of the train set: initializes the topic's entity and
+    event clusters, and then alternates between entity and event training and clustering.
+
+    :param cur_topic_id: the topic's id
+    :param cur_topic: Topic object represents the current topic
+    :param epoch: current epoch number
+    :param topics_counter: the number of current topic
+    :param topics_num: total number of topics
+    :param doc_to_entity_mentions: the predicted WD entity coref chains (see load_entity_wd_clusters())
+    :param device: gpu/cpu Pytorch device
+    :param cd_event_model: the event CDCorefScorer
+    :param cd_event_optimizer: the event model's optimizer
+    :param cd_event_loss: the event model's loss function
+    :param cd_entity_model: the entity CDCorefScorer
+    :param cd_entity_optimizer: the entity model's optimizer
+    :param cd_entity_loss: the entity model's loss function
+    :param event_th: the event merging threshold
+    :param entity_th: the entity merging threshold
+    :return: No return. The models are trained.
+    """
+    logging.info('=========================================================================')
+    logging.info('Topic {}:'.format(cur_topic_id))
+
+    # 1.1. extract golden event and entity mention
+    event_mentions, entity_mentions = topic_to_mention_list(cur_topic, is_gold=True)
+    # 预先查好指称的词和字的索引 (word/char indices, both models share the vocabularies)
+    index_mentions(event_mentions + entity_mentions, cd_event_model)
+
+    # 1.2. initialize entity cluster
+    if 1:
+        entity_clusters: List[Cluster] = []
+        """ entity cluster list. """
+        # get entity cluster
+        if 1:
+            # strategy 1: initial entity clusters = singleton clusters.
+            if 0:  # we don't use this strategy.
+                entity_clusters = mention_list_to_singleton_cluster_list(entity_mentions, is_event=False)
+            # strategy 2: initial entity clusters = gold WD entity coref clusters.
+            elif config_dict["train_init_wd_entity_with_gold"]:
+                entity_clusters = mention_list_to_gold_wd_cluster_list(entity_mentions, is_event=False)
+            # strategy 3: initial entity clusters = external WD entity coref clusters
+            else:
+                entity_clusters = mention_list_to_external_wd_cluster_list(entity_mentions, doc_to_entity_mentions,
+                                                                           is_event=False, )
+        # calc entity cluster vector
+        update_lexical_vectors(entity_clusters, cd_entity_model, device,
+                               is_event=False, requires_grad=False)
+    # 1.3. initialize event cluster
+    if 1:
+        event_clusters: List[Cluster] = []
+        """ event Cluster list.  """
+        # get event cluster: initial event clusters = singleton clusters.
+        event_clusters = mention_list_to_singleton_cluster_list(event_mentions, is_event=True)
+        # calc event cluster representation
+        update_lexical_vectors(event_clusters, cd_event_model, device,
+                               is_event=True, requires_grad=False)
+
+    # 1.4. merge and train
+    """ 
+    while ∃ meaningful cluster-pair merge do
+    论文中是迭代聚合直到没有新簇产生，这里却是直接指定迭代聚合次数
+    merge XXX times
+    """
+    for i in range(1, config_dict["merge_iters"] + 1):
+        logging.info('Iteration number {}'.format(i))
+
+        # Entities
+        """
+        E_t <- UpdateJointFeatures(V_t)
+        S_E <- TrainMentionPairScorer(E_t; G)
+        E_t <- MergeClusters(S_E; E_t)
+        """
+        logging.info('Train entity model and merge entity clusters...')
+        train_and_merge(clusters=entity_clusters, other_clusters=event_clusters,
+                        model=cd_entity_model, optimizer=cd_entity_optimizer,
+                        loss=cd_entity_loss, device=device, topic=cur_topic, is_event=False, epoch=epoch,
+                        topics_counter=topics_counter, topics_num=topics_num,
+                        threshold=entity_th)
+        # Events
+        """
+        V_t <- UpdateJointFeatures(E_t)
+        S_V <- TrainMentionPairScorer(V_t; G)
+        V_t <- MergeClusters(S_V; V_t)
+        """
+        logging.info('Train event model and merge event clusters...')
+        train_and_merge(clusters=event_clusters, other_clusters=entity_clusters,
+                        model=cd_event_model, optimizer=cd_event_optimizer,
+                        loss=cd_event_loss, device=device, topic=cur_topic, is_event=True, epoch=epoch,
+                        topics_counter=topics_counter, topics_num=topics_num,
+                        threshold=event_th)
+
+
+def hogwild_worker(rank: int, processes: int, parameters_queue, tasks, results, topics: Dict[str, Topic],
+                   doc_to_entity_mentions, device: torch.cuda.device) -> None:
+    """
+    The loop of a HogwildTrainer worker process: builds its own event and entity models, takes their
+    trainable parameters (shared with the main process) from *parameters_queue*, and then takes topics
+    from *tasks* and trains the shared parameters on them (see train_topic()), until it gets None.
+
+    :param rank: the worker's number
+    :param processes: the number of worker processes
+    :param parameters_queue: the worker's queue of the shared parameters, see HogwildTrainer.share_models()
+    :param tasks: a queue of tuples (epoch, topics_counter, topics_num, topic_id, event_merge_threshold,
+        entity_merge_threshold), or None to stop
+    :param results: a queue of tuples (topic_id, error), error is None or the traceback of a failed topic
+    :param topics: the topics of the train set (the worker's own copy)
+    :param doc_to_entity_mentions: the predicted WD entity coref chains (see load_entity_wd_clusters())
+    :param device: Pytorch device (cpu)
+    :return: No return.
+    """
+    # 每个进程分到一部分CPU核
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // processes))
+    random.seed(config_dict["random_seed"] + rank)
+    np.random.seed(config_dict["random_seed"] + rank)
+    torch.manual_seed(config_dict["seed"] + rank)
+    cd_event_model = create_model(config_dict).to(device)
+    cd_entity_model = create_model(config_dict).to(device)
+    # 可训练参数换成主进程的共享内存参数 (the frozen word embeddings are already shared by the fork)
+    for model, shared_parameters in zip([cd_event_model, cd_entity_model], parameters_queue.get()):
+        trainable_parameters = [parameter for parameter in model.parameters() if parameter.requires_grad]
+        for parameter, shared_parameter in zip(trainable_parameters, shared_parameters):
+            parameter.data = shared_parameter
+    # 每个进程有自己的optimizer, 参数是共享的
+    cd_event_optimizer = create_optimizer(config_dict, cd_event_model)
+    cd_entity_optimizer = create_optimizer(config_dict, cd_entity_model)
+    cd_event_loss = create_loss(config_dict)
+    cd_entity_loss = create_loss(config_dict)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, topics_counter, topics_num, topic_id, event_th, entity_th = task
+        try:
+            train_topic(topic_id, topics[topic_id], epoch, topics_counter, topics_num,
+                        doc_to_entity_mentions, device,
+                        cd_event_model, cd_event_optimizer, cd_event_loss,
+                        cd_entity_model, cd_entity_optimizer, cd_entity_loss,
+                        event_th, entity_th)
+        except Exception:
+            results.put((topic_id, traceback.format_exc()))
+            break
+        results.put((topic_id, None))
+
+
+class HogwildTrainer(object):
+    """
+    Trains the event and entity models on the topics of each epoch with several worker processes
+    (Hogwild!, Recht et al. 2011): the trainable parameters are moved to shared memory, and each
+    worker takes topics from a queue and updates them asynchronously, without locks, with its own
+    optimizer.
+
+    The workers are forked once and live across the epochs. They must be forked before the main
+    process runs any torch operation (forking a process whose torch thread pools are running can
+    deadlock the child), so they are created before the models: each worker builds its own models,
+    sharing the frozen word embeddings with the main process through the fork, and then gets the main
+    process's trainable parameters (see share_models()). Each worker trains on its own (forked) copy
+    of the topics, nothing set on them is sent back. Only CPU training is supported.
+    """
+    def __init__(self, processes: int, topics: Dict[str, Topic], doc_to_entity_mentions,
+                 device: torch.cuda.device):
+        '''
+        :param processes: the number of worker processes
+        :param topics: the topics of the train set
+        :param doc_to_entity_mentions: the predicted WD entity coref chains (see load_entity_wd_clusters())
+        :param device: Pytorch device (cpu)
+        '''
+        context = torch.multiprocessing.get_context('fork')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.parameters_queues = []
+        self.workers = []
+        for rank in range(processes):
+            parameters_queue = context.Queue()
+            worker = context.Process(target=hogwild_worker,
+                                     args=(rank, processes, parameters_queue, self.tasks, self.results, topics,
+                                           doc_to_entity_mentions, device))
+            worker.daemon = True
+            worker.start()
+            self.parameters_queues.append(parameters_queue)
+            self.workers.append(worker)
+        logging.info('Started {} Hogwild training processes'.format(processes))
+
+    def share_models(self, cd_event_model: CDCorefScorer, cd_entity_model: CDCorefScorer) -> None:
+        '''
+        Moves the trainable parameters of the models to shared memory and sends them to the workers,
+        which train them from now on.
+        :param cd_event_model: the event model
+        :param cd_entity_model: the entity model
+        '''
+        shared_parameters = []
+        for model in [cd_event_model, cd_entity_model]:
+            trainable_parameters = [parameter.data for parameter in model.parameters() if parameter.requires_grad]
+            for parameter in trainable_parameters:
+                parameter.share_memory_()
+            shared_parameters.append(trainable_parameters)
+        for parameters_queue in self.parameters_queues:
+            parameters_queue.put(shared_parameters)
+
+    def train_epoch(self, epoch: int, topics_keys: List[str], topics_num: int,
+                    event_th: float, entity_th: float) -> None:
+        '''
+        Trains the models on the given topics, and waits for all of them.
+        :param epoch: current epoch number
+        :param topics_keys: the ids of the topics to train on
+        :param topics_num: total number of topics
+        :param event_th: the event merging threshold
+        :param entity_th: the entity merging threshold
+        '''
+        for topics_counter, topic_id in enumerate(topics_keys, 1):
+            self.tasks.put((epoch, topics_counter, topics_num, topic_id, event_th, entity_th))
+        for _ in range(len(topics_keys)):
+            while True:
+                try:
+                    topic_id, error = self.results.get(timeout=10)
+                    break
+                except queue.Empty:
+                    if not all(worker.is_alive() for worker in self.workers):
+                        raise RuntimeError('A Hogwild training process exited unexpectedly')
+            if error is not None:
+                raise RuntimeError('Training on topic {} failed:\n{}'.format(topic_id, error))
+
+    def close(self) -> None:
+        '''
+        Stops the worker processes.
+        '''
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+
 def main():
     """
     This function:
@@ -426,18 +724,35 @@ def main():
     doc_to_entity_mentions = load_entity_wd_clusters(config_dict)
     # 1.3 loading pre-trained embeddings
     global word_embeds, word_to_ix, char_embeds, char_to_ix
-    """
-    # 这段代码加载word和char的embeddings，并存到pkl。方便以后从pkl加载，这样比较快。
-    load_model_embeddings(config_dict)
-    with open('output/trainGlobal.pkl', 'wb') as f:
-        cPickle.dump((word_embeds, word_to_ix, char_embeds, char_to_ix), f)
-    """
-    with open('output/trainGlobal.pkl', 'rb') as f:
-        word_embeds, word_to_ix, char_embeds, char_to_ix = cPickle.load(f)
+    store_path = config_dict.get("word_embeds_store_path", "")
+    if store_path and os.path.exists(store_path + '.npy'):
+        # 词向量已转换成store (see build_word_embeds_store.py)，只需加载字符向量
+        load_char_embeddings(config_dict)
+    else:
+        """
+        # 这段代码加载word和char的embeddings，并存到pkl。方便以后从pkl加载，这样比较快。
+        load_model_embeddings(config_dict)
+        with open('output/trainGlobal.pkl', 'wb') as f:
+            cPickle.dump((word_embeds, word_to_ix, char_embeds, char_to_ix), f)
+        """
+        with open('output/trainGlobal.pkl', 'rb') as f:
+            word_embeds, word_to_ix, char_embeds, char_to_ix = cPickle.load(f)
+    # 两个模型共用一份词向量 (one frozen word embeddings store for both models)
+    create_word_embeds_store(config_dict)
+    device: torch.cuda.device = torch.device("cuda:0" if args.use_cuda else "cpu")
+
+    # 2. 多进程训练 (Hogwild), 否则单进程按顺序训练每个topic.
+    # The workers are forked here, before any torch operation (see HogwildTrainer).
+    hogwild_trainer = None
+    if config_dict.get("train_processes", 1) > 1:
+        if args.use_cuda:
+            logging.warning('Hogwild training is supported only on CPU, training in a single process')
+        else:
+            hogwild_trainer = HogwildTrainer(config_dict["train_processes"], train_set.topics,
+                                             doc_to_entity_mentions, device)
 
     # 3. create model
     logging.info('Create model')
-    device: torch.cuda.device = torch.device("cuda:0" if args.use_cuda else "cpu")
 
     cd_event_model: CDCorefScorer = create_model(config_dict)
     cd_event_model = cd_event_model.to(device)
@@ -455,6 +770,9 @@ def main():
     cd_event_loss = create_loss(config_dict)
     cd_entity_loss = create_loss(config_dict)
 
+    if hogwild_trainer is not None:
+        hogwild_trainer.share_models(cd_event_model, cd_entity_model)
+
     topics: Dict[str, Topic] = train_set.topics  # Use the gold sub-topics
     """
     topic dict of train set. ::
@@ -483,81 +801,18 @@ def main():
         """ In cur epoch, how many topics has been processed or being processed. """
 
         # 1. training models on whole train set once (one epoch)
-        """ for each topic in training set """
-        for cur_topic_id in topics_keys:
-            topics_counter += 1
-            cur_topic: Topic = topics[cur_topic_id]
-
-            logging.info('=========================================================================')
-            logging.info('Topic {}:'.format(cur_topic_id))
-
-            # 1.1. extract golden event and entity mention
-            event_mentions, entity_mentions = topic_to_mention_list(cur_topic, is_gold=True)
-
-            # 1.2. initialize entity cluster
-            if 1:
-                entity_clusters: List[Cluster] = []
-                """ entity cluster list. """
-                # get entity cluster
-                if 1:
-                    # strategy 1: initial entity clusters = singleton clusters.
-                    if 0:  # we don't use this strategy.
-                        entity_clusters = mention_list_to_singleton_cluster_list(entity_mentions, is_event=False)
-                    # strategy 2: initial entity clusters = gold WD entity coref clusters.
-                    elif config_dict["train_init_wd_entity_with_gold"]:
-                        entity_clusters = mention_list_to_gold_wd_cluster_list(entity_mentions, is_event=False)
-                    # strategy 3: initial entity clusters = external WD entity coref clusters
-                    else:
-                        entity_clusters = mention_list_to_external_wd_cluster_list(entity_mentions, doc_to_entity_mentions,
-                                                                                   is_event=False, )
-                # calc entity cluster vector
-                update_lexical_vectors(entity_clusters, cd_entity_model, device,
-                                       is_event=False, requires_grad=False)
-            # 1.3. initialize event cluster
-            if 1:
-                event_clusters: List[Cluster] = []
-                """ event Cluster list.  """
-                # get event cluster: initial event clusters = singleton clusters.
-                event_clusters = mention_list_to_singleton_cluster_list(event_mentions, is_event=True)
-                # calc event cluster representation
-                update_lexical_vectors(event_clusters, cd_event_model, device,
-                                       is_event=True, requires_grad=False)
-
-            # 1.4. merge and train
-            entity_th = config_dict["entity_merge_threshold"]
-            event_th = config_dict["event_merge_threshold"]
-            """ 
-            while ∃ meaningful cluster-pair merge do
-            论文中是迭代聚合直到没有新簇产生，这里却是直接指定迭代聚合次数
-            merge XXX times
-            """
-            for i in range(1, config_dict["merge_iters"] + 1):
-                logging.info('Iteration number {}'.format(i))
-
-                # Entities
-                """
-                E_t <- UpdateJointFeatures(V_t)
-                S_E <- TrainMentionPairScorer(E_t; G)
-                E_t <- MergeClusters(S_E; E_t)
-                """
-                logging.info('Train entity model and merge entity clusters...')
-                train_and_merge(clusters=entity_clusters, other_clusters=event_clusters,
-                                model=cd_entity_model, optimizer=cd_entity_optimizer,
-                                loss=cd_entity_loss, device=device, topic=cur_topic, is_event=False, epoch=epoch,
-                                topics_counter=topics_counter, topics_num=topics_num,
-                                threshold=entity_th)
-                # Events
-                """
-                V_t <- UpdateJointFeatures(E_t)
-                S_V <- TrainMentionPairScorer(V_t; G)
-                V_t <- MergeClusters(S_V; V_t)
-                """
-                logging.info('Train event model and merge event clusters...')
-                train_and_merge(clusters=event_clusters, other_clusters=entity_clusters,
-                                model=cd_event_model, optimizer=cd_event_optimizer,
-                                loss=cd_event_loss, device=device, topic=cur_topic, is_event=True, epoch=epoch,
-                                topics_counter=topics_counter, topics_num=topics_num,
-                                threshold=event_th)
+        if hogwild_trainer is not None:
+            hogwild_trainer.train_epoch(epoch, topics_keys, topics_num,
+                                        config_dict["event_merge_threshold"], config_dict["entity_merge_threshold"])
+        else:
+            """ for each topic in training set """
+            for cur_topic_id in topics_keys:
+                topics_counter += 1
+                train_topic(cur_topic_id, topics[cur_topic_id], epoch, topics_counter, topics_num,
+                            doc_to_entity_mentions, device,
+                            cd_event_model, cd_event_optimizer, cd_event_loss,
+                            cd_entity_model, cd_entity_optimizer, cd_entity_loss,
+                            config_dict["event_merge_threshold"], config_dict["entity_merge_threshold"])
 
         # 2. testing models on whole dev set once (one epoch)
         logging.info('Testing models on dev set...')
@@ -589,6 +844,9 @@ def main():
             save_summary(event_best_dev_f1, entity_best_dev_f1, best_event_epoch, best_entity_epoch, epoch)
             break
 
+    if hogwild_trainer is not None:
+        hogwild_trainer.close()
+
 
 if __name__ == '__main__':
     main()
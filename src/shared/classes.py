@@ -1,4 +1,6 @@
-from collections import defaultdict
+import collections.abc
+import itertools
+from collections import defaultdict, Counter
 import torch
 
 
@@ -424,6 +426,30 @@ class Mention(object):
         self.arg1_vec = None
         self.loc_vec = None
         self.time_vec = None
+        self.lex_vec = None
+        """The mention's part of its cluster's lexical vector (see update_lexical_vectors())."""
+        self.lex_vec_version = None
+        """The model parameters version lex_vec was computed with (see model_utils.model_parameters_version())."""
+
+        # word/char embedding indices, set by model_utils.index_mentions()
+        self.head_word_ix = None
+        """The vocabulary index of the head."""
+        self.word_ixs = None
+        """The vocabulary indices of the tokens (stop words excluded), a numpy array."""
+        self.head_char_ixs = None
+        """The char indices of the head string, a numpy array."""
+        self.span_char_ixs = None
+        """The char indices of the mention string, a numpy array."""
+
+        # set by model_utils.update_role_signatures()
+        self.role_signature = None
+        """
+        The cluster ids (in the other type's ClusterList) of the mention's Arg0/Arg1/location/time
+        arguments (for an event mention) or predicates (for an entity mention), a tuple of four
+        tuples of ints.
+        """
+        self.role_signature_version = None
+        """The ClusterList.version the role signature was computed at."""
 
         self.head_elmo_embeddings: torch.Tensor = None
 
@@ -648,13 +674,58 @@ class Srl_info(object):
         return 'sent_id {}  tok_id {} predicate {}'.format(self.sent_id, self.tok_id, self.predicate)
 
 
+class MentionsDict(dict):
+    '''
+    A dict (mention id -> Mention object) that counts its changes, so values computed from a
+    cluster's mentions can be cached until they change (see Cluster.get_gold_tag_counts()).
+    '''
+    def __init__(self, *args, **kwargs):
+        super(MentionsDict, self).__init__(*args, **kwargs)
+        self.version = 0
+        """Incremented whenever a mention is added or removed."""
+
+    def _changed(self):
+        self.version = getattr(self, 'version', 0) + 1
+
+    def __setitem__(self, key, value):
+        super(MentionsDict, self).__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super(MentionsDict, self).__delitem__(key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        super(MentionsDict, self).update(*args, **kwargs)
+        self._changed()
+
+    def setdefault(self, key, default=None):
+        value = super(MentionsDict, self).setdefault(key, default)
+        self._changed()
+        return value
+
+    def pop(self, *args):
+        value = super(MentionsDict, self).pop(*args)
+        self._changed()
+        return value
+
+    def popitem(self):
+        item = super(MentionsDict, self).popitem()
+        self._changed()
+        return item
+
+    def clear(self):
+        super(MentionsDict, self).clear()
+        self._changed()
+
+
 class Cluster(object):
     '''
     A class represents a coreference cluster
     '''
     def __init__(self, is_event):
         self.cluster_id = 0
-        self.mentions = {}
+        self.mentions = MentionsDict()
         """
         A mentions dictionary of this cluster.
         Key is mention id.
@@ -664,10 +735,22 @@ class Cluster(object):
         """This cluster is event cluster or entity cluster."""
         self.merged = False
         self.lex_vec = None
+        """The cluster's lexical vector, the average of its mentions' vectors."""
+        self.lex_vec_sum = None
+        """The sum of the mentions' vectors, lex_vec = lex_vec_sum / lex_vec_count."""
+        self.lex_vec_count = 0
+        """The number of mention vectors summed in lex_vec_sum."""
         self.arg0_vec = None
         self.arg1_vec = None
         self.loc_vec = None
         self.time_vec = None
+        self.gold_tag_counts = None
+        """
+        A Counter of the gold tags of this cluster's mentions (gold tag -> number of mentions),
+        or None if it was not computed yet. See get_gold_tag_counts().
+        """
+        self.gold_tag_counts_version = None
+        """The version of self.mentions (see MentionsDict) gold_tag_counts was computed for."""
 
     # def __eq__(self, other):
     #     for key in self.__dict__.keys():
@@ -686,6 +769,31 @@ class Cluster(object):
                                                       mention.gold_tag, mention.mention_id))
         return str(mentions_strings)
 
+    def get_gold_tag_counts(self):
+        '''
+        Returns the gold tags histogram of the cluster's mentions. It is computed from the mentions
+        on first use (or if the mentions were changed since), and merge_clusters() sets it for a new
+        cluster as the sum of its parents' histograms (see set_gold_tag_counts()).
+        :return: a Counter, gold tag -> number of mentions
+        '''
+        if not isinstance(self.mentions, MentionsDict):
+            # clusters pickled before MentionsDict was added, or given a plain dict
+            self.mentions = MentionsDict(self.mentions)
+        gold_tag_counts = getattr(self, 'gold_tag_counts', None)
+        if gold_tag_counts is None or getattr(self, 'gold_tag_counts_version', None) != self.mentions.version:
+            self.set_gold_tag_counts(Counter(mention.gold_tag for mention in self.mentions.values()))
+        return self.gold_tag_counts
+
+    def set_gold_tag_counts(self, gold_tag_counts):
+        '''
+        Sets the gold tags histogram of the cluster's current mentions
+        :param gold_tag_counts: a Counter, gold tag -> number of mentions
+        '''
+        if not isinstance(self.mentions, MentionsDict):
+            self.mentions = MentionsDict(self.mentions)
+        self.gold_tag_counts = gold_tag_counts
+        self.gold_tag_counts_version = self.mentions.version
+
     def __str__(self):
         mentions_strings = []
         for mention in self.mentions.values():
@@ -704,4 +812,300 @@ class Cluster(object):
         return mentions_strings
 
 
+class DisjointSet(object):
+    '''
+    A disjoint-set (union-find) structure over the integers 0..n-1, with path compression and union
+    by size, so find() and union() cost O(α(n)) amortized time.
+    '''
+    def __init__(self):
+        self.parents = []
+        """parents[x] is the parent of x in its tree, a root is its own parent."""
+        self.sizes = []
+        """sizes[root] is the number of elements in root's set."""
 
+    def __len__(self):
+        return len(self.parents)
+
+    def add(self):
+        '''
+        Adds a new singleton set
+        :return: the new element (and the id of its set)
+        '''
+        element = len(self.parents)
+        self.parents.append(element)
+        self.sizes.append(1)
+        return element
+
+    def find(self, element):
+        '''
+        :param element: an element
+        :return: the root (id) of the element's set
+        '''
+        parents = self.parents
+        while parents[element] != element:
+            parents[element] = parents[parents[element]]
+            element = parents[element]
+        return element
+
+    def union(self, element_1, element_2):
+        '''
+        Merges the sets of two elements
+        :param element_1: first element
+        :param element_2: second element
+        :return: the root (id) of the merged set, which is the root of the larger of the two sets.
+        '''
+        root_1 = self.find(element_1)
+        root_2 = self.find(element_2)
+        if root_1 == root_2:
+            return root_1
+        if self.sizes[root_1] < self.sizes[root_2]:
+            root_1, root_2 = root_2, root_1
+        self.parents[root_2] = root_1
+        self.sizes[root_1] += self.sizes[root_2]
+        return root_1
+
+
+class ClusterList(list):
+    '''
+    A list of Cluster objects that also keeps, in a disjoint-set over the mentions, which cluster
+    contains each mention, so the cluster of a mention is found in O(α(n)) instead of scanning all
+    the clusters (see model_utils.find_mention_cluster()).
+
+    Each cluster in the list has a stable integer id (the root of its mentions' set, see
+    get_cluster_id()), which does not change until the cluster is merged. merge() replaces two
+    clusters by their merged cluster in O(α(n)): the mentions' sets are joined by one union, without
+    re-indexing the mentions, and the two clusters are swap-removed from the list (the last cluster
+    takes the place of a removed one).
+
+    So after a merge() the list is not in the order of a plain list (where the two clusters would
+    be removed and the merged cluster appended). That order is kept as a sequence number of each
+    cluster, and ordered() returns it. The candidate pairs are generated in this order, since
+    their orientation (cluster_1, cluster_2) affects their scores. The other list operations
+    restore this order first.
+
+    The mentions of a cluster should not be changed while it is in the list (merge_clusters()
+    creates a new cluster instead).
+
+    Every change of the list sets a new version (unique among all the lists), so values computed
+    from the clusters can be cached until the version changes (see model_utils.update_role_signatures()).
+    '''
+    _versions = itertools.count()
+    def __init__(self, clusters=()):
+        super(ClusterList, self).__init__()
+        self.mentions_set = DisjointSet()
+        """A disjoint-set over the mentions of the clusters, one set per cluster in the list."""
+        self.mention_to_element = {}
+        """Key is a mention id, value is its element in mentions_set."""
+        self.id_to_cluster = {}
+        """Key is a cluster id (a root of mentions_set), value is the Cluster object."""
+        self.cluster_to_id = {}
+        """Key is a Cluster object in this list, value is its id."""
+        self.cluster_to_slot = {}
+        """Key is a Cluster object in this list, value is its index in the list."""
+        self.cluster_to_seq = {}
+        """Key is a Cluster object in this list, value is its position in the list's order (see ordered())."""
+        self.next_seq = 0
+        self.mention_to_cluster = _MentionToCluster(self)
+        """
+        A read-only mapping view, key is a mention id and value is the Cluster object in this list
+        which contains the mention.
+        """
+        self.version = next(ClusterList._versions)
+        """Changes whenever a cluster is added, removed or merged."""
+        self.extend(clusters)
+
+    def __reduce__(self):
+        return ClusterList, (self.ordered(),)
+
+    def ordered(self):
+        '''
+        :return: a list of the clusters, in the order of a plain list that had the same operations
+        '''
+        return sorted(self, key=self.cluster_to_seq.__getitem__)
+
+    def _add_to_index(self, cluster):
+        # the mentions get new elements, their old elements (if any) belong to removed clusters
+        cluster_id = None
+        for mention_id in cluster.mentions:
+            element = self.mentions_set.add()
+            self.mention_to_element[mention_id] = element
+            cluster_id = element if cluster_id is None else self.mentions_set.union(cluster_id, element)
+        if cluster_id is not None:
+            self.id_to_cluster[cluster_id] = cluster
+            self.cluster_to_id[cluster] = cluster_id
+        self.version = next(ClusterList._versions)
+
+    def _remove_from_index(self, cluster):
+        cluster_id = self.cluster_to_id.pop(cluster, None)
+        if cluster_id is not None:
+            del self.id_to_cluster[cluster_id]
+        self.version = next(ClusterList._versions)
+
+    def _push(self, cluster):
+        super(ClusterList, self).append(cluster)
+        self.cluster_to_slot[cluster] = len(self) - 1
+        self.cluster_to_seq[cluster] = self.next_seq
+        self.next_seq += 1
+
+    def _swap_remove(self, cluster):
+        # O(1): the last cluster is moved into the removed cluster's slot
+        slot = self.cluster_to_slot.pop(cluster)
+        del self.cluster_to_seq[cluster]
+        last = super(ClusterList, self).pop()
+        if last is not cluster:
+            super(ClusterList, self).__setitem__(slot, last)
+            self.cluster_to_slot[last] = slot
+
+    def _restore_order(self):
+        # before an operation by position, the list is put in the order of ordered()
+        super(ClusterList, self).__setitem__(slice(None), self.ordered())
+
+    def _renumber(self):
+        self.cluster_to_slot = {cluster: slot for slot, cluster in enumerate(self)}
+        self.cluster_to_seq = dict(self.cluster_to_slot)
+        self.next_seq = len(self)
+
+    def reindex(self):
+        '''
+        Rebuilds the mention index, e.g. after the mentions of a cluster in the list were changed.
+        '''
+        self.mentions_set = DisjointSet()
+        self.mention_to_element = {}
+        self.id_to_cluster = {}
+        self.cluster_to_id = {}
+        self.version = next(ClusterList._versions)
+        for cluster in self:
+            self._add_to_index(cluster)
+
+    def get_cluster_id(self, cluster):
+        '''
+        :param cluster: a Cluster object in this list
+        :return: the cluster's integer id, or None if the cluster is not in the list (or is empty).
+        '''
+        return self.cluster_to_id.get(cluster)
+
+    def find_mention_cluster_id(self, mention_id):
+        '''
+        :param mention_id: mention ID
+        :return: the id of the cluster in this list which contains the mention, or None.
+        '''
+        element = self.mention_to_element.get(mention_id)
+        if element is None:
+            return None
+        cluster_id = self.mentions_set.find(element)
+        return cluster_id if cluster_id in self.id_to_cluster else None
+
+    def find_mention_cluster(self, mention_id):
+        '''
+        :param mention_id: mention ID
+        :return: the Cluster object in this list which contains the mention, or None.
+        '''
+        element = self.mention_to_element.get(mention_id)
+        if element is None:
+            return None
+        return self.id_to_cluster.get(self.mentions_set.find(element))
+
+    def merge(self, cluster_1, cluster_2, merged_cluster):
+        '''
+        Replaces two clusters of the list by their merged cluster (whose mentions should be the
+        union of their mentions) in O(α(n)), the mention index is updated by one union.
+        :param cluster_1: first cluster (in the list)
+        :param cluster_2: second cluster (in the list)
+        :param merged_cluster: the merged cluster, it is appended to the list.
+        :return: the merged cluster's id
+        '''
+        cluster_id_1 = self.cluster_to_id.get(cluster_1)
+        cluster_id_2 = self.cluster_to_id.get(cluster_2)
+        self._swap_remove(cluster_1)
+        self._swap_remove(cluster_2)
+        self._remove_from_index(cluster_1)
+        self._remove_from_index(cluster_2)
+        self._push(merged_cluster)
+        if cluster_id_1 is None or cluster_id_2 is None:
+            # an empty cluster has no id, index the merged cluster's mentions
+            self._add_to_index(merged_cluster)
+            return self.get_cluster_id(merged_cluster)
+        merged_id = self.mentions_set.union(cluster_id_1, cluster_id_2)
+        self.id_to_cluster[merged_id] = merged_cluster
+        self.cluster_to_id[merged_cluster] = merged_id
+        self.version = next(ClusterList._versions)
+        return merged_id
+
+    def append(self, cluster):
+        self._push(cluster)
+        self._add_to_index(cluster)
+
+    def insert(self, index, cluster):
+        self._restore_order()
+        super(ClusterList, self).insert(index, cluster)
+        self._renumber()
+        self._add_to_index(cluster)
+
+    def extend(self, clusters):
+        for cluster in clusters:
+            self.append(cluster)
+
+    def __iadd__(self, clusters):
+        self.extend(clusters)
+        return self
+
+    def remove(self, cluster):
+        self._restore_order()
+        super(ClusterList, self).remove(cluster)
+        self._renumber()
+        self._remove_from_index(cluster)
+
+    def pop(self, index=-1):
+        self._restore_order()
+        cluster = super(ClusterList, self).pop(index)
+        self._renumber()
+        self._remove_from_index(cluster)
+        return cluster
+
+    def sort(self, *args, **kwargs):
+        super(ClusterList, self).sort(*args, **kwargs)
+        self._renumber()
+
+    def reverse(self):
+        self._restore_order()
+        super(ClusterList, self).reverse()
+        self._renumber()
+
+    def clear(self):
+        super(ClusterList, self).clear()
+        self._renumber()
+        self.reindex()
+
+    def __setitem__(self, index, value):
+        self._restore_order()
+        super(ClusterList, self).__setitem__(index, value)
+        self._renumber()
+        self.reindex()
+
+    def __delitem__(self, index):
+        self._restore_order()
+        super(ClusterList, self).__delitem__(index)
+        self._renumber()
+        self.reindex()
+
+
+class _MentionToCluster(collections.abc.Mapping):
+    '''
+    The mention id -> Cluster mapping of a ClusterList (see ClusterList.mention_to_cluster).
+    '''
+    def __init__(self, cluster_list):
+        self.cluster_list = cluster_list
+
+    def __getitem__(self, mention_id):
+        cluster = self.cluster_list.find_mention_cluster(mention_id)
+        if cluster is None:
+            raise KeyError(mention_id)
+        return cluster
+
+    def __iter__(self):
+        for cluster in self.cluster_list:
+            for mention_id in cluster.mentions:
+                yield mention_id
+
+    def __len__(self):
+        return sum(len(cluster.mentions) for cluster in self.cluster_list)